@@ -20,22 +20,48 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import argparse
+import base64
+import collections
+import contextlib
+import csv
 import datetime
+import hashlib
+import heapq
+import hmac
+import io
+import json
 import logging
+import multiprocessing
 import os
+import queue
 import re
+import resource
 import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib
 import xml.etree.ElementTree as et
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
+import dateutil.tz
+import numpy as np
+import pandas as pd
 import paramiko
+import pyarrow.feather as feather
 import requests
 import toml
 from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class ConfigurationManager:
@@ -48,6 +74,7 @@ class ConfigurationManager:
   Attributes:
       __required_keys (set): Set of configuration keys that must be present
       __optional_keys (set): Set of optional configuration keys
+      __optional_prefixes (tuple): Prefixes of optional keys with user-defined names, e.g. publish targets
   """
 
   __required_keys = {
@@ -57,7 +84,23 @@ class ConfigurationManager:
     'RSCRIPT.LOS_SCRIPT_PATH', 'RSCRIPT.LOS_MAX', 'RSCRIPT.ERROR_MAX', 'RSCRIPT.CLINIC_NUMS'
   }
 
-  __optional_keys = {'REQUESTS_CA_BUNDLE'}
+  __optional_keys = {
+    'REQUESTS_CA_BUNDLE',
+    'SFTP.WINDOW_SIZE', 'SFTP.MAX_PACKET_SIZE', 'SFTP.CHANNELS', 'SFTP.PARALLEL_MIN_MB', 'SFTP.VERIFY',
+    'SFTP.PUBLISH_MODE', 'SFTP.KEEPALIVE',
+    'BROKER.CONNECT_TIMEOUT', 'BROKER.READ_TIMEOUT', 'BROKER.DOWNLOAD_TIMEOUT',
+    'BROKER.RETRIES', 'BROKER.BACKOFF_FACTOR', 'BROKER.POOL_SIZE',
+    'BROKER.EXPORT_INTERVAL', 'BROKER.EXPORT_DEADLINE', 'BROKER.EXPORT_404_GRACE',
+    'BROKER.FETCH_MODE', 'BROKER.MAX_WORKERS',
+    'RSCRIPT.ENGINE', 'RSCRIPT.INPUT_MODE', 'RSCRIPT.WORKERS', 'RSCRIPT.PROFILE',
+    'RSCRIPT.WORKER', 'RSCRIPT.WORKER_MAX_RSS_MB', 'RSCRIPT.JOB_TIMEOUT',
+    'CACHE.DIR', 'CACHE.MAX_SIZE_MB', 'CACHE.MAX_AGE_DAYS', 'CACHE.CASE_DATA_DIR',
+    'STORE.PATH',
+    'METRICS.REPORT_PATH', 'METRICS.TEXTFILE_PATH',
+    'SCHEDULE.CRON', 'SCHEDULE.HEALTH_HOST', 'SCHEDULE.HEALTH_PORT'
+  }
+
+  __optional_prefixes = ('PUBLISH.',)
 
   def __init__(self, path_toml: Path):
     self.__verify_and_load_toml(path_toml)
@@ -93,11 +136,14 @@ class ConfigurationManager:
     missing_keys = self.__required_keys - loaded_keys
     if missing_keys:
       raise SystemExit(f'Missing keys in config file: {missing_keys}')
-    for key in self.__required_keys | self.__optional_keys:
+    prefixed_keys = {key for key in loaded_keys if key.startswith(self.__optional_prefixes)}
+    for key in self.__required_keys | self.__optional_keys | prefixed_keys:
       if key in config:
         value = config[key]
         if key == 'RSCRIPT.CLINIC_NUMS':
           value = self.__parse_clinic_nums(value)
+        elif isinstance(value, list):
+          value = ','.join(map(str, value))
         os.environ[key] = str(value)
 
   def __parse_clinic_nums(self, ranges_str: str):
@@ -106,81 +152,703 @@ class ConfigurationManager:
     return ','.join(map(str, sorted(numbers)))
 
 
-class SftpFileManager:
-  """Manages SFTP server file operations.
+class PipelineMetrics:
+  """Collects wall time, transferred bytes, processed rows and peak memory per pipeline stage.
 
-  Handles uploading, listing and deleting files on a configured SFTP server.
-  Uses environment variables for connection settings.
+  Stages are measured with the stage() context manager, which yields a dict the
+  caller fills with 'bytes' and 'rows'. Nested stages are named by their path,
+  e.g. "download/broker_export"; stages running concurrently in other threads
+  are nested independently. Summaries of the whole run, like the critical path
+  of the stage graph, are added with annotate(). At the end of a run, a JSON report is written to
+  METRICS.REPORT_PATH and the stage metrics are exported in the Prometheus text
+  format to METRICS.TEXTFILE_PATH for the textfile collector of the node exporter.
+  """
+
+  __prometheus_metrics = (
+    ('duration_seconds', 'los_stage_duration_seconds', 'Wall time of the LOS pipeline stage.'),
+    ('bytes', 'los_stage_bytes', 'Bytes transferred or written by the LOS pipeline stage.'),
+    ('rows', 'los_stage_rows', 'Rows processed by the LOS pipeline stage.'),
+    ('peak_rss_bytes', 'los_stage_peak_rss_bytes', 'Peak resident set size of the LOS pipeline at the end of the stage.'),
+    ('peak_children_rss_bytes', 'los_stage_peak_children_rss_bytes', 'Peak resident set size of the child processes at the end of the stage.')
+  )
+
+  def __init__(self):
+    self.__report_path = os.environ.get('METRICS.REPORT_PATH')
+    self.__textfile_path = os.environ.get('METRICS.TEXTFILE_PATH')
+    self.__local = threading.local()
+    self.__lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.__lock:
+      self.__started_at = datetime.datetime.now(datetime.timezone.utc)
+      self.__start = time.perf_counter()
+      self.__stages = []
+      self.__annotations = {}
+
+  @property
+  def __stack(self) -> list[str]:
+    if not hasattr(self.__local, 'stack'):
+      self.__local.stack = []
+    return self.__local.stack
+
+  @contextlib.contextmanager
+  def stage(self, name: str):
+    path = '/'.join(self.__stack + [name])
+    record = {}
+    status = 'error'
+    self.__stack.append(name)
+    start = time.perf_counter()
+    try:
+      yield record
+      status = 'ok'
+    finally:
+      duration = time.perf_counter() - start
+      self.__stack.pop()
+      with self.__lock:
+        self.__stages.append({'stage': path, 'status': status, 'duration_seconds': round(duration, 6), **record, **self.__measure_peak_rss()})
+      logging.info("Finished stage=%s status=%s duration=%.3fs bytes=%s rows=%s", path, status, duration, record.get('bytes', '-'), record.get('rows', '-'))
+
+  def __measure_peak_rss(self) -> dict:
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+      'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+      'peak_children_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    }
+
+  def record(self, name: str, duration: float, status: str = 'ok', **values):
+    path = '/'.join(self.__stack + [name])
+    with self.__lock:
+      self.__stages.append({'stage': path, 'status': status, 'duration_seconds': round(duration, 6), **values})
+
+  def annotate(self, key: str, value):
+    self.__annotations[key] = value
+
+  def report(self, status: str) -> dict:
+    return {
+      'status': status,
+      'started_at': self.__started_at.isoformat(),
+      'finished_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      'duration_seconds': round(time.perf_counter() - self.__start, 6),
+      'stages': list(self.__stages),
+      **self.__annotations,
+      **self.__measure_peak_rss()
+    }
+
+  def write_report(self, status: str) -> dict:
+    report = self.report(status)
+    logging.info("Pipeline finished status=%s duration=%.3fs stages=%d", status, report['duration_seconds'], len(report['stages']))
+    if self.__report_path:
+      self.__write_atomically(Path(self.__report_path), json.dumps(report, indent=2))
+      logging.info("Run report written path=%s", self.__report_path)
+    if self.__textfile_path:
+      self.__write_atomically(Path(self.__textfile_path), self.format_prometheus(report))
+    return report
+
+  @classmethod
+  def format_prometheus(cls, report: dict) -> str:
+    lines = []
+    for key, metric, description in cls.__prometheus_metrics:
+      samples = [(stage['stage'], stage[key]) for stage in report['stages'] if key in stage]
+      if samples:
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} gauge']
+        lines += [f'{metric}{{stage="{stage}"}} {value}' for stage, value in samples]
+    lines += [
+      '# HELP los_run_duration_seconds Wall time of the last LOS pipeline run.', '# TYPE los_run_duration_seconds gauge',
+      f"los_run_duration_seconds {report['duration_seconds']}",
+      '# HELP los_run_success Whether the last LOS pipeline run succeeded.', '# TYPE los_run_success gauge',
+      f"los_run_success {int(report['status'] == 'ok')}",
+      '# HELP los_run_last_timestamp_seconds Unix time the last LOS pipeline run finished.', '# TYPE los_run_last_timestamp_seconds gauge',
+      f"los_run_last_timestamp_seconds {datetime.datetime.fromisoformat(report['finished_at']).timestamp():.0f}"
+    ]
+    if 'critical_path' in report:
+      lines += [
+        '# HELP los_run_critical_path_seconds Wall time of the critical path through the LOS pipeline stages.',
+        '# TYPE los_run_critical_path_seconds gauge',
+        f"los_run_critical_path_seconds {report['critical_path']['duration_seconds']}"
+      ]
+    return '\n'.join(lines) + '\n'
+
+  def __write_atomically(self, path: Path, content: str):
+    path = path.resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_text(content, encoding='utf-8')
+    os.replace(tmp_path, path)
+
+
+class PipelineGraph:
+  """Runs pipeline stages as a graph with explicit dependencies on a thread pool.
+
+  A stage is started as soon as all stages it depends on have finished, so
+  independent I/O like connecting to the publish destinations overlaps with the
+  broker download and the analysis. Each stage function is called with its
+  metrics record and the results of the finished stages. After the first failure
+  no further stages are started, and the error is raised once the running stages
+  have finished. The critical path, i.e. the chain of dependent stages that
+  determined the total wall time, is added to the run report.
+  """
+
+  def __init__(self, metrics: PipelineMetrics = None):
+    self.__metrics = metrics or PipelineMetrics()
+    self.__stages = {}
+    self.__timings = {}
+
+  def add(self, name: str, func, depends_on: tuple[str, ...] = ()):
+    if name in self.__stages:
+      raise ValueError(f'Duplicate pipeline stage: {name}')
+    unknown = [dependency for dependency in depends_on if dependency not in self.__stages]
+    if unknown:
+      raise ValueError(f'Pipeline stage {name} depends on unknown stages: {unknown}')
+    self.__stages[name] = (func, tuple(depends_on))
+
+  def run(self) -> dict:
+    results, errors, running = {}, [], {}
+    pending = dict(self.__stages)
+    self.__timings = {}
+    start = time.perf_counter()
+    try:
+      with ThreadPoolExecutor(max_workers=max(len(self.__stages), 1), thread_name_prefix='los-stage') as executor:
+        while pending or running:
+          ready = [] if errors else [name for name, (_, depends_on) in pending.items() if all(d in results for d in depends_on)]
+          for name in ready:
+            func, _ = pending.pop(name)
+            running[executor.submit(self.__run_stage, name, func, results, start)] = name
+          if not running:
+            break
+          done, _ = wait(running, return_when=FIRST_COMPLETED)
+          for future in done:
+            name = running.pop(future)
+            try:
+              results[name] = future.result()
+            except BaseException as e:
+              errors.append(e)
+    finally:
+      self.__metrics.annotate('critical_path', self.critical_path())
+    if errors:
+      raise errors[0]
+    return results
+
+  def __run_stage(self, name: str, func, results: dict, start: float):
+    started = time.perf_counter() - start
+    try:
+      with self.__metrics.stage(name) as stage:
+        return func(stage, results)
+    finally:
+      self.__timings[name] = (started, time.perf_counter() - start)
+
+  def critical_path(self) -> dict:
+    if not self.__timings:
+      return {'stages': [], 'duration_seconds': 0.0}
+    name = max(self.__timings, key=lambda stage: self.__timings[stage][1])
+    path = [name]
+    while True:
+      finished = [dependency for dependency in self.__stages[name][1] if dependency in self.__timings]
+      if not finished:
+        break
+      name = max(finished, key=lambda stage: self.__timings[stage][1])
+      path.insert(0, name)
+    return {
+      'stages': path,
+      'duration_seconds': round(self.__timings[path[-1]][1] - self.__timings[path[0]][0], 6),
+      'timeline': {stage: {'start_seconds': round(started, 6), 'end_seconds': round(ended, 6)}
+                   for stage, (started, ended) in sorted(self.__timings.items(), key=lambda item: item[1])}
+    }
+
+
+class SftpConnectionPool:
+  """Pool of SSH sessions and SFTP channels shared by SFTP file managers.
+
+  Sessions are opened lazily on the first request for an endpoint and kept
+  alive with SSH keepalive packets every SFTP.KEEPALIVE seconds. SFTP channels
+  are handed out per operation and returned to the pool afterwards, so repeated
+  uploads, deletes and parallel chunk writes reuse both the handshake and the
+  channels. A session whose transport is no longer active is replaced
+  transparently. Sessions to different endpoints are opened concurrently, the
+  handshake only holds a lock for its own endpoint. Closes all sessions on close()
+  or when used as context manager.
   """
 
+  __connection_errors = (EOFError, paramiko.SSHException, ConnectionError, TimeoutError)
+
   def __init__(self):
-    self.__sftp_host = os.environ['SFTP.HOST']
-    self.__sftp_port = int(os.environ['SFTP.PORT'])
-    self.__sftp_username = os.environ['SFTP.USERNAME']
-    self.__sftp_password = os.environ['SFTP.PASSWORD']
-    self.__sftp_timeout = int(os.environ['SFTP.TIMEOUT'])
-    self.__sftp_folder = Path(os.environ['SFTP.FOLDER'])
-    self.__connection = self.__connect_to_sftp()
-
-  def __connect_to_sftp(self) -> paramiko.sftp_client.SFTPClient:
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(
-        self.__sftp_host,
-        port=self.__sftp_port,
-        username=self.__sftp_username,
-        password=self.__sftp_password,
-        timeout=self.__sftp_timeout,
+    self.__keepalive = int(os.environ.get('SFTP.KEEPALIVE', 30))
+    self.__lock = threading.Lock()
+    self.__endpoint_locks = {}
+    self.__clients = {}
+    self.__idle_channels = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @classmethod
+  def is_connection_error(cls, error: BaseException) -> bool:
+    return isinstance(error, cls.__connection_errors)
+
+  @contextlib.contextmanager
+  def channel(self, endpoint: tuple):
+    sftp = self.__acquire(endpoint)
+    try:
+      yield sftp
+    except BaseException as e:
+      if self.is_connection_error(e):
+        sftp.close()
+      else:
+        self.__release(endpoint, sftp)
+      raise
+    self.__release(endpoint, sftp)
+
+  def __acquire(self, endpoint: tuple) -> paramiko.SFTPClient:
+    host, port, username, password, timeout, window_size, max_packet_size = endpoint
+    with self.__lock:
+      endpoint_lock = self.__endpoint_locks.setdefault(endpoint, threading.Lock())
+    with endpoint_lock:
+      with self.__lock:
+        client = self.__clients.get(endpoint)
+        if client is not None and (not client.get_transport() or not client.get_transport().is_active()):
+          logging.warning('SFTP session is no longer active, reconnecting host=%s port=%d', host, port)
+          self.__close_endpoint(endpoint)
+          client = None
+      if client is None:
+        client = self.__connect(host, port, username, password, timeout)
+        with self.__lock:
+          self.__clients[endpoint] = client
+          self.__idle_channels[endpoint] = []
+    with self.__lock:
+      idle_channels = self.__idle_channels.get(endpoint, [])
+      while idle_channels:
+        sftp = idle_channels.pop()
+        if not sftp.get_channel().closed:
+          return sftp
+    return paramiko.SFTPClient.from_transport(client.get_transport(), window_size=window_size, max_packet_size=max_packet_size)
+
+  def __release(self, endpoint: tuple, sftp: paramiko.SFTPClient):
+    with self.__lock:
+      if endpoint in self.__idle_channels and not sftp.get_channel().closed:
+        self.__idle_channels[endpoint].append(sftp)
+        return
+    sftp.close()
+
+  def __connect(self, host: str, port: int, username: str, password: str, timeout: int) -> paramiko.SSHClient:
+    logging.info('Opening SFTP session host=%s port=%d', host, port)
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        host,
+        port=port,
+        username=username,
+        password=password,
+        timeout=timeout,
         allow_agent=False,
         look_for_keys=False
     )
-    return ssh.open_sftp()
+    client.get_transport().set_keepalive(self.__keepalive)
+    return client
+
+  def discard(self, endpoint: tuple):
+    with self.__lock:
+      self.__close_endpoint(endpoint)
+
+  def __close_endpoint(self, endpoint: tuple):
+    for sftp in self.__idle_channels.pop(endpoint, []):
+      sftp.close()
+    client = self.__clients.pop(endpoint, None)
+    if client:
+      client.close()
+
+  def close(self):
+    with self.__lock:
+      for endpoint in list(self.__clients):
+        self.__close_endpoint(endpoint)
+    logging.info('SFTP connections closed.')
+
+
+class SftpFileManager:
+  """Manages SFTP server file operations.
+
+  Handles uploading, listing and deleting files on a configured SFTP server.
+  Uses environment variables for connection settings. Connects lazily on the
+  first operation through a SftpConnectionPool, which may be shared with other
+  managers, and retries an operation once on a fresh session if the pooled one
+  went stale. Uploads are pipelined over a channel with a tunable window and
+  packet size. Archives larger than SFTP.PARALLEL_MIN_MB are written in chunks
+  over SFTP.CHANNELS parallel channels. Each upload is verified by the remote
+  size or, with SFTP.VERIFY = "hash", by a SHA-256 digest of the remote file.
+  With SFTP.PUBLISH_MODE = "atomic", results are uploaded under a temporary
+  name and renamed over the target, so the folder is never empty or half-written.
+  Reads its settings from the SFTP section or another section with the same keys.
+  """
+
+  __block_size = 256 * 1024
+  __prune_channels = 4
+
+  def __init__(self, pool: SftpConnectionPool = None, section: str = 'SFTP'):
+    self.__owns_pool = pool is None
+    self.__pool = pool or SftpConnectionPool()
+    self.__sftp_folder = Path(os.environ[f'{section}.FOLDER'])
+    self.__channels = int(os.environ.get(f'{section}.CHANNELS', 1))
+    self.__parallel_threshold = float(os.environ.get(f'{section}.PARALLEL_MIN_MB', 16)) * 1024 * 1024
+    self.__verify = os.environ.get(f'{section}.VERIFY', 'size')
+    if self.__verify not in ('none', 'size', 'hash'):
+      raise SystemExit(f'Invalid SFTP verification mode: {self.__verify}')
+    self.__publish_mode = os.environ.get(f'{section}.PUBLISH_MODE', 'replace')
+    if self.__publish_mode not in ('replace', 'atomic'):
+      raise SystemExit(f'Invalid SFTP publish mode: {self.__publish_mode}')
+    self.__endpoint = (
+      os.environ[f'{section}.HOST'],
+      int(os.environ[f'{section}.PORT']),
+      os.environ[f'{section}.USERNAME'],
+      os.environ[f'{section}.PASSWORD'],
+      int(os.environ[f'{section}.TIMEOUT']),
+      int(os.environ.get(f'{section}.WINDOW_SIZE', 8 * 1024 * 1024)),
+      int(os.environ.get(f'{section}.MAX_PACKET_SIZE', 32 * 1024))
+    )
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
 
   def __del__(self):
     try:
-      if self.__connection:
-        self.__connection.close()
-        logging.info('SFTP connection closed.')
+      self.close()
     except Exception as e:
       logging.error('Error closing SFTP connection: %s', e)
 
-  def upload_file(self, path_file: Path):
+  def close(self):
+    if self.__owns_pool:
+      self.__pool.close()
+
+  @property
+  def publish_mode(self) -> str:
+    return self.__publish_mode
+
+  def __run(self, operation):
+    try:
+      with self.__pool.channel(self.__endpoint) as sftp:
+        return operation(sftp)
+    except Exception as e:
+      if not SftpConnectionPool.is_connection_error(e):
+        raise
+      logging.warning('SFTP operation failed on stale session, retrying on a new one error=%s', e)
+      self.__pool.discard(self.__endpoint)
+      with self.__pool.channel(self.__endpoint) as sftp:
+        return operation(sftp)
+
+  def upload_file(self, path_file: Path, remote_name: str = None):
     path_file = Path(path_file).resolve()
     logging.info('Uploading %s to SFTP server', path_file)
     if not path_file.exists():
       raise FileNotFoundError(f"File {path_file} does not exist.")
-    self.__connection.put(str(path_file), str(self.__sftp_folder / path_file.name))
+    remote_path = str(self.__sftp_folder / (remote_name or path_file.name))
+    size = path_file.stat().st_size
+    start = time.perf_counter()
+    channels = self.__channels if size >= self.__parallel_threshold else 1
+    if channels > 1:
+      self.__run(lambda sftp: sftp.open(remote_path, 'wb').close())
+      self.__upload_in_parallel_chunks(path_file, remote_path, size, channels)
+    else:
+      self.__run(lambda sftp: self.__upload_whole_file(sftp, path_file, remote_path, size))
+    self.__run(lambda sftp: self.__verify_upload(sftp, path_file, remote_path, size))
+    elapsed = time.perf_counter() - start
+    logging.info('Uploaded path=%s bytes=%d channels=%d duration=%.3fs throughput=%.1fKiB/s',
+                 path_file.name, size, channels, elapsed, size / 1024 / elapsed if elapsed > 0 else 0)
+
+  def __upload_whole_file(self, sftp: paramiko.SFTPClient, path_file: Path, remote_path: str, size: int):
+    with open(path_file, 'rb') as f:
+      sftp.putfo(f, remote_path, file_size=size, confirm=False)
+
+  def __upload_in_parallel_chunks(self, path_file: Path, remote_path: str, size: int, channels: int):
+    chunk_size = -(-size // channels)
+    ranges = [(offset, min(chunk_size, size - offset)) for offset in range(0, size, chunk_size)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+      futures = [executor.submit(self.__run, lambda sftp, offset=offset, length=length: self.__upload_range(sftp, path_file, remote_path, offset, length))
+                 for offset, length in ranges]
+      for future in futures:
+        future.result()
+
+  def __upload_range(self, sftp: paramiko.SFTPClient, path_file: Path, remote_path: str, offset: int, length: int):
+    with open(path_file, 'rb') as local, sftp.open(remote_path, 'r+b') as remote:
+      remote.set_pipelined(True)
+      local.seek(offset)
+      remote.seek(offset)
+      remaining = length
+      while remaining > 0:
+        data = local.read(min(self.__block_size, remaining))
+        if not data:
+          raise RuntimeError(f'{path_file} shrank during SFTP upload')
+        remote.write(data)
+        remaining -= len(data)
+
+  def __verify_upload(self, sftp: paramiko.SFTPClient, path_file: Path, remote_path: str, size: int):
+    if self.__verify == 'none':
+      return
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != size:
+      sftp.remove(remote_path)
+      raise RuntimeError(f'SFTP upload of {path_file.name} is incomplete: local={size} remote={remote_size}')
+    if self.__verify == 'hash':
+      local_digest = hashlib.sha256()
+      with open(path_file, 'rb') as f:
+        for block in iter(lambda: f.read(self.__block_size), b''):
+          local_digest.update(block)
+      if self.__get_remote_digest(sftp, remote_path, size) != local_digest.digest():
+        sftp.remove(remote_path)
+        raise RuntimeError(f'SFTP upload of {path_file.name} is corrupted: SHA-256 of remote file does not match')
+
+  def __get_remote_digest(self, sftp: paramiko.SFTPClient, remote_path: str, size: int) -> bytes:
+    with sftp.open(remote_path, 'rb') as remote:
+      try:
+        return remote.check('sha256')
+      except IOError:
+        logging.debug('SFTP server does not support check-file, reading back path=%s', remote_path)
+      remote.prefetch(size)
+      remote_digest = hashlib.sha256()
+      for block in iter(lambda: remote.read(self.__block_size), b''):
+        remote_digest.update(block)
+      return remote_digest.digest()
 
   def list_files(self) -> list:
-    return self.__connection.listdir(str(self.__sftp_folder))
+    return self.__run(lambda sftp: sftp.listdir(str(self.__sftp_folder)))
 
   def delete_file(self, filename: str):
     logging.info('Deleting %s from SFTP server', filename)
     try:
-      self.__connection.remove(str(self.__sftp_folder / filename))
+      self.__run(lambda sftp: sftp.remove(str(self.__sftp_folder / filename)))
     except FileNotFoundError:
       logging.warning("File not found on SFTP server")
 
+  def delete_files(self, filenames: list[str]):
+    if len(filenames) <= 1:
+      for filename in filenames:
+        self.delete_file(filename)
+      return
+    channels = min(self.__prune_channels, len(filenames))
+    logging.info('Deleting files=%d from SFTP server channels=%d', len(filenames), channels)
+    with ThreadPoolExecutor(max_workers=channels) as executor:
+      futures = [executor.submit(self.__run, lambda sftp, batch=filenames[i::channels]: self.__delete_batch(sftp, batch)) for i in range(channels)]
+      for future in futures:
+        future.result()
+
+  def __delete_batch(self, sftp: paramiko.SFTPClient, filenames: list[str]):
+    for filename in filenames:
+      try:
+        sftp.remove(str(self.__sftp_folder / filename))
+      except FileNotFoundError:
+        logging.warning("File not found on SFTP server file=%s", filename)
+
+  def publish_files(self, file_paths: list[Path]):
+    published = set()
+    for file_path in file_paths:
+      file_path = Path(file_path).resolve()
+      temp_name = f'.{file_path.name}.part'
+      self.upload_file(file_path, temp_name)
+      self.__run(lambda sftp: self.__replace_remote_file(sftp, temp_name, file_path.name))
+      published.add(file_path.name)
+    stale = [filename for filename in self.list_files() if filename not in published]
+    self.delete_files(stale)
+    logging.info('Published files=%d pruned=%d', len(published), len(stale))
+
+  def __replace_remote_file(self, sftp: paramiko.SFTPClient, source_name: str, target_name: str):
+    source, target = str(self.__sftp_folder / source_name), str(self.__sftp_folder / target_name)
+    try:
+      sftp.posix_rename(source, target)
+    except IOError as e:
+      if self.__pool.is_connection_error(e):
+        raise
+      logging.warning('posix-rename failed, falling back to remove and rename target=%s error=%s', target_name, e)
+      try:
+        sftp.remove(target)
+      except FileNotFoundError:
+        pass
+      sftp.rename(source, target)
+
+
+class BrokerResultCache:
+  """Local on-disk cache of downloaded broker request bundles.
+
+  Each entry is keyed by the broker request ID and stores the bundle together with a
+  manifest of per-node result fingerprints and the scope it was fetched with, i.e.
+  the fetch mode and node whitelist. A cached bundle is reused as long as the
+  fingerprints reported by the broker and the scope did not change. Entries are evicted by age and
+  least-recent use once the cache exceeds its size limit. Single node results can be
+  cached next to the bundle, so only changed nodes have to be fetched again.
+  """
+
+  __manifest_name = 'manifest.json'
+  __bundle_name = 'bundle.zip'
+
+  def __init__(self, cache_dir: Path = None):
+    self.__cache_dir = Path(cache_dir or os.environ['CACHE.DIR']).resolve()
+    self.__max_size = int(float(os.environ.get('CACHE.MAX_SIZE_MB', 1024)) * 1024 * 1024)
+    self.__max_age = float(os.environ.get('CACHE.MAX_AGE_DAYS', 60)) * 86400
+    self.__cache_dir.mkdir(parents=True, exist_ok=True)
+
+  def lookup(self, id_request: str, fingerprints: dict, scope: dict = None) -> Path:
+    manifest = self.__load_manifest(id_request)
+    bundle_path = self.__cache_dir / id_request / self.__bundle_name
+    if manifest is None or manifest.get('nodes') != fingerprints or manifest.get('scope') != scope or not bundle_path.exists():
+      logging.info("Broker result cache miss request_id=%s", id_request)
+      return None
+    logging.info("Broker result cache hit request_id=%s nodes=%d", id_request, len(fingerprints))
+    os.utime(self.__cache_dir / id_request / self.__manifest_name)
+    return bundle_path
+
+  def changed_nodes(self, id_request: str, fingerprints: dict) -> set:
+    manifest = self.__load_manifest(id_request) or {}
+    cached = manifest.get('nodes', {})
+    return {node for node, fingerprint in fingerprints.items() if cached.get(node) != fingerprint}
+
+  def store(self, id_request: str, fingerprints: dict, bundle_path: Path, scope: dict = None) -> Path:
+    entry_dir = self.__cache_dir / id_request
+    entry_dir.mkdir(exist_ok=True)
+    cached_bundle_path = entry_dir / self.__bundle_name
+    self.link_or_copy(bundle_path, cached_bundle_path)
+    manifest = {'request_id': id_request, 'nodes': fingerprints, 'scope': scope, 'created': time.time()}
+    manifest_path = entry_dir / self.__manifest_name
+    manifest_path.with_suffix('.tmp').write_text(json.dumps(manifest), encoding='utf-8')
+    os.replace(manifest_path.with_suffix('.tmp'), manifest_path)
+    logging.info("Stored broker result in cache request_id=%s path=%s", id_request, cached_bundle_path)
+    self.evict()
+    return cached_bundle_path
+
+  def lookup_node_result(self, id_request: str, node: str) -> Path:
+    node_result_path = self.__cache_dir / id_request / 'nodes' / f'{node}_result.zip'
+    return node_result_path if node_result_path.exists() else None
+
+  def store_node_result(self, id_request: str, node: str, node_result_path: Path) -> Path:
+    nodes_dir = self.__cache_dir / id_request / 'nodes'
+    nodes_dir.mkdir(parents=True, exist_ok=True)
+    cached_node_result_path = nodes_dir / f'{node}_result.zip'
+    self.link_or_copy(node_result_path, cached_node_result_path)
+    return cached_node_result_path
+
+  def evict(self):
+    now = time.time()
+    entries = []
+    for manifest_path in self.__cache_dir.glob(f'*/{self.__manifest_name}'):
+      entry_dir = manifest_path.parent
+      last_used = manifest_path.stat().st_mtime
+      if now - last_used > self.__max_age:
+        logging.info("Evicting expired broker result cache entry path=%s", entry_dir)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        continue
+      size = sum(f.stat().st_size for f in entry_dir.rglob('*') if f.is_file())
+      entries.append((last_used, size, entry_dir))
+    total_size = sum(size for _, size, _ in entries)
+    for last_used, size, entry_dir in sorted(entries):
+      if total_size <= self.__max_size:
+        break
+      logging.info("Evicting broker result cache entry to free space path=%s bytes=%d", entry_dir, size)
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      total_size -= size
+
+  @staticmethod
+  def link_or_copy(source: Path, target: Path):
+    target.unlink(missing_ok=True)
+    try:
+      os.link(source, target)
+    except OSError:
+      shutil.copy2(source, target)
+
+  def __load_manifest(self, id_request: str) -> dict:
+    manifest_path = self.__cache_dir / id_request / self.__manifest_name
+    if not manifest_path.exists():
+      return None
+    try:
+      return json.loads(manifest_path.read_text(encoding='utf-8'))
+    except ValueError:
+      logging.warning("Ignoring unreadable broker result cache manifest path=%s", manifest_path)
+      return None
+
 
 class BrokerRequestResultManager:
   """Manages interactions with AKTIN Broker API. The AKTIN Broker is the data source from where our data is being imported.
 
   Handles downloading and processing of hospital data from the AKTIN Broker.
-  Uses environment variables for connection settings.
+  Uses environment variables for connection settings. Downloads are written to a
+  .part file with a JSON sidecar (export uuid, validator, size, checksum), so an
+  interrupted transfer is resumed via HTTP Range requests instead of restarted.
+  All calls share one keep-alive session; idempotent calls (HEAD/GET) are retried
+  with exponential backoff. With BROKER.FETCH_MODE = "nodes" the results of the
+  whitelisted clinics are fetched concurrently from the aggregator endpoints and
+  staged as a bundle, instead of exporting the whole request bundle.
+  The availability of the broker is checked on creation, unless it is created
+  with lazy=True and check_availability() is called later, e.g. concurrently
+  with other pipeline stages.
   """
 
-  __timeout = 10
+  __chunk_size = 64 * 1024
+  __download_attempts = 3
+  __download_backoff = 1.0
+  __retry_status_codes = (429, 500, 502, 503, 504)
+  __export_pending_status_codes = (202, 409, 425)
+  __export_poll_max_interval = 30.0
 
-  def __init__(self):
+  def __init__(self, metrics: PipelineMetrics = None, lazy: bool = False):
+    self.__metrics = metrics or PipelineMetrics()
     self.__broker_url = os.environ['BROKER.URL']
     self.__admin_api_key = os.environ['BROKER.API_KEY']
     self.__requests_tag = os.environ['REQUESTS.TAG']
-    self.__check_broker_server_availability()
+    connect_timeout = float(os.environ.get('BROKER.CONNECT_TIMEOUT', 10))
+    read_timeout = float(os.environ.get('BROKER.READ_TIMEOUT', 10))
+    download_timeout = float(os.environ.get('BROKER.DOWNLOAD_TIMEOUT', 60))
+    self.__timeouts = {
+      'status': (connect_timeout, read_timeout),
+      'request': (connect_timeout, read_timeout),
+      'export': (connect_timeout, download_timeout),
+      'download': (connect_timeout, download_timeout)
+    }
+    self.__export_poll_interval = float(os.environ.get('BROKER.EXPORT_INTERVAL', 1))
+    self.__export_deadline = float(os.environ.get('BROKER.EXPORT_DEADLINE', 900))
+    self.__export_not_found_grace = float(os.environ.get('BROKER.EXPORT_404_GRACE', 30))
+    self.__fetch_mode = os.environ.get('BROKER.FETCH_MODE', 'bundle')
+    if self.__fetch_mode not in ('bundle', 'nodes'):
+      raise SystemExit(f'Invalid broker fetch mode: {self.__fetch_mode}')
+    self.__max_workers = int(os.environ.get('BROKER.MAX_WORKERS', 8))
+    clinic_nums = os.environ.get('RSCRIPT.CLINIC_NUMS')
+    self.__clinic_nums = {int(n) for n in clinic_nums.split(',')} if clinic_nums else None
+    whitelist = sorted(self.__clinic_nums) if self.__fetch_mode == 'nodes' and self.__clinic_nums is not None else None
+    self.__cache_scope = {'fetch_mode': self.__fetch_mode, 'clinic_nums': whitelist}
+    self.__session = self.__create_session()
+    self.__cache = BrokerResultCache() if os.environ.get('CACHE.DIR') else None
+    if not lazy:
+      with self.__metrics.stage('broker_availability'):
+        self.check_availability()
 
-  def __check_broker_server_availability(self):
+  def __create_session(self) -> requests.Session:
+    retries = int(os.environ.get('BROKER.RETRIES', 3))
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=float(os.environ.get('BROKER.BACKOFF_FACTOR', 0.5)),
+        status_forcelist=self.__retry_status_codes,
+        allowed_methods=frozenset({'HEAD', 'GET'}),
+        raise_on_status=False
+    )
+    pool_size = max(int(os.environ.get('BROKER.POOL_SIZE', 4)), self.__max_workers)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+  def __del__(self):
+    try:
+      self.__session.close()
+    except AttributeError:
+      pass
+
+  def check_availability(self):
     url = self.__append_to_broker_url('broker', 'status')
     try:
-      response = requests.head(url, timeout=self.__timeout)
+      response = self.__session.head(url, timeout=self.__timeouts['status'])
       response.raise_for_status()
       logging.info("Broker server is reachable")
     except requests.exceptions.Timeout:
@@ -201,103 +869,1097 @@ class BrokerRequestResultManager:
     }
 
   def download_latest_broker_result_by_set_tag(self, zip_target_path: Path = None, requests_tag: str = None) -> Path:
-    id_request = str(self.__get_id_of_latest_request_by_set_tag(requests_tag))
-    uuid = self.__export_request_result(id_request)
-    result_stream = self.__download_exported_result(uuid)
-    zip_file_path = self.__store_broker_response_as_zip(result_stream, id_request, zip_target_path)
+    with self.__metrics.stage('broker_request_lookup'):
+      id_request = str(self.__get_id_of_latest_request_by_set_tag(requests_tag))
+    target_path = Path(zip_target_path or Path(__file__).resolve().parent)
+    zip_file_path = target_path / f'result{id_request}.zip'
+    fingerprints = None
+    if self.__cache:
+      with self.__metrics.stage('broker_cache_lookup'):
+        fingerprints = self.__get_result_fingerprints(id_request)
+        cached_bundle_path = self.__cache.lookup(id_request, fingerprints, self.__cache_scope)
+        if cached_bundle_path:
+          BrokerResultCache.link_or_copy(cached_bundle_path, zip_file_path)
+          return zip_file_path
+    if self.__fetch_mode == 'nodes':
+      with self.__metrics.stage('broker_download') as stage:
+        zip_file_path = self.__download_node_results(id_request, zip_file_path, fingerprints)
+        stage['bytes'] = zip_file_path.stat().st_size
+    else:
+      with self.__metrics.stage('broker_export'):
+        uuid = self.__export_request_result(id_request)
+        self.__wait_for_export_to_be_ready(uuid)
+      with self.__metrics.stage('broker_download') as stage:
+        zip_file_path = self.__download_exported_result(uuid, zip_file_path)
+        stage['bytes'] = zip_file_path.stat().st_size
+    if self.__cache:
+      self.__cache.store(id_request, fingerprints, zip_file_path, self.__cache_scope)
     return zip_file_path
 
+  def get_latest_request_ids(self, count: int, requests_tag: str = None) -> list[int]:
+    return heapq.nlargest(count, self.__iterate_request_ids_by_set_tag(requests_tag))
+
   def __get_id_of_latest_request_by_set_tag(self, requests_tag: str = None) -> int:
+    count = 0
+    max_id = None
+    for id_request in self.__iterate_request_ids_by_set_tag(requests_tag):
+      count += 1
+      if max_id is None or id_request > max_id:
+        max_id = id_request
+    if max_id is None:
+      logging.warning("No requests found")
+      sys.exit(0)
+    logging.info("Found requests count=%d max_id=%d", count, max_id)
+    return max_id
+
+  def __iterate_request_ids_by_set_tag(self, requests_tag: str = None):
     requests_tag = requests_tag or self.__requests_tag
     logging.info("Fetching requests with tag=%s", requests_tag)
     url = self.__append_to_broker_url('broker', 'request', 'filtered')
     url = '?'.join([url, urllib.parse.urlencode({'type': 'application/vnd.aktin.query.request+xml', 'predicate': f"//tag='{requests_tag}'"})])
-    response = requests.get(url, headers=self.__create_basic_header(), timeout=self.__timeout)
+    response = self.__session.get(url, headers=self.__create_basic_header(), timeout=self.__timeouts['request'], stream=True)
     response.raise_for_status()
-    list_request_id = [int(element.get('id')) for element in et.fromstring(response.content)]
-    if not list_request_id:
-      logging.warning("No requests found")
-      sys.exit(0)
-    max_id = max(list_request_id)
-    logging.info("Found requests count=%d max_id=%d", len(list_request_id), max_id)
-    return max_id
+    with response:
+      response.raw.decode_content = True
+      root = None
+      depth = 0
+      for event, element in et.iterparse(response.raw, events=('start', 'end')):
+        if event == 'start':
+          root = root if root is not None else element
+          depth += 1
+          continue
+        depth -= 1
+        if depth == 1:
+          id_request = element.get('id')
+          root.clear()
+          if id_request is not None:
+            yield int(id_request)
+
+  def __get_result_fingerprints(self, id_request: str) -> dict:
+    url = self.__append_to_broker_url('broker', 'request', id_request, 'status')
+    response = self.__session.get(url, headers=self.__create_basic_header(), timeout=self.__timeouts['request'])
+    response.raise_for_status()
+    fingerprints = {}
+    for element in et.fromstring(response.content):
+      node = element.findtext('{*}node') or element.get('node')
+      if node is None:
+        continue
+      status = ';'.join(f'{child.tag.rpartition("}")[2]}={(child.text or "").strip()}' for child in sorted(element, key=lambda c: c.tag))
+      fingerprints[node.strip()] = hashlib.sha256(status.encode('utf-8')).hexdigest()
+    return fingerprints
+
+  def __list_result_nodes(self, id_request: str) -> list[str]:
+    url = self.__append_to_broker_url('aggregator', 'request', id_request, 'result')
+    response = self.__session.get(url, headers=self.__create_basic_header(), timeout=self.__timeouts['request'])
+    response.raise_for_status()
+    nodes = []
+    for element in et.fromstring(response.content):
+      node = element.findtext('{*}node-id') or element.findtext('{*}node')
+      if node is not None:
+        nodes.append(node.strip())
+    return nodes
+
+  def __download_node_results(self, id_request: str, zip_file_path: Path, fingerprints: dict = None) -> Path:
+    nodes = self.__list_result_nodes(id_request)
+    if self.__clinic_nums is not None:
+      skipped = [node for node in nodes if int(node) not in self.__clinic_nums]
+      nodes = [node for node in nodes if int(node) in self.__clinic_nums]
+      logging.info("Skipping results of non-whitelisted nodes=%s", ','.join(skipped) or '-')
+    changed_nodes = self.__cache.changed_nodes(id_request, fingerprints) if self.__cache else set(nodes)
+    logging.info("Fetching node results request_id=%s nodes=%d changed=%d workers=%d", id_request, len(nodes),
+                 len(changed_nodes.intersection(nodes)), self.__max_workers)
+    staging_dir = zip_file_path.with_name(zip_file_path.stem + '_nodes')
+    staging_dir.mkdir(exist_ok=True)
+    part_file_path = zip_file_path.with_name(zip_file_path.name + '.part')
+    try:
+      with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+        futures = [executor.submit(self.__fetch_node_result, id_request, node, staging_dir, node not in changed_nodes) for node in nodes]
+        node_result_paths = [future.result() for future in futures]
+      with zipfile.ZipFile(part_file_path, 'w', zipfile.ZIP_STORED) as zf:
+        for node_result_path in node_result_paths:
+          zf.write(node_result_path, node_result_path.name)
+      os.replace(part_file_path, zip_file_path)
+    finally:
+      part_file_path.unlink(missing_ok=True)
+      shutil.rmtree(staging_dir, ignore_errors=True)
+    return zip_file_path
+
+  def __fetch_node_result(self, id_request: str, node: str, staging_dir: Path, unchanged: bool) -> Path:
+    node_result_path = staging_dir / f'{node}_result.zip'
+    cached_node_result_path = self.__cache.lookup_node_result(id_request, node) if self.__cache and unchanged else None
+    if cached_node_result_path:
+      BrokerResultCache.link_or_copy(cached_node_result_path, node_result_path)
+      return node_result_path
+    url = self.__append_to_broker_url('aggregator', 'request', id_request, 'result', node)
+    response = self.__session.get(url, headers=self.__create_basic_header('*/*'), timeout=self.__timeouts['download'], stream=True)
+    response.raise_for_status()
+    self.__store_response_chunks(response, node_result_path)
+    if self.__cache:
+      self.__cache.store_node_result(id_request, node, node_result_path)
+    return node_result_path
 
   def __export_request_result(self, id_request: str) -> str:
     logging.info("Exporting broker results request_id=%s", id_request)
     url = self.__append_to_broker_url('broker', 'export', 'request-bundle', id_request)
-    response = requests.post(url, headers=self.__create_basic_header('text/plain'), timeout=self.__timeout)
+    response = self.__session.post(url, headers=self.__create_basic_header('text/plain'), timeout=self.__timeouts['export'])
     response.raise_for_status()
     return response.text
 
-  def __download_exported_result(self, uuid: str) -> Response:
-    logging.info("Downloading broker results uuid=%s", uuid)
+  def __wait_for_export_to_be_ready(self, uuid: str):
     url = self.__append_to_broker_url('broker', 'download', uuid)
-    response = requests.get(url, headers=self.__create_basic_header(), timeout=self.__timeout)
-    response.raise_for_status()
-    return response
+    start = time.monotonic()
+    interval = self.__export_poll_interval
+    polls = 0
+    registered = False
+    while True:
+      polls += 1
+      response = self.__session.head(url, headers=self.__create_basic_header('application/zip'), timeout=self.__timeouts['status'])
+      elapsed = time.monotonic() - start
+      # a new export may not be registered yet, an unknown or expired uuid stays 404
+      if response.status_code == 404 and (registered or elapsed >= self.__export_not_found_grace):
+        raise RuntimeError(f"Broker export {uuid} was not found after {polls} polls and {elapsed:.1f}s")
+      registered = registered or response.status_code != 404
+      if response.status_code not in self.__export_pending_status_codes + (404,):
+        response.raise_for_status()
+        logging.info("Broker export is ready uuid=%s polls=%d seconds=%.1f size=%s", uuid, polls, elapsed, response.headers.get('Content-Length', 'unknown'))
+        return
+      remaining = self.__export_deadline - elapsed
+      if remaining <= 0:
+        raise RuntimeError(f"Broker export {uuid} was not ready after {elapsed:.0f}s")
+      wait = min(interval, remaining)
+      logging.info("Waiting for broker export uuid=%s status=%d polls=%d seconds=%.1f next_poll_in=%.1f", uuid, response.status_code, polls, elapsed, wait)
+      time.sleep(wait)
+      interval = min(interval * 1.5, self.__export_poll_max_interval)
 
-  def __store_broker_response_as_zip(self, response: Response, id_request: str, target_path: Path = None) -> Path:
-    target_path = target_path or Path(__file__).resolve().parent
-    zip_file_path = target_path / f'result{id_request}.zip'
-    logging.info("Writing broker results to file path=%s", zip_file_path)
-    with zip_file_path.open('wb') as zip_file:
-      zip_file.write(response.content)
+  def __download_exported_result(self, uuid: str, zip_file_path: Path) -> Path:
+    logging.info("Downloading broker results uuid=%s path=%s", uuid, zip_file_path)
+    url = self.__append_to_broker_url('broker', 'download', uuid)
+    part_file_path = zip_file_path.with_name(zip_file_path.name + '.part')
+    sidecar_path = zip_file_path.with_name(zip_file_path.name + '.part.json')
+    for attempt in range(1, self.__download_attempts + 1):
+      state = self.__load_partial_download_state(sidecar_path, part_file_path, uuid)
+      offset = part_file_path.stat().st_size if state else 0
+      headers = self.__create_basic_header('application/zip')
+      if offset:
+        headers['Range'] = f'bytes={offset}-'
+        if state.get('validator'):
+          headers['If-Range'] = state['validator']
+      try:
+        response = self.__session.get(url, headers=headers, timeout=self.__timeouts['download'], stream=True)
+        if offset and (response.status_code == 416 or response.status_code == 206 and self.__parse_content_range_start(response) != offset):
+          logging.warning("Broker did not resume partial download offset=%d status=%d content_range=%s, restarting from zero", offset,
+                          response.status_code, response.headers.get('Content-Range'))
+          response.close()
+          self.__discard_partial_download(part_file_path, sidecar_path)
+          offset = 0
+          response = self.__session.get(url, headers=self.__create_basic_header('application/zip'), timeout=self.__timeouts['download'], stream=True)
+        response.raise_for_status()
+        if response.status_code != 206:
+          offset = 0
+          state = self.__create_partial_download_state(response, uuid)
+          sidecar_path.write_text(json.dumps(state), encoding='utf-8')
+        elif offset:
+          logging.info("Resuming broker download offset=%d", offset)
+        self.__store_response_chunks(response, part_file_path, append=offset > 0)
+        break
+      except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as err:
+        if attempt == self.__download_attempts:
+          raise
+        wait = self.__download_backoff * 2 ** (attempt - 1)
+        logging.warning("Broker download interrupted attempt=%d error=%s, resuming in %.1fs", attempt, err, wait)
+        time.sleep(wait)
+    self.__verify_downloaded_zip(part_file_path, state)
+    os.replace(part_file_path, zip_file_path)
+    sidecar_path.unlink(missing_ok=True)
     return zip_file_path
 
+  def __load_partial_download_state(self, sidecar_path: Path, part_file_path: Path, uuid: str) -> dict:
+    if not sidecar_path.exists() or not part_file_path.exists():
+      return {}
+    try:
+      state = json.loads(sidecar_path.read_text(encoding='utf-8'))
+    except ValueError:
+      return {}
+    if state.get('uuid') != uuid:
+      return {}
+    return state
+
+  def __parse_content_range_start(self, response: Response) -> int:
+    match = re.fullmatch(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('Content-Range', '').strip())
+    return int(match.group(1)) if match else None
+
+  def __create_partial_download_state(self, response: Response, uuid: str) -> dict:
+    length = response.headers.get('Content-Length')
+    return {
+      'uuid': uuid,
+      'validator': response.headers.get('ETag') or response.headers.get('Last-Modified'),
+      'length': int(length) if length else None,
+      'digest': self.__parse_digest_header(response.headers)
+    }
+
+  def __parse_digest_header(self, headers) -> list:
+    if 'Digest' in headers:
+      for entry in headers['Digest'].split(','):
+        algorithm, _, value = entry.strip().partition('=')
+        algorithm = algorithm.lower().replace('-', '')
+        if algorithm in ('sha256', 'sha512', 'md5'):
+          return [algorithm, base64.b64decode(value).hex()]
+    if 'Content-MD5' in headers:
+      return ['md5', base64.b64decode(headers['Content-MD5']).hex()]
+    return None
+
+  def __discard_partial_download(self, part_file_path: Path, sidecar_path: Path):
+    part_file_path.unlink(missing_ok=True)
+    sidecar_path.unlink(missing_ok=True)
+
+  def __store_response_chunks(self, response: Response, part_file_path: Path, append: bool = False):
+    start = time.monotonic()
+    written = 0
+    with response, part_file_path.open('ab' if append else 'wb') as part_file:
+      for chunk in response.iter_content(chunk_size=self.__chunk_size):
+        part_file.write(chunk)
+        written += len(chunk)
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logging.info("Downloaded broker results path=%s bytes=%d seconds=%.2f bytes_per_second=%.0f", part_file_path.name, written, elapsed,
+                 written / elapsed)
+
+  def __verify_downloaded_zip(self, part_file_path: Path, state: dict):
+    try:
+      size = part_file_path.stat().st_size
+      if state.get('length') is not None and size != state['length']:
+        raise RuntimeError(f"Broker download is incomplete: expected {state['length']} bytes, got {size}")
+      if state.get('digest'):
+        algorithm, expected = state['digest']
+        digest = hashlib.new(algorithm)
+        with part_file_path.open('rb') as part_file:
+          for chunk in iter(lambda: part_file.read(self.__chunk_size), b''):
+            digest.update(chunk)
+        if digest.hexdigest() != expected:
+          raise RuntimeError(f"Broker download failed {algorithm} checksum verification")
+      with zipfile.ZipFile(part_file_path) as zf:
+        zf.infolist()
+    except (OSError, RuntimeError, zipfile.BadZipFile) as err:
+      self.__discard_partial_download(part_file_path, part_file_path.with_name(part_file_path.name + '.json'))
+      raise RuntimeError(f"Downloaded broker result is corrupt: {err}") from err
+
+
+class BrokerResultReader:
+  """Reads the case data of whitelisted clinics straight out of a broker bundle.
+
+  The bundle contains one <n>_result.zip per clinic, each with a case_data.txt.
+  Both archive levels are opened in memory, so no file is extracted to disk.
+  """
+
+  __case_data_name = 'case_data.txt'
+  __timestamp_columns = ('aufnahme_ts', 'entlassung_ts', 'triage_ts')
+
+  def __init__(self, clinic_nums: list[int]):
+    self.__clinic_nums = clinic_nums
+
+  def list_clinics(self, zip_file_path: Path) -> list[int]:
+    with zipfile.ZipFile(zip_file_path) as bundle:
+      names = set(bundle.namelist())
+    clinics = []
+    for clinic in self.__clinic_nums:
+      if f'{clinic}_result.zip' in names:
+        clinics.append(clinic)
+      else:
+        logging.info("No result found for clinic=%d", clinic)
+    return clinics
+
+  @classmethod
+  def read_case_data(cls, zip_file_path: Path, clinic: int) -> bytes:
+    with zipfile.ZipFile(zip_file_path) as bundle:
+      with zipfile.ZipFile(io.BytesIO(bundle.read(f'{clinic}_result.zip'))) as clinic_zip:
+        if cls.__case_data_name not in clinic_zip.namelist():
+          logging.info("No %s found for clinic=%d", cls.__case_data_name, clinic)
+          return None
+        return clinic_zip.read(cls.__case_data_name)
+
+  def iterate_case_data(self, zip_file_path: Path):
+    with zipfile.ZipFile(zip_file_path) as bundle:
+      names = set(bundle.namelist())
+      for clinic in self.__clinic_nums:
+        name = f'{clinic}_result.zip'
+        if name not in names:
+          logging.info("No result found for clinic=%d", clinic)
+          continue
+        with zipfile.ZipFile(io.BytesIO(bundle.read(name))) as clinic_zip:
+          if self.__case_data_name not in clinic_zip.namelist():
+            logging.info("No %s found for clinic=%d", self.__case_data_name, clinic)
+            continue
+          with clinic_zip.open(self.__case_data_name) as case_data:
+            yield clinic, case_data
+
+  def iterate_timestamp_rows(self, zip_file_path: Path):
+    for clinic, case_data in self.iterate_case_data(zip_file_path):
+      lines = io.TextIOWrapper(case_data, encoding='utf-8', errors='replace', newline='')
+      rows = csv.reader(lines, delimiter='\t', quoting=csv.QUOTE_NONE)
+      header = [column.strip() for column in next(rows, [])]
+      if 'entlassung_ts' not in header:
+        logging.warning("Clinic %d has no discharge column matching the configured naming", clinic)
+        continue
+      indices = [header.index(column) if column in header else None for column in self.__timestamp_columns]
+      for row in rows:
+        yield [str(clinic)] + [row[i].strip() if i is not None and i < len(row) else '' for i in indices]
+
+
+class RWorker:
+  """Long-lived R process that runs LOSCalculator.R jobs without loading its libraries again.
+
+  Started with "--worker", the R script loads its libraries once, prints
+  "worker_ready" and then reads one job per line from stdin, i.e. the tab-separated
+  arguments of a single run. The output of a job ends with "job_end:ok" or
+  "job_end:error:<message>", its result table is written as a line of JSON to
+  a pipe inherited as LOS_RESULT_FD for the lifetime of the worker. The worker is started on the first job or by start(),
+  started again for the next job if it exited during a job, and stopped after a
+  job if its resident memory exceeds max_rss_mb (Linux only), so the next job
+  gets a fresh process. A job that does not end within job_timeout seconds kills
+  the worker, the next job starts a new one.
+  """
+
+  __ready_marker = 'worker_ready'
+  __job_end_marker = 'job_end:'
+  __ready_timeout = 300
+  __result_timeout = 30
+  __stop_timeout = 10
+  __stderr_lines = 200
+
+  def __init__(self, script_path: Path, env: dict = None, max_rss_mb: float = 2048, job_timeout: float = None):
+    self.__script_path = Path(script_path).resolve()
+    self.__env = env
+    self.__max_rss_bytes = max_rss_mb * 1024 * 1024
+    self.__job_timeout = job_timeout
+    self.__process = None
+    self.__lines = None
+    self.__stderr = collections.deque(maxlen=self.__stderr_lines)
+    self.__jobs = 0
+
+  @property
+  def is_running(self) -> bool:
+    return self.__process is not None and self.__process.poll() is None
+
+  @property
+  def pid(self) -> int:
+    return self.__process.pid if self.is_running else None
+
+  def start(self):
+    if self.is_running:
+      return
+    cmd = ['Rscript', self.__script_path.as_posix(), '--worker']
+    logging.info("Starting R worker command='%s'", ' '.join(cmd))
+    start = time.perf_counter()
+    read_fd, write_fd = os.pipe()
+    env = dict(self.__env or os.environ, LOS_RESULT_FD=str(write_fd))
+    try:
+      self.__process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1, env=env,
+                                        pass_fds=(write_fd,))
+    except BaseException:
+      os.close(read_fd)
+      raise
+    finally:
+      os.close(write_fd)
+    self.__lines = queue.Queue()
+    self.__results = queue.Queue()
+    self.__stderr.clear()
+    self.__jobs = 0
+    threading.Thread(target=self.__read_lines, args=(self.__process.stdout, self.__lines), daemon=True).start()
+    threading.Thread(target=self.__read_lines, args=(open(read_fd, 'r', encoding='utf-8'), self.__results), daemon=True).start()
+    threading.Thread(target=self.__stderr.extend, args=(self.__process.stderr,), daemon=True).start()
+    _, marker = self.__read_until(self.__ready_marker, self.__ready_timeout)
+    if marker is None:
+      stderr = ''.join(self.__stderr)
+      self.stop()
+      raise RuntimeError(f"R worker failed to start: {stderr}")
+    logging.info("R worker ready pid=%d duration=%.3fs", self.__process.pid, time.perf_counter() - start)
+
+  def run(self, args: list[str]) -> tuple[str, str]:
+    self.start()
+    self.__stderr.clear()
+    while not self.__results.empty():
+      self.__results.get_nowait()
+    try:
+      self.__process.stdin.write('\t'.join(args) + '\n')
+      self.__process.stdin.flush()
+    except BrokenPipeError:
+      pass
+    deadline = None if self.__job_timeout is None else time.monotonic() + self.__job_timeout
+    output, marker = self.__read_until(self.__job_end_marker, self.__job_timeout)
+    if marker is None and deadline is not None and time.monotonic() >= deadline:
+      logging.warning("Killing R worker after job timeout pid=%d timeout=%.0fs", self.__process.pid, self.__job_timeout)
+      self.__kill()
+      raise RuntimeError(f"R worker job timed out after {self.__job_timeout:.0f}s")
+    if marker is None:
+      returncode = self.__process.wait()
+      stderr = ''.join(self.__stderr)
+      self.stop()
+      raise RuntimeError(f"R worker exited during job with returncode={returncode}: {stderr}")
+    self.__jobs += 1
+    succeeded = marker == f'{self.__job_end_marker}ok'
+    result = None
+    if succeeded:
+      try:
+        result = self.__results.get(timeout=self.__result_timeout)
+      except queue.Empty:
+        pass
+    self.__stop_if_grown()
+    if not succeeded:
+      raise RuntimeError(f"R script failed: {marker[len(self.__job_end_marker):]} {''.join(self.__stderr)}")
+    if result is None:
+      raise RuntimeError("R worker returned no result")
+    return output, result
+
+  def stop(self):
+    if self.__process is None:
+      return
+    process, self.__process = self.__process, None
+    try:
+      process.stdin.close()
+    except BrokenPipeError:
+      pass
+    try:
+      process.wait(self.__stop_timeout)
+    except subprocess.TimeoutExpired:
+      logging.warning("Killing R worker pid=%d", process.pid)
+      process.kill()
+      process.wait()
+    logging.info("R worker stopped pid=%d jobs=%d", process.pid, self.__jobs)
+
+  def __kill(self):
+    process, self.__process = self.__process, None
+    process.kill()
+    process.wait()
+
+  def __read_lines(self, stream, lines: queue.Queue):
+    for line in stream:
+      lines.put(line)
+    lines.put(None)
+
+  def __read_until(self, marker: str, timeout: float = None) -> tuple[str, str]:
+    output = []
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      try:
+        line = self.__lines.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+      except queue.Empty:
+        return ''.join(output), None
+      if line is None:
+        return ''.join(output), None
+      if line.startswith(marker):
+        return ''.join(output), line.strip()
+      output.append(line)
+
+  def __stop_if_grown(self):
+    rss = self.__read_rss_bytes()
+    if rss is not None and rss > self.__max_rss_bytes:
+      logging.info("Restarting R worker after memory growth pid=%d rss=%d jobs=%d", self.__process.pid, rss, self.__jobs)
+      self.stop()
+
+  def __read_rss_bytes(self) -> int:
+    try:
+      with open(f'/proc/{self.__process.pid}/status', encoding='ascii') as f:
+        for line in f:
+          if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+      pass
+    return None
+
 
 class LosScriptManager:
   """Manages R script execution for length of stay calculations.
 
   Handles running the R script with appropriate parameters and processing
-  its output. Uses environment variables for R script settings.
+  its output. Uses environment variables for R script settings. The result
+  table is passed back as a line of JSON on a dedicated pipe, inherited by the
+  R script as LOS_RESULT_FD, instead of a timeframe.csv found in its output. With
+  RSCRIPT.INPUT_MODE = "stream" the case data is streamed from the nested
+  archives to the stdin of the R script instead of being extracted by it.
+  With RSCRIPT.PROFILE enabled, the R script prints timing and row count
+  markers for its processing steps, which are added to the pipeline metrics.
+  With RSCRIPT.WORKER enabled, the calculations are dispatched to a long-lived
+  RWorker instead of starting Rscript for every run; streamed case data is then
+  passed through a named pipe. Calculations taking longer than
+  RSCRIPT.JOB_TIMEOUT seconds are killed and fail the run.
   """
 
-  def __init__(self):
+  def __init__(self, metrics: PipelineMetrics = None):
+    self.__metrics = metrics or PipelineMetrics()
     self.__los_script_path = Path(os.environ['RSCRIPT.LOS_SCRIPT_PATH']).resolve()
     self.__los_max = os.environ['RSCRIPT.LOS_MAX']
     self.__error_max = os.environ['RSCRIPT.ERROR_MAX']
     self.__clinic_nums = os.environ['RSCRIPT.CLINIC_NUMS']
+    self.__input_mode = os.environ.get('RSCRIPT.INPUT_MODE', 'extract')
+    if self.__input_mode not in ('extract', 'stream'):
+      raise SystemExit(f'Invalid R script input mode: {self.__input_mode}')
+    self.__workers = os.environ.get('RSCRIPT.WORKERS', '1')
+    self.__profile = os.environ.get('RSCRIPT.PROFILE', 'false').lower() in ('true', '1', 'yes')
+    self.__env = dict(os.environ, LOS_PROFILE='1') if self.__profile else None
+    self.__job_timeout = float(os.environ.get('RSCRIPT.JOB_TIMEOUT', 3600))
+    self.__worker = None
+    if os.environ.get('RSCRIPT.WORKER', 'false').lower() in ('true', '1', 'yes'):
+      self.__worker = RWorker(self.__los_script_path, self.__env, float(os.environ.get('RSCRIPT.WORKER_MAX_RSS_MB', 2048)), self.__job_timeout)
+
+  def prepare(self):
+    if self.__worker:
+      self.__worker.start()
 
-  def execute_rscript(self, zip_file_path: Path, start_year: str, start_cw: str, end_year: str, end_cw: str) -> Path:
+  def close(self):
+    if self.__worker:
+      self.__worker.stop()
+
+  def calculate_timeframe(self, zip_file_path: Path, start_year: str, start_cw: str, end_year: str, end_cw: str) -> pd.DataFrame:
     zip_file_path = Path(zip_file_path).resolve()
-    cmd = ['Rscript', self.__los_script_path.as_posix(), zip_file_path.as_posix(),
-           start_year, start_cw, end_year, end_cw, self.__los_max, self.__error_max, self.__clinic_nums]
-    logging.info("Executing R script command='%s'", ' '.join(cmd))
-    output = subprocess.run(cmd, capture_output=True, text=True)
-    if output.returncode != 0:
-      raise RuntimeError(f"R script failed: {output.stderr}")
+    args = [zip_file_path.as_posix(), start_year, start_cw, end_year, end_cw, self.__los_max, self.__error_max, self.__clinic_nums,
+            self.__input_mode, self.__workers]
+    cmd = ['Rscript', self.__los_script_path.as_posix()] + args
+    logging.info("Executing R script command='%s'%s", ' '.join(cmd), ' in worker' if self.__worker else '')
+    with self.__metrics.stage('rscript') as stage:
+      if self.__worker:
+        stdout, result, rows = self.__run_in_worker(args, zip_file_path)
+      else:
+        stdout, result, rows = self.__run_process(cmd, zip_file_path)
+      if rows is not None:
+        stage['rows'] = rows
+      if self.__profile:
+        self.__record_profile_markers(stdout)
     logging.info("R script execution completed successfully")
-    return self.__extract_result_path(output.stdout)
+    return self.__parse_result(result)
+
+  def __run_process(self, cmd: list, zip_file_path: Path) -> tuple[str, str, int]:
+    read_fd, write_fd = os.pipe()
+    env = dict(self.__env or os.environ, LOS_RESULT_FD=str(write_fd))
+    stdin = subprocess.PIPE if self.__input_mode == 'stream' else None
+    try:
+      process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env, pass_fds=(write_fd,))
+    except BaseException:
+      os.close(read_fd)
+      raise
+    finally:
+      os.close(write_fd)
+    timed_out = threading.Event()
+    timer = threading.Timer(self.__job_timeout, lambda: (timed_out.set(), process.kill()))
+    timer.start()
+    with process, open(read_fd, 'r', encoding='utf-8') as result_pipe, ThreadPoolExecutor(max_workers=3) as executor:
+      stdout = executor.submit(process.stdout.read)
+      stderr = executor.submit(process.stderr.read)
+      result = executor.submit(result_pipe.read)
+      try:
+        rows = self.__write_case_data(process.stdin, zip_file_path) if stdin else None
+        returncode = process.wait()
+      finally:
+        timer.cancel()
+      if timed_out.is_set():
+        raise RuntimeError(f"R script timed out after {self.__job_timeout:.0f}s")
+      if returncode != 0:
+        raise RuntimeError(f"R script failed: {stderr.result()}")
+      return stdout.result(), result.result(), rows
+
+  def __write_case_data(self, stream, zip_file_path: Path) -> int:
+    reader = BrokerResultReader([int(n) for n in self.__clinic_nums.split(',')])
+    rows = 0
+    try:
+      for row in reader.iterate_timestamp_rows(zip_file_path):
+        stream.write('\t'.join(row) + '\n')
+        rows += 1
+    except BrokenPipeError:
+      logging.warning("R script closed its input after rows=%d", rows)
+    finally:
+      try:
+        stream.close()
+      except BrokenPipeError:
+        pass
+    logging.info("Streamed case data to R script rows=%d", rows)
+    return rows
+
+  def __run_in_worker(self, args: list, zip_file_path: Path) -> tuple[str, str, int]:
+    if self.__input_mode != 'stream':
+      return *self.__worker.run(args), None
+    with tempfile.TemporaryDirectory(prefix='los_stream_') as tmp_dir:
+      fifo_path = Path(tmp_dir) / 'case_data.fifo'
+      os.mkfifo(fifo_path)
+      with ThreadPoolExecutor(max_workers=1) as executor:
+        rows = executor.submit(lambda: self.__write_case_data(open(fifo_path, 'w', encoding='utf-8'), zip_file_path))
+        try:
+          output, result = self.__worker.run(args + [fifo_path.as_posix()])
+        finally:
+          while not rows.done():
+            # the job ended without reading the pipe, release the writer blocked in open()
+            os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+            wait([rows], timeout=0.1)
+        return output, result, rows.result()
+
+  def __record_profile_markers(self, output: str):
+    for marker in re.findall(r'^profile:(\{.*\})\s*$', output, re.MULTILINE):
+      try:
+        step = json.loads(marker)
+      except json.JSONDecodeError:
+        logging.warning("Ignoring malformed R profile marker=%s", marker)
+        continue
+      values = {'rows': step['rows']} if step.get('rows') is not None else {}
+      self.__metrics.record(step['step'], float(step['seconds']), **values)
+      logging.info("R step=%s duration=%.3fs rows=%s", step['step'], float(step['seconds']), step.get('rows'))
+
+  def __parse_result(self, result: str) -> pd.DataFrame:
+    lines = (result or '').strip().splitlines()
+    if not lines:
+      raise RuntimeError("R script returned no result")
+    try:
+      return pd.DataFrame(json.loads(lines[-1]))
+    except ValueError as e:
+      raise RuntimeError(f"Malformed result of R script: {e}")
+
+
+class CaseDataCache:
+  """Columnar on-disk cache of parsed clinic case data.
+
+  Stores the parsed, UTC-normalized timestamp columns of a clinic's case_data.txt as
+  uncompressed Arrow IPC file, keyed by the hash of the raw file content. Re-runs,
+  backfills and calculations with different thresholds load the typed columns
+  memory-mapped instead of parsing the text again. Unused entries expire after
+  CACHE.MAX_AGE_DAYS.
+  """
+
+  __format_version = 1
+
+  def __init__(self, cache_dir: Path = None):
+    self.__cache_dir = Path(cache_dir or os.environ['CACHE.CASE_DATA_DIR']).resolve()
+    self.__max_age = float(os.environ.get('CACHE.MAX_AGE_DAYS', 60)) * 86400
+    self.__cache_dir.mkdir(parents=True, exist_ok=True)
+
+  @property
+  def cache_dir(self) -> Path:
+    return self.__cache_dir
+
+  @classmethod
+  def create_key(cls, raw: bytes, clinic: int) -> str:
+    digest = hashlib.sha256(raw)
+    digest.update(f'clinic={clinic};version={cls.__format_version}'.encode('utf-8'))
+    return digest.hexdigest()
+
+  def load(self, key: str) -> pd.DataFrame:
+    path = self.__cache_dir / f'{key}.arrow'
+    if not path.exists():
+      return None
+    os.utime(path)
+    return feather.read_table(str(path), memory_map=True).to_pandas()
+
+  def store(self, key: str, case_data: pd.DataFrame):
+    path = self.__cache_dir / f'{key}.arrow'
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    feather.write_feather(case_data.reset_index(drop=True), str(tmp_path), compression='uncompressed')
+    os.replace(tmp_path, path)
+
+  def evict(self):
+    now = time.time()
+    for path in self.__cache_dir.glob('*.arrow'):
+      if now - path.stat().st_mtime > self.__max_age:
+        logging.info("Evicting expired case data cache entry path=%s", path)
+        path.unlink(missing_ok=True)
 
-  def __extract_result_path(self, output: str) -> Path:
-    match = re.search(r'timeframe_path:(.+?)(?:$|\n)', output)
-    if not match:
-      raise ValueError("Could not find result path in script output")
-    result_path = Path(match.group(1).strip().strip('"')).resolve()
-    return result_path
+
+class LosAggregateStore:
+  """Persistent SQLite store of weekly LOS aggregates per clinic.
+
+  Keeps one row per (ISO year, ISO week, clinic) with the total number of cases,
+  the cases dropped by the LOS plausibility filter and the count and sum of the
+  valid LOS values. Every clinic is stored together with the content hash of the
+  case_data.txt it was aggregated from, so only clinics whose data changed since
+  the last run have to be parsed again. Report windows are calculated from these
+  aggregates instead of the raw rows. The broker delivers the full history of a
+  clinic, so a changed clinic is parsed and replaced as a whole; the saving is
+  limited to unchanged clinics, not to the newly arrived weeks.
+  """
+
+  __schema_version = 2
+  __aggregate_columns = ['clinic', 'calendarweek_year', 'cw', 'total_rows', 'invalid_rows', 'case_count', 'los_sum']
+
+  def __init__(self, store_path: Path = None):
+    self.__store_path = Path(store_path or os.environ['STORE.PATH']).resolve()
+    self.__store_path.parent.mkdir(parents=True, exist_ok=True)
+    self.__create_schema()
+
+  def __connect(self) -> sqlite3.Connection:
+    return sqlite3.connect(self.__store_path, timeout=30)
+
+  def __create_schema(self):
+    with contextlib.closing(self.__connect()) as conn, conn:
+      if conn.execute('PRAGMA user_version').fetchone()[0] != self.__schema_version:
+        logging.info("Creating LOS aggregate store path=%s version=%d", self.__store_path, self.__schema_version)
+        conn.execute('DROP TABLE IF EXISTS weekly_los')
+        conn.execute('DROP TABLE IF EXISTS clinic_source')
+        conn.execute(f'PRAGMA user_version = {self.__schema_version}')
+      conn.execute('CREATE TABLE IF NOT EXISTS clinic_source (clinic INTEGER PRIMARY KEY, content_hash TEXT NOT NULL, updated_at TEXT NOT NULL)')
+      conn.execute('CREATE TABLE IF NOT EXISTS weekly_los (clinic INTEGER NOT NULL, calendarweek_year INTEGER NOT NULL, cw INTEGER NOT NULL, '
+                   'total_rows INTEGER NOT NULL, invalid_rows INTEGER NOT NULL, case_count INTEGER NOT NULL, los_sum REAL NOT NULL, '
+                   'PRIMARY KEY (clinic, calendarweek_year, cw))')
+
+  def content_hashes(self) -> dict[int, str]:
+    with contextlib.closing(self.__connect()) as conn:
+      return dict(conn.execute('SELECT clinic, content_hash FROM clinic_source').fetchall())
+
+  def replace_clinic(self, clinic: int, content_hash: str, aggregates: pd.DataFrame):
+    rows = [] if aggregates is None else aggregates[self.__aggregate_columns].astype(object).where(aggregates.notna(), None).values.tolist()
+    logging.info("Updating LOS aggregate store clinic=%d weeks=%d", clinic, len(rows))
+    with contextlib.closing(self.__connect()) as conn, conn:
+      conn.execute('DELETE FROM weekly_los WHERE clinic = ?', (clinic,))
+      conn.executemany(f'INSERT INTO weekly_los VALUES ({", ".join("?" * len(self.__aggregate_columns))})', rows)
+      conn.execute('INSERT OR REPLACE INTO clinic_source VALUES (?, ?, ?)', (clinic, content_hash, datetime.datetime.now(datetime.timezone.utc).isoformat()))
+
+  def retain_clinics(self, clinics: set[int]):
+    stale = set(self.content_hashes()) - set(clinics)
+    if not stale:
+      return
+    logging.info("Removing clinics missing from broker result from LOS aggregate store clinics=%s", sorted(stale))
+    with contextlib.closing(self.__connect()) as conn, conn:
+      conn.executemany('DELETE FROM weekly_los WHERE clinic = ?', [(clinic,) for clinic in stale])
+      conn.executemany('DELETE FROM clinic_source WHERE clinic = ?', [(clinic,) for clinic in stale])
+
+  def load_aggregates(self) -> pd.DataFrame:
+    with contextlib.closing(self.__connect()) as conn:
+      return pd.read_sql_query(f'SELECT {", ".join(self.__aggregate_columns)} FROM weekly_los', conn)
+
+
+class LosCalculator:
+  """Native Python implementation of the length of stay calculation in LOSCalculator.R.
+
+  Reads the case data of all whitelisted clinics straight from the nested result
+  archives of a broker bundle and reproduces the analysis of the R script with
+  vectorized pandas operations. Returns the result table in memory with the same
+  columns and values as the R script, so both engines are interchangeable. Uses
+  environment variables for the calculation settings.
+  Parsing and enrichment of each clinic are independent and run on a process pool
+  if RSCRIPT.WORKERS is greater than one and the bundle contains enough clinics
+  to outweigh the transfer of the parsed frames. The pool is started by prepare(),
+  kept for the lifetime of the calculator and shut down by close(). Workers are
+  handed the bundle path and clinic number and read the case data themselves.
+  """
+
+  __los_reference = 193.5357
+  __min_parallel_clinics = 4
+  __timestamp_columns = ('aufnahme_ts', 'entlassung_ts', 'triage_ts')
+  __no_data_message = 'Error: No Data found in case_data files!'
+
+  def __init__(self, metrics: PipelineMetrics = None):
+    self.__metrics = metrics or PipelineMetrics()
+    self.__los_max = float(os.environ['RSCRIPT.LOS_MAX'])
+    self.__error_max = float(os.environ['RSCRIPT.ERROR_MAX'])
+    self.__reader = BrokerResultReader([int(n) for n in os.environ['RSCRIPT.CLINIC_NUMS'].split(',')])
+    self.__workers = int(os.environ.get('RSCRIPT.WORKERS', 1))
+    self.__case_data_cache = CaseDataCache() if os.environ.get('CACHE.CASE_DATA_DIR') else None
+    self.__aggregate_store = LosAggregateStore() if os.environ.get('STORE.PATH') else None
+    self.__executor = None
+
+  def prepare(self):
+    if self.__workers > 1:
+      executor = self.__get_executor()
+      wait([executor.submit(os.getpid) for _ in range(self.__workers)])
+
+  def close(self):
+    if self.__executor:
+      self.__executor.shutdown(cancel_futures=True)
+      self.__executor = None
+
+  def calculate_timeframe(self, zip_file_path: Path, start_year: str, start_cw: str, end_year: str, end_cw: str) -> pd.DataFrame:
+    zip_file_path = Path(zip_file_path).resolve()
+    logging.info("Calculating LOS with python engine path=%s workers=%d", zip_file_path, self.__workers)
+    window = int(start_year), int(start_cw), int(end_year), int(end_cw)
+    if self.__aggregate_store:
+      with self.__metrics.stage('update_aggregate_store') as stage:
+        stage['rows'] = self.update_aggregate_store(zip_file_path)
+      with self.__metrics.stage('analysis') as stage:
+        aggregates = self.__aggregate_store.load_aggregates()
+        timeframe = self.perform_aggregate_analysis(aggregates, *window) if aggregates['total_rows'].sum() > 0 else None
+        stage['rows'] = len(aggregates)
+    else:
+      with self.__metrics.stage('prepare_case_data') as stage:
+        case_data = self.prepare_case_data(zip_file_path)
+        stage['rows'] = 0 if case_data is None else len(case_data)
+      with self.__metrics.stage('analysis') as stage:
+        timeframe = self.perform_analysis(case_data, *window) if case_data is not None else None
+        stage['rows'] = 0 if case_data is None else len(case_data)
+    if timeframe is None:
+      logging.warning("case_data is empty, check the given tables for missing columns")
+      timeframe = pd.DataFrame({'message': [self.__no_data_message]})
+    logging.info("LOS calculation completed successfully")
+    return timeframe
+
+  def prepare_case_data(self, zip_file_path: Path) -> pd.DataFrame:
+    cache_dir = self.__case_data_cache.cache_dir if self.__case_data_cache else None
+    frames = self.__map_clinics(LosCalculator.prepare_bundle_case_data, zip_file_path, cache_dir)
+    if self.__case_data_cache:
+      self.__case_data_cache.evict()
+    frames = [df for df in frames.values() if df is not None]
+    if not frames or sum(len(df) for df in frames) == 0:
+      return None
+    return pd.concat(frames, ignore_index=True)
+
+  def update_aggregate_store(self, zip_file_path: Path) -> int:
+    known_hashes = self.__aggregate_store.content_hashes()
+    cache_dir = self.__case_data_cache.cache_dir if self.__case_data_cache else None
+    results = self.__map_clinics(LosCalculator.aggregate_bundle_case_data, zip_file_path, known_hashes, cache_dir)
+    results = {clinic: result for clinic, result in results.items() if result[0] is not None}
+    changed = [clinic for clinic, (content_hash, _) in results.items() if known_hashes.get(clinic) != content_hash]
+    logging.info("Updating LOS aggregate store changed=%d unchanged=%d", len(changed), len(results) - len(changed))
+    for clinic in changed:
+      self.__aggregate_store.replace_clinic(clinic, *results[clinic])
+    self.__aggregate_store.retain_clinics(set(results))
+    if self.__case_data_cache:
+      self.__case_data_cache.evict()
+    return sum(int(results[clinic][1]['total_rows'].sum()) for clinic in changed if results[clinic][1] is not None)
+
+  @classmethod
+  def prepare_bundle_case_data(cls, zip_file_path: Path, clinic: int, cache_dir: Path = None) -> pd.DataFrame:
+    raw = BrokerResultReader.read_case_data(zip_file_path, clinic)
+    return cls.prepare_clinic_case_data(raw, clinic, cache_dir) if raw is not None else None
+
+  @classmethod
+  def aggregate_bundle_case_data(cls, zip_file_path: Path, clinic: int, known_hashes: dict, cache_dir: Path = None) -> tuple[str, pd.DataFrame]:
+    raw = BrokerResultReader.read_case_data(zip_file_path, clinic)
+    if raw is None:
+      return None, None
+    content_hash = CaseDataCache.create_key(raw, clinic)
+    if known_hashes.get(clinic) == content_hash:
+      return content_hash, None
+    return content_hash, cls.aggregate_clinic_case_data(raw, clinic, cache_dir)
+
+  @classmethod
+  def aggregate_clinic_case_data(cls, raw: bytes, clinic: int, cache_dir: Path = None) -> pd.DataFrame:
+    df = cls.prepare_clinic_case_data(raw, clinic, cache_dir)
+    if df is None:
+      return None
+    valid = cls.__filter_cases(df)
+    weeks = df.groupby(['calendarweek_year', 'cw']).size().rename('total_rows')
+    valid_weeks = valid.groupby(['calendarweek_year', 'cw']).agg(
+        case_count=('los', 'size'),
+        los_sum=('los', 'sum')
+    )
+    aggregates = weeks.to_frame().join(valid_weeks).reset_index()
+    aggregates[['case_count', 'los_sum']] = aggregates[['case_count', 'los_sum']].fillna(0)
+    aggregates['case_count'] = aggregates['case_count'].astype(int)
+    aggregates['invalid_rows'] = aggregates['total_rows'] - aggregates['case_count']
+    aggregates['clinic'] = clinic
+    return aggregates
+
+  @classmethod
+  def prepare_clinic_case_data(cls, case_data, clinic: int, cache_dir: Path = None) -> pd.DataFrame:
+    if cache_dir:
+      df = cls.__load_or_parse_case_data(case_data, clinic, CaseDataCache(cache_dir))
+    else:
+      df = cls.parse_case_data(io.BytesIO(case_data) if isinstance(case_data, bytes) else case_data, clinic)
+    return cls.__fill_case_data(df) if df is not None else None
+
+  @classmethod
+  def __load_or_parse_case_data(cls, raw: bytes, clinic: int, cache: CaseDataCache) -> pd.DataFrame:
+    key = CaseDataCache.create_key(raw, clinic)
+    df = cache.load(key)
+    if df is not None:
+      logging.info("Loaded parsed case data from cache clinic=%d rows=%d", clinic, len(df))
+      return df
+    df = cls.parse_case_data(io.BytesIO(raw), clinic)
+    if df is not None:
+      cache.store(key, df)
+    return df
+
+  @classmethod
+  def parse_case_data(cls, case_data, clinic: int) -> pd.DataFrame:
+    try:
+      df = pd.read_csv(case_data, sep='\t', dtype=str, keep_default_na=False,
+                       usecols=lambda column: column.strip() in cls.__timestamp_columns)
+    except pd.errors.EmptyDataError:
+      df = pd.DataFrame()
+    df.columns = df.columns.str.strip()
+    if 'entlassung_ts' not in df.columns:
+      logging.warning("Clinic %d has no discharge column matching the configured naming", clinic)
+      return None
+    for column in cls.__timestamp_columns:
+      if column in df.columns:
+        values = df[column].str.strip().replace({'': None, 'NA': None})
+        df[column] = pd.to_datetime(values, utc=True, format='ISO8601', errors='coerce')
+      else:
+        df[column] = pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns, UTC]')
+    df = df[df['triage_ts'].notna() | df['aufnahme_ts'].notna()].copy()
+    df['aufnahme_ts'] = df['aufnahme_ts'].fillna(df['triage_ts'])
+    df['clinic'] = clinic
+    return df[['aufnahme_ts', 'entlassung_ts', 'triage_ts', 'clinic']]
+
+  def perform_analysis(self, filled_case_data: pd.DataFrame, start_year: int, start_cw: int, end_year: int, end_cw: int) -> pd.DataFrame:
+    num_of_cases = filled_case_data.groupby('clinic').size()
+    db = self.__filter_cases(filled_case_data)
+    los_valid = self.__filter_los_valid(db, num_of_cases)
+    complete_db = db[db['clinic'].isin(los_valid)]
+    return self.__calculate_timeframe(complete_db, start_year, start_cw, end_year, end_cw)
+
+  def perform_aggregate_analysis(self, aggregates: pd.DataFrame, start_year: int, start_cw: int, end_year: int, end_cw: int) -> pd.DataFrame:
+    clinics = aggregates.groupby('clinic')[['total_rows', 'case_count', 'los_sum']].sum()
+    clinics = clinics[clinics['case_count'] > 0]
+    error_rate = (clinics['total_rows'] - clinics['case_count']) / clinics['total_rows'] * 100
+    los_mean = clinics['los_sum'] / clinics['case_count']
+    los_valid = clinics[(error_rate < self.__error_max) & (los_mean < self.__los_max)].index
+    complete = aggregates[aggregates['clinic'].isin(los_valid) & (aggregates['case_count'] > 0)]
+    weighted = complete.assign(weighted_los=complete['los_sum'] * complete['clinic'], weight=complete['case_count'] * complete['clinic'])
+    weeks = weighted.groupby(['calendarweek_year', 'cw']).agg(
+        weighted_los=('weighted_los', 'sum'),
+        weight=('weight', 'sum'),
+        case_count=('case_count', 'sum'),
+        ed_count=('clinic', 'nunique')
+    ).reset_index()
+    timeframe = pd.DataFrame({
+      'calendarweek_year': weeks['calendarweek_year'],
+      'cw': weeks['cw'],
+      'los_mean': weeks['weighted_los'] / weeks['weight'],
+      'visit_mean': weeks['case_count'] / len(los_valid),
+      'ed_count': weeks['ed_count']
+    })
+    return self.__format_timeframe(timeframe, start_year, start_cw, end_year, end_cw)
+
+  def __map_clinics(self, func, zip_file_path: Path, *args) -> dict:
+    clinics = self.__reader.list_clinics(zip_file_path)
+    if self.__workers < 2 or len(clinics) < self.__min_parallel_clinics:
+      return {clinic: func(zip_file_path, clinic, *args) for clinic in clinics}
+    executor = self.__get_executor()
+    futures = {clinic: executor.submit(func, zip_file_path, clinic, *args) for clinic in clinics}
+    return {clinic: future.result() for clinic, future in futures.items()}
+
+  def __get_executor(self) -> ProcessPoolExecutor:
+    if self.__executor is None:
+      logging.info("Starting case data process pool workers=%d", self.__workers)
+      self.__executor = ProcessPoolExecutor(max_workers=self.__workers, mp_context=multiprocessing.get_context('forkserver'))
+    return self.__executor
+
+  @classmethod
+  def __fill_case_data(cls, case_data: pd.DataFrame) -> pd.DataFrame:
+    case_data = case_data.copy()
+    local_tz = dateutil.tz.tzlocal()
+    for column in cls.__timestamp_columns:
+      case_data[column] = case_data[column].dt.tz_convert(local_tz)
+    iso_calendar = case_data['aufnahme_ts'].dt.isocalendar()
+    case_data['calendarweek_year'] = iso_calendar['year'].astype(int)
+    case_data['cw'] = iso_calendar['week'].astype(int)
+    use_aufnahme = case_data['triage_ts'].isna() | (case_data['triage_ts'] >= case_data['aufnahme_ts'])
+    first_ts = case_data['aufnahme_ts'].where(use_aufnahme, case_data['triage_ts'])
+    case_data['los'] = (case_data['entlassung_ts'] - first_ts).dt.total_seconds() / 60
+    return case_data
+
+  @classmethod
+  def __filter_cases(cls, filled_case_data: pd.DataFrame) -> pd.DataFrame:
+    los = filled_case_data['los']
+    return filled_case_data[los.notna() & (los >= 1) & (los < 1440.0)]
+
+  def __filter_los_valid(self, db: pd.DataFrame, num_of_cases: pd.Series) -> pd.Index:
+    los = db.groupby('clinic')['los'].agg(['mean', 'size'])
+    error_rate = (num_of_cases.reindex(los.index) - los['size']) / num_of_cases.reindex(los.index) * 100
+    valid = los[(error_rate < self.__error_max) & (los['mean'] < self.__los_max)]
+    return valid.index
+
+  def __calculate_timeframe(self, complete_db: pd.DataFrame, start_year: int, start_cw: int, end_year: int, end_cw: int) -> pd.DataFrame:
+    weighted = complete_db.assign(weighted_los=complete_db['los'] * complete_db['clinic'])
+    weeks = weighted.groupby(['calendarweek_year', 'cw']).agg(
+        weighted_los=('weighted_los', 'sum'),
+        weight=('clinic', 'sum'),
+        case_count=('clinic', 'size'),
+        ed_count=('clinic', 'nunique')
+    ).reset_index()
+    timeframe = pd.DataFrame({
+      'calendarweek_year': weeks['calendarweek_year'],
+      'cw': weeks['cw'],
+      'los_mean': weeks['weighted_los'] / weeks['weight'],
+      'visit_mean': weeks['case_count'] / complete_db['clinic'].nunique(),
+      'ed_count': weeks['ed_count']
+    })
+    return self.__format_timeframe(timeframe, start_year, start_cw, end_year, end_cw)
+
+  def __format_timeframe(self, timeframe: pd.DataFrame, start_year: int, start_cw: int, end_year: int, end_cw: int) -> pd.DataFrame:
+    timeframe['los_reference'] = self.__los_reference
+    timeframe['los_difference'] = timeframe['los_mean'] - self.__los_reference
+    timeframe['change'] = np.where(timeframe['los_difference'] > 0, 'Zunahme', 'Abnahme')
+    year, cw = timeframe['calendarweek_year'], timeframe['cw']
+    after_start = (year > start_year) | ((year == start_year) & (cw >= start_cw))
+    before_end = (year < end_year) | ((year == end_year) & (cw <= end_cw))
+    timeframe = timeframe[after_start & before_end].copy()
+    timeframe['date'] = timeframe['calendarweek_year'].astype(str) + '-W' + timeframe['cw'].astype(str).str.zfill(2)
+    timeframe = timeframe[LosResultFileManager.result_columns]
+    for column in ('visit_mean', 'los_mean', 'los_reference', 'los_difference'):
+      timeframe[column] = timeframe[column].map(lambda value: round(value, 2))
+    return timeframe.reset_index(drop=True)
 
 
 class LosResultFileManager:
   """Manages LOS calculation result files.
 
-  Handles renaming, zipping and cleanup of result files according to standardized format.
-  Can create zip archives with standardized folder structure for result files.
+  Result tables returned by the engines in memory are validated and written to
+  one archive per reporting window directly, without intermediate files. Archives
+  use the standardized name and folder structure. Also handles cleanup of the
+  calculation working directory.
   """
 
-  def rename_result_file_to_standardized_form(self, file_path: Path) -> Path:
-    file_path = file_path.resolve()
-    logging.info("Standardizing result filename path=%s", file_path)
-    if not file_path.exists():
-      raise FileNotFoundError(f'File {file_path} does not exist.')
+  result_columns = ['date', 'ed_count', 'visit_mean', 'los_mean', 'los_reference', 'los_difference', 'change']
+
+  def create_standardized_name(self, window: tuple = None, now: datetime.datetime = None) -> str:
+    now = now or datetime.datetime.now()
+    start_year, start_week, end_year, end_week = window or self.calculate_default_window(now)
+    timestamp = now.strftime('%Y%m%d-%H%M%S')
+    return f'LOS_{start_year}-W{start_week:02d}_to_{end_year}-W{end_week:02d}_{timestamp}'
+
+  @classmethod
+  def format_result_csv(cls, timeframe: pd.DataFrame) -> str:
+    return timeframe.to_csv(index=False, float_format='%.15g', na_rep='NA', lineterminator='\n')
+
+  def validate_timeframe(self, timeframe: pd.DataFrame):
+    columns = list(timeframe.columns)
+    if columns == ['message']:
+      return
+    if columns != self.result_columns:
+      raise RuntimeError(f'Unexpected columns in LOS result: {columns}')
+    invalid_dates = timeframe.loc[~timeframe['date'].astype(str).str.fullmatch(r'\d{4}-W\d{2}'), 'date']
+    if not invalid_dates.empty:
+      raise RuntimeError(f'Invalid calendar weeks in LOS result: {invalid_dates.tolist()[:5]}')
+    if timeframe['date'].duplicated().any():
+      raise RuntimeError('Duplicate calendar weeks in LOS result')
+
+  def write_result_archives(self, timeframe: pd.DataFrame, windows: list[tuple[int, int, int, int]], target_dir: Path) -> list[Path]:
+    self.validate_timeframe(timeframe)
+    target_dir = Path(target_dir).resolve()
+    target_dir.mkdir(parents=True, exist_ok=True)
     now = datetime.datetime.now()
+    zip_paths = []
+    for window in windows:
+      window_data = timeframe
+      if 'date' in timeframe.columns:
+        start, end = f'{window[0]}-W{window[1]:02d}', f'{window[2]}-W{window[3]:02d}'
+        window_data = timeframe[(timeframe['date'] >= start) & (timeframe['date'] <= end)]
+      name = self.create_standardized_name(window, now)
+      zip_path = target_dir / f'{name}.zip'
+      logging.info("Writing result archive path=%s rows=%d", zip_path, len(window_data))
+      with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f'{name}/{name}.csv', self.format_result_csv(window_data))
+      zip_paths.append(zip_path)
+    return zip_paths
+
+  def calculate_default_window(self, now: datetime.datetime = None) -> tuple[int, int, int, int]:
+    now = now or datetime.datetime.now()
     current_year, current_week, _ = now.isocalendar()
     end_year, end_week = self.calculate_cw_minus_n(current_year, current_week, 1)
     start_year, start_week = self.calculate_cw_minus_n(end_year, end_week, 3)
-    timestamp = now.strftime('%Y%m%d-%H%M%S')
-    new_filename = f'LOS_{start_year}-W{start_week:02d}_to_{end_year}-W{end_week:02d}_{timestamp}'
-    new_file_path = file_path.with_name(new_filename + file_path.suffix)
-    file_path.rename(new_file_path)
-    return new_file_path
+    return start_year, start_week, end_year, end_week
+
+  def calculate_rolling_windows(self, first_end: tuple[int, int], last_end: tuple[int, int], weeks: int = 4) -> list[tuple[int, int, int, int]]:
+    if first_end > last_end:
+      raise ValueError(f'Backfill range ends before it starts: {first_end} > {last_end}')
+    windows = []
+    end_date = datetime.date.fromisocalendar(first_end[0], first_end[1], 1)
+    last_date = datetime.date.fromisocalendar(last_end[0], last_end[1], 1)
+    while end_date <= last_date:
+      end_year, end_week, _ = end_date.isocalendar()
+      start_year, start_week = self.calculate_cw_minus_n(end_year, end_week, weeks - 1)
+      windows.append((start_year, start_week, end_year, end_week))
+      end_date += datetime.timedelta(weeks=1)
+    return windows
+
+  def calculate_enclosing_window(self, windows: list[tuple[int, int, int, int]]) -> tuple[int, int, int, int]:
+    start = min((window[0], window[1]) for window in windows)
+    end = max((window[2], window[3]) for window in windows)
+    return start + end
 
   def calculate_cw_minus_n(self, year: int, week: int, n: int) -> tuple[int, int]:
     if week > n:
@@ -307,22 +1969,6 @@ class LosResultFileManager:
       last_year_weeks = datetime.date(last_year, 12, 28).isocalendar()[1]
       return last_year, last_year_weeks - (n - week)
 
-  def zip_result_file(self, file_path: Path) -> Path:
-    file_path = file_path.resolve()
-    logging.info("Creating ZIP archive for result file path=%s", file_path)
-    if not file_path.exists():
-      raise FileNotFoundError(f'File {file_path} does not exist.')
-    folder_name = file_path.stem
-    folder_path = file_path.parent / folder_name
-    folder_path.mkdir(exist_ok=True)
-    shutil.copy2(file_path, folder_path / file_path.name)
-    zip_path = file_path.with_suffix('.zip')
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
-      for file in folder_path.rglob('*'):
-        zf.write(file, file.relative_to(folder_path.parent))
-    shutil.rmtree(folder_path)
-    return zip_path
-
   def clear_rscript_data(self, result_file_path: Path):
     result_dir = result_file_path.resolve().parent
     logging.info("Cleaning R script data directory path=%s", result_dir)
@@ -331,47 +1977,571 @@ class LosResultFileManager:
     shutil.rmtree(result_dir)
 
 
+class SftpDestination:
+  """Publishes result archives to an SFTP server configured by a section with the SFTP keys.
+
+  Replaces the content of the target folder, either by deleting all files before
+  uploading or atomically, depending on the PUBLISH_MODE of the section. The
+  session is opened and the folder listed by prepare(), ahead of publishing.
+  """
+
+  required_keys = ('HOST', 'PORT', 'USERNAME', 'PASSWORD', 'TIMEOUT', 'FOLDER')
+
+  def __init__(self, section: str, pool: SftpConnectionPool):
+    self.__sftp_manager = SftpFileManager(pool, section)
+    self.__existing_files = None
+
+  def prepare(self):
+    self.__existing_files = self.__sftp_manager.list_files()
+
+  def publish(self, file_paths: list[Path]):
+    if self.__sftp_manager.publish_mode == 'atomic':
+      self.__sftp_manager.publish_files(file_paths)
+      return
+    existing_files, self.__existing_files = self.__existing_files, None
+    if existing_files is None:
+      existing_files = self.__sftp_manager.list_files()
+    self.__sftp_manager.delete_files(existing_files)
+    for file_path in file_paths:
+      self.__sftp_manager.upload_file(file_path)
+
+
+class LocalDestination:
+  """Publishes result archives to a local or mounted directory, e.g. an internal archive.
+
+  Copies each archive under a temporary name and renames it into place, so
+  readers of the directory never see partial files. Existing files are kept.
+  """
+
+  required_keys = ('DIR',)
+
+  def __init__(self, section: str):
+    self.__target_dir = Path(os.environ[f'{section}.DIR']).resolve()
+
+  def prepare(self):
+    self.__target_dir.mkdir(parents=True, exist_ok=True)
+
+  def publish(self, file_paths: list[Path]):
+    self.__target_dir.mkdir(parents=True, exist_ok=True)
+    for file_path in file_paths:
+      file_path = Path(file_path).resolve()
+      target_path = self.__target_dir / file_path.name
+      tmp_path = target_path.with_name(f'.{target_path.name}.{os.getpid()}.part')
+      shutil.copyfile(file_path, tmp_path)
+      os.replace(tmp_path, target_path)
+      logging.info('Copied result archive path=%s', target_path)
+
+
+class S3Destination:
+  """Publishes result archives to an S3-compatible object store.
+
+  Uploads each archive with a single PUT request to ENDPOINT/BUCKET/PREFIX/name
+  (path-style addressing), signed with AWS Signature Version 4 and protected by
+  a Content-MD5 header, so any S3-compatible store like MinIO or Ceph can be used
+  without an SDK.
+  """
+
+  required_keys = ('ENDPOINT', 'BUCKET', 'ACCESS_KEY', 'SECRET_KEY')
+  __chunk_size = 256 * 1024
+
+  def __init__(self, section: str):
+    self.__endpoint = os.environ[f'{section}.ENDPOINT'].rstrip('/')
+    self.__bucket = os.environ[f'{section}.BUCKET']
+    self.__prefix = os.environ.get(f'{section}.PREFIX', '').strip('/')
+    self.__access_key = os.environ[f'{section}.ACCESS_KEY']
+    self.__secret_key = os.environ[f'{section}.SECRET_KEY']
+    self.__region = os.environ.get(f'{section}.REGION', 'us-east-1')
+    self.__timeout = float(os.environ.get(f'{section}.TIMEOUT', 60))
+
+  def publish(self, file_paths: list[Path]):
+    with requests.Session() as session:
+      for file_path in file_paths:
+        self.__put_object(session, Path(file_path).resolve())
+
+  def __put_object(self, session: requests.Session, file_path: Path):
+    key = '/'.join(filter(None, [self.__prefix, file_path.name]))
+    path = '/' + '/'.join(urllib.parse.quote(segment, safe='-_.~') for segment in [self.__bucket] + key.split('/'))
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    with open(file_path, 'rb') as f:
+      for block in iter(lambda: f.read(self.__chunk_size), b''):
+        sha256.update(block)
+        md5.update(block)
+    headers = self.__sign('PUT', path, sha256.hexdigest())
+    headers['Content-MD5'] = base64.b64encode(md5.digest()).decode('ascii')
+    headers['Content-Type'] = 'application/zip'
+    with open(file_path, 'rb') as f:
+      response = session.put(self.__endpoint + path, data=f, headers=headers, timeout=self.__timeout)
+    if response.status_code not in (200, 201):
+      raise RuntimeError(f'S3 upload of {file_path.name} failed with HTTP {response.status_code}: {response.text[:200]}')
+    logging.info('Uploaded result archive to S3 bucket=%s key=%s', self.__bucket, key)
+
+  def __sign(self, method: str, path: str, payload_hash: str) -> dict:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    amz_date, date = now.strftime('%Y%m%dT%H%M%SZ'), now.strftime('%Y%m%d')
+    host = urllib.parse.urlsplit(self.__endpoint).netloc
+    headers = {'host': host, 'x-amz-content-sha256': payload_hash, 'x-amz-date': amz_date}
+    signed_headers = ';'.join(sorted(headers))
+    canonical_headers = ''.join(f'{name}:{headers[name]}\n' for name in sorted(headers))
+    canonical_request = '\n'.join([method, path, '', canonical_headers, signed_headers, payload_hash])
+    scope = f'{date}/{self.__region}/s3/aws4_request'
+    string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+    key = f'AWS4{self.__secret_key}'.encode('utf-8')
+    for part in (date, self.__region, 's3', 'aws4_request'):
+      key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+    return {
+      'x-amz-content-sha256': payload_hash,
+      'x-amz-date': amz_date,
+      'Authorization': f'AWS4-HMAC-SHA256 Credential={self.__access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}'
+    }
+
+
+class ResultPublisher:
+  """Publishes result archives to all configured destinations concurrently.
+
+  The SFTP section is always the first destination. PUBLISH.TARGETS names
+  further sections below PUBLISH, each with a TYPE of "sftp", "local" or "s3"
+  and the keys of that destination type. Every destination is retried up to
+  PUBLISH.RETRIES times with exponential backoff, independent of the others.
+  The outcome of each destination is recorded in the pipeline metrics, and a
+  RuntimeError names the destinations that failed after all retries.
+  prepare() connects to the destinations ahead of publishing; its failures are
+  only logged, as publishing connects again and retries.
+  """
+
+  __destination_types = {'sftp': SftpDestination, 'local': LocalDestination, 's3': S3Destination}
+
+  def __init__(self, metrics: PipelineMetrics = None):
+    self.__metrics = metrics or PipelineMetrics()
+    self.__retries = int(os.environ.get('PUBLISH.RETRIES', 2))
+    self.__backoff = float(os.environ.get('PUBLISH.BACKOFF', 2))
+    self.__pool = SftpConnectionPool()
+    self.__destinations = {'sftp': SftpDestination('SFTP', self.__pool)}
+    targets = [target.strip() for target in os.environ.get('PUBLISH.TARGETS', '').split(',') if target.strip()]
+    for target in targets:
+      if target in self.__destinations:
+        raise SystemExit(f'Duplicate publish target: {target}')
+      self.__destinations[target] = self.__create_destination(target)
+
+  def __create_destination(self, target: str):
+    section = f'PUBLISH.{target}'
+    destination_type = os.environ.get(f'{section}.TYPE')
+    if destination_type not in self.__destination_types:
+      raise SystemExit(f'Invalid or missing TYPE for publish target {target}: {destination_type}')
+    destination_class = self.__destination_types[destination_type]
+    missing_keys = {f'{section}.{key}' for key in destination_class.required_keys if f'{section}.{key}' not in os.environ}
+    if missing_keys:
+      raise SystemExit(f'Missing keys for publish target {target}: {missing_keys}')
+    if destination_class is SftpDestination:
+      return SftpDestination(section, self.__pool)
+    return destination_class(section)
+
+  @property
+  def destinations(self) -> list[str]:
+    return list(self.__destinations)
+
+  def close(self):
+    self.__pool.close()
+
+  def prepare(self):
+    destinations = {name: destination for name, destination in self.__destinations.items() if hasattr(destination, 'prepare')}
+    if not destinations:
+      return
+    with ThreadPoolExecutor(max_workers=len(destinations)) as executor:
+      futures = {name: executor.submit(self.__prepare, name, destination) for name, destination in destinations.items()}
+      results = {name: future.result() for name, future in futures.items()}
+    for name, (duration, error) in results.items():
+      values = {'error': error} if error else {}
+      self.__metrics.record(name, duration, 'ok' if error is None else 'error', **values)
+
+  def __prepare(self, name: str, destination) -> tuple[float, str]:
+    start = time.perf_counter()
+    try:
+      destination.prepare()
+      return time.perf_counter() - start, None
+    except Exception as e:
+      logging.warning('Preparing destination failed destination=%s error=%s', name, e)
+      return time.perf_counter() - start, str(e)
+
+  def publish(self, file_paths: list[Path]) -> list[dict]:
+    with ThreadPoolExecutor(max_workers=len(self.__destinations)) as executor:
+      futures = {name: executor.submit(self.__publish_to, name, destination, file_paths) for name, destination in self.__destinations.items()}
+      results = [future.result() for future in futures.values()]
+    for result in results:
+      values = {key: value for key, value in result.items() if key not in ('destination', 'duration_seconds')}
+      self.__metrics.record(result['destination'], result['duration_seconds'], **values)
+    failed = [result['destination'] for result in results if result['status'] != 'ok']
+    if failed:
+      raise RuntimeError(f'Publishing failed for destinations: {", ".join(failed)}')
+    return results
+
+  def __publish_to(self, name: str, destination, file_paths: list[Path]) -> dict:
+    start = time.perf_counter()
+    error = None
+    for attempt in range(1, self.__retries + 2):
+      try:
+        destination.publish(file_paths)
+        logging.info('Published results destination=%s attempt=%d', name, attempt)
+        error = None
+        break
+      except Exception as e:
+        error = e
+        logging.warning('Publishing failed destination=%s attempt=%d error=%s', name, attempt, e)
+        if attempt <= self.__retries:
+          time.sleep(self.__backoff * 2 ** (attempt - 1))
+    result = {
+      'destination': name,
+      'duration_seconds': time.perf_counter() - start,
+      'status': 'ok' if error is None else 'error',
+      'attempts': attempt,
+      'bytes': sum(Path(file_path).stat().st_size for file_path in file_paths)
+    }
+    if error is not None:
+      result['error'] = str(error)
+    return result
+
+
 class LosProcessor:
   """Main pipeline processor for Length of Stay calculations.
 
   Coordinates the end-to-end process of:
   1. Loading configuration
   2. Downloading broker data
-  3. Running R script analysis
+  3. Running R script (or native python) analysis
   4. Zipping result file
-  5. Uploading results to SFTP
+  5. Publishing results to SFTP and further destinations
+
+  The steps run as a PipelineGraph, so checking the broker, starting the R worker
+  and connecting to the publish destinations overlap with each other and with
+  download and analysis.
+  A persistent processor keeps its sessions open between runs of process() until
+  close() is called, e.g. in service mode.
   """
 
-  def __init__(self, config_path: str):
+  def __init__(self, config_path: str, persistent: bool = False):
     config_path = Path(config_path).resolve()
     self.__config_manager = ConfigurationManager(config_path)
-    self.__broker_manager = BrokerRequestResultManager()
-    self.__sftp_manager = SftpFileManager()
-    self.__los_script = LosScriptManager()
-    self.__result_manager = LosResultFileManager()
+    self.__metrics = PipelineMetrics()
+    self.__persistent = persistent
+    self.__runs = 0
+    self.__last_report = None
+    try:
+      self.__broker_manager = BrokerRequestResultManager(self.__metrics, lazy=True)
+      self.__publisher = ResultPublisher(self.__metrics)
+      self.__los_engine = os.environ.get('RSCRIPT.ENGINE', 'r')
+      if self.__los_engine not in ('r', 'python'):
+        raise SystemExit(f'Invalid LOS engine: {self.__los_engine}')
+      if os.environ.get('STORE.PATH') and self.__los_engine != 'python':
+        raise SystemExit('STORE.PATH requires RSCRIPT.ENGINE "python"')
+      self.__los_script = LosCalculator(self.__metrics) if self.__los_engine == 'python' else LosScriptManager(self.__metrics)
+      self.__result_manager = LosResultFileManager()
+    except BaseException:
+      self.__metrics.write_report('error')
+      raise
 
-  def process(self):
+  @property
+  def last_report(self) -> dict:
+    return self.__last_report
+
+  def close(self):
+    self.__publisher.close()
+    self.__los_script.close()
+
+  def process(self, windows: list[tuple[int, int, int, int]] = None):
+    status = 'error'
+    if self.__runs:
+      self.__metrics.reset()
+    self.__runs += 1
     try:
-      now = datetime.datetime.now()
-      current_year, current_week, _ = now.isocalendar()
-      end_year, end_week = self.__result_manager.calculate_cw_minus_n(current_year, current_week, 1)
-      start_year, start_week = self.__result_manager.calculate_cw_minus_n(end_year, end_week, 3)
-      raw_data_zip = self.__broker_manager.download_latest_broker_result_by_set_tag()
-      processed_data = self.__los_script.execute_rscript(raw_data_zip, str(start_year), str(start_week), str(end_year), str(end_week))
-      renamed_data = self.__result_manager.rename_result_file_to_standardized_form(processed_data)
-      zipped_data = self.__result_manager.zip_result_file(renamed_data)
-      self.__clean_and_upload_sftp(zipped_data)
-      self.__result_manager.clear_rscript_data(zipped_data)
-      os.remove(raw_data_zip)
+      windows = list(dict.fromkeys(windows or [self.__result_manager.calculate_default_window()]))
+      enclosing_window = self.__result_manager.calculate_enclosing_window(windows)
+      logging.info("Processing reporting windows count=%d start=%d-W%02d end=%d-W%02d", len(windows), *enclosing_window)
+      graph = PipelineGraph(self.__metrics)
+      graph.add('broker_availability', lambda stage, results: self.__broker_manager.check_availability())
+      graph.add('publish_prepare', lambda stage, results: self.__publisher.prepare())
+      graph.add('download', lambda stage, results: self.__download(stage), ('broker_availability',))
+      graph.add('engine_prepare', lambda stage, results: self.__los_script.prepare())
+      graph.add('calculate', lambda stage, results: self.__calculate(results['download'], enclosing_window), ('download', 'engine_prepare'))
+      graph.add('package', lambda stage, results: self.__package(stage, results['download'], results['calculate'], windows), ('download', 'calculate'))
+      graph.add('publish', lambda stage, results: self.__publish(stage, results['package']), ('package', 'publish_prepare'))
+      graph.add('cleanup', lambda stage, results: self.__cleanup(results['download'], results['package']), ('publish',))
+      graph.run()
+      status = 'ok'
+    except SystemExit as e:
+      status = 'skipped' if e.code in (0, None) else 'error'
+      raise
     except Exception as e:
       logging.error(f"Error during LOS processing: {e}", exc_info=True)
       raise
+    finally:
+      if not self.__persistent:
+        self.close()
+      self.__last_report = self.__metrics.write_report(status)
+
+  def __download(self, stage: dict) -> Path:
+    raw_data_zip = self.__broker_manager.download_latest_broker_result_by_set_tag()
+    stage['bytes'] = raw_data_zip.stat().st_size
+    return raw_data_zip
+
+  def __calculate(self, raw_data_zip: Path, window: tuple[int, int, int, int]) -> pd.DataFrame:
+    return self.__los_script.calculate_timeframe(raw_data_zip, *map(str, window))
+
+  def __package(self, stage: dict, raw_data_zip: Path, timeframe: pd.DataFrame, windows: list[tuple[int, int, int, int]]) -> list[Path]:
+    zipped_data = self.__result_manager.write_result_archives(timeframe, windows, raw_data_zip.parent / 'broker_result')
+    stage['rows'] = len(timeframe)
+    stage['bytes'] = sum(path.stat().st_size for path in zipped_data)
+    return zipped_data
+
+  def __publish(self, stage: dict, zipped_data: list[Path]):
+    self.__publisher.publish(zipped_data)
+    stage['bytes'] = sum(path.stat().st_size for path in zipped_data)
+
+  def __cleanup(self, raw_data_zip: Path, zipped_data: list[Path]):
+    self.__result_manager.clear_rscript_data(zipped_data[0])
+    os.remove(raw_data_zip)
+
+
+class CronSchedule:
+  """Schedule given as a cron expression with the five fields minute, hour, day of month, month and day of week.
+
+  Fields support "*", lists, ranges and steps, e.g. "0 6 * * 1" for Mondays at
+  06:00 or "*/30 8-18 * * 1-5". Day of week 0 and 7 are Sunday. If both day
+  fields are restricted, a day matches if either of them matches, as in cron.
+  Times are local times.
+  """
+
+  __fields = (('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7))
+  __search_years = 5
+
+  def __init__(self, expression: str):
+    parts = expression.split()
+    if len(parts) != len(self.__fields):
+      raise SystemExit(f'Invalid cron expression {expression!r}, expected five fields')
+    values = [self.__parse_field(part, name, low, high) for part, (name, low, high) in zip(parts, self.__fields)]
+    self.__minutes, self.__hours, self.__days, self.__months = values[:4]
+    self.__weekdays = {weekday % 7 for weekday in values[4]}
+    self.__days_restricted = not parts[2].startswith('*')
+    self.__weekdays_restricted = not parts[4].startswith('*')
+    self.__expression = expression
+
+  def __parse_field(self, field: str, name: str, low: int, high: int) -> set[int]:
+    values = set()
+    try:
+      for item in field.split(','):
+        value_range, _, step = item.partition('/')
+        step = int(step) if step else 1
+        if value_range == '*':
+          start, end = low, high
+        elif '-' in value_range:
+          start, end = map(int, value_range.split('-'))
+        else:
+          start = int(value_range)
+          end = high if '/' in item else start
+        if step < 1 or start < low or end > high or start > end:
+          raise ValueError
+        values.update(range(start, end + 1, step))
+    except ValueError:
+      raise SystemExit(f'Invalid {name} field in cron expression: {field!r}')
+    return values
+
+  def __matches_day(self, moment: datetime.datetime) -> bool:
+    day_matches = moment.day in self.__days
+    weekday_matches = moment.isoweekday() % 7 in self.__weekdays
+    if self.__days_restricted and self.__weekdays_restricted:
+      return day_matches or weekday_matches
+    return day_matches and weekday_matches
+
+  def next_run(self, after: datetime.datetime) -> datetime.datetime:
+    moment = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    limit = moment + datetime.timedelta(days=366 * self.__search_years)
+    while moment < limit:
+      if moment.month not in self.__months:
+        moment = (moment.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+      elif not self.__matches_day(moment):
+        moment = moment.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+      elif moment.hour not in self.__hours:
+        moment = moment.replace(minute=0) + datetime.timedelta(hours=1)
+      elif moment.minute not in self.__minutes:
+        moment += datetime.timedelta(minutes=1)
+      else:
+        return moment
+    raise SystemExit(f'Cron expression {self.__expression!r} never matches')
+
+
+class LosService:
+  """Runs the LOS pipeline as a long-running service on the schedule SCHEDULE.CRON.
+
+  Configuration is loaded and the pipeline components are created once, so the
+  broker and SFTP sessions, the engine and its caches stay warm between runs and
+  start-up and handshakes are not paid on every run. A failed run is logged and
+  reported, and the service waits for the next scheduled run. If
+  SCHEDULE.HEALTH_PORT is set, a local HTTP endpoint on SCHEDULE.HEALTH_HOST
+  serves the service state as JSON on /health and the Prometheus metrics of the
+  last run on /metrics. SIGTERM and SIGINT stop the service after the current run.
+  """
+
+  __max_sleep_seconds = 60
+
+  def __init__(self, config_path: str):
+    self.__processor = LosProcessor(config_path, persistent=True)
+    try:
+      if not os.environ.get('SCHEDULE.CRON'):
+        raise SystemExit('SCHEDULE.CRON is required to run as a service')
+      self.__schedule = CronSchedule(os.environ['SCHEDULE.CRON'])
+      health_port = os.environ.get('SCHEDULE.HEALTH_PORT')
+      self.__health_server = None
+      self.__health_thread = None
+      if health_port is not None:
+        self.__health_server = ThreadingHTTPServer((os.environ.get('SCHEDULE.HEALTH_HOST', '127.0.0.1'), int(health_port)), self.__create_health_handler())
+        self.__health_server.daemon_threads = True
+    except BaseException:
+      self.__processor.close()
+      raise
+    self.__stop = threading.Event()
+    self.__started_at = datetime.datetime.now(datetime.timezone.utc)
+    self.__next_run = None
+    self.__running = False
+    self.__runs = 0
+    self.__failed_runs = 0
+    self.__last_run = None
+
+  @property
+  def health_address(self) -> tuple[str, int]:
+    return self.__health_server.server_address if self.__health_server else None
+
+  def stop(self):
+    self.__stop.set()
+
+  def serve(self):
+    if threading.current_thread() is threading.main_thread():
+      signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+      signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+    if self.__health_server:
+      self.__health_thread = threading.Thread(target=self.__health_server.serve_forever, name='los-health', daemon=True)
+      self.__health_thread.start()
+      logging.info('Health endpoint listening address=%s:%d', *self.health_address[:2])
+    try:
+      while not self.__stop.is_set():
+        self.__next_run = self.__schedule.next_run(datetime.datetime.now())
+        logging.info('Next run scheduled at=%s', self.__next_run.isoformat())
+        while not self.__stop.is_set():
+          remaining = (self.__next_run - datetime.datetime.now()).total_seconds()
+          if remaining <= 0:
+            break
+          self.__stop.wait(min(remaining, self.__max_sleep_seconds))
+        if not self.__stop.is_set():
+          self.run_once()
+    finally:
+      self.close()
+      logging.info('Service stopped runs=%d failed=%d', self.__runs, self.__failed_runs)
+
+  def run_once(self, windows: list[tuple[int, int, int, int]] = None):
+    self.__running = True
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    error = None
+    try:
+      self.__processor.process(windows)
+    except SystemExit as e:
+      if e.code not in (0, None):
+        error = str(e.code)
+    except Exception as e:
+      error = str(e)
+    finally:
+      self.__running = False
+    report = self.__processor.last_report or {}
+    self.__runs += 1
+    self.__failed_runs += report.get('status') == 'error'
+    self.__last_run = {
+      'status': report.get('status', 'error'),
+      'started_at': started_at.isoformat(),
+      'duration_seconds': report.get('duration_seconds'),
+      **({'error': error} if error else {})
+    }
+    logging.info('Scheduled run finished status=%s', self.__last_run['status'])
+
+  def close(self):
+    if self.__health_server:
+      if self.__health_thread:
+        self.__health_server.shutdown()
+      self.__health_server.server_close()
+      self.__health_server = None
+    self.__processor.close()
+
+  def health(self) -> dict:
+    return {
+      'status': 'ok' if self.__last_run is None or self.__last_run['status'] != 'error' else 'degraded',
+      'started_at': self.__started_at.isoformat(),
+      'running': self.__running,
+      'runs': self.__runs,
+      'failed_runs': self.__failed_runs,
+      'next_run': self.__next_run.astimezone().isoformat() if self.__next_run else None,
+      'last_run': self.__last_run
+    }
+
+  def metrics(self) -> str:
+    lines = [
+      '# HELP los_service_runs_total Runs of the LOS pipeline since the service started.', '# TYPE los_service_runs_total counter',
+      f'los_service_runs_total {self.__runs}',
+      '# HELP los_service_failed_runs_total Failed runs of the LOS pipeline since the service started.', '# TYPE los_service_failed_runs_total counter',
+      f'los_service_failed_runs_total {self.__failed_runs}'
+    ]
+    if self.__next_run:
+      lines += [
+        '# HELP los_service_next_run_timestamp_seconds Unix time of the next scheduled run.', '# TYPE los_service_next_run_timestamp_seconds gauge',
+        f'los_service_next_run_timestamp_seconds {self.__next_run.timestamp():.0f}'
+      ]
+    report = self.__processor.last_report
+    return '\n'.join(lines) + '\n' + (PipelineMetrics.format_prometheus(report) if report else '')
+
+  def __create_health_handler(self):
+    service = self
+
+    class HealthHandler(BaseHTTPRequestHandler):
+
+      def log_message(self, format, *args):
+        logging.debug('Health endpoint request %s', format % args)
+
+      def do_GET(self):
+        if self.path == '/health':
+          body, content_type = json.dumps(service.health()).encode('utf-8'), 'application/json'
+        elif self.path == '/metrics':
+          body, content_type = service.metrics().encode('utf-8'), 'text/plain; version=0.0.4'
+        else:
+          self.send_error(404)
+          return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    return HealthHandler
+
+
+def parse_calendar_week(value: str) -> tuple[int, int]:
+  match = re.fullmatch(r'(\d{4})-W(\d{2})', value.strip())
+  if not match:
+    raise argparse.ArgumentTypeError(f'Invalid calendar week {value!r}, expected YYYY-Www')
+  year, week = int(match.group(1)), int(match.group(2))
+  try:
+    datetime.date.fromisocalendar(year, week, 1)
+  except ValueError:
+    raise argparse.ArgumentTypeError(f'Calendar week {value!r} does not exist')
+  return year, week
+
+
+def parse_week_range(value: str) -> tuple[int, int, int, int]:
+  start, separator, end = value.partition(':')
+  if not separator:
+    raise argparse.ArgumentTypeError(f'Invalid week range {value!r}, expected YYYY-Www:YYYY-Www')
+  window = parse_calendar_week(start) + parse_calendar_week(end)
+  if window[:2] > window[2:]:
+    raise argparse.ArgumentTypeError(f'Week range {value!r} ends before it starts')
+  return window
+
 
-  def __clean_and_upload_sftp(self, file_path: Path):
-    files = self.__sftp_manager.list_files()
-    for file in files:
-      self.__sftp_manager.delete_file(file)
-    self.__sftp_manager.upload_file(file_path)
+def parse_report_windows(value: str) -> list[tuple[int, int, int, int]]:
+  return [parse_week_range(window) for window in value.split(',') if window.strip()]
 
 
 def main():
@@ -381,8 +2551,22 @@ def main():
   )
   if len(sys.argv) < 2:
     raise SystemExit('Path to config TOML is missing!')
-  processor = LosProcessor(sys.argv[1])
-  processor.process()
+  parser = argparse.ArgumentParser(description='Calculate the LOS report and publish it to the SFTP server.')
+  parser.add_argument('config', help='path to the config TOML')
+  parser.add_argument('--windows', type=parse_report_windows, default=[], help='comma-separated reporting windows YYYY-Www:YYYY-Www')
+  parser.add_argument('--backfill', type=parse_week_range, help='emit one rolling 4-week window for every end week in YYYY-Www:YYYY-Www')
+  parser.add_argument('--serve', action='store_true', help='run as a service on the schedule SCHEDULE.CRON instead of once')
+  args = parser.parse_args()
+  if args.serve:
+    if args.windows or args.backfill:
+      parser.error('--serve cannot be combined with --windows or --backfill')
+    LosService(args.config).serve()
+    return
+  windows = list(args.windows)
+  if args.backfill:
+    windows += LosResultFileManager().calculate_rolling_windows(args.backfill[:2], args.backfill[2:])
+  processor = LosProcessor(args.config)
+  processor.process(windows or None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+Benchmark of the LOS pipeline with synthetic AKTIN broker bundles.
+
+Generates bundles with a configurable number of clinics and cases, serves them
+through a local stub broker, runs LosProcessor end to end against a local SFTP
+server and appends the stage timings of its run report as JSON lines to a
+results file. Runs of different commits with the same scenario can be compared
+with --compare.
+
+  python test/benchmark/benchmark.py --clinics 10,50 --cases 20000 --engine python,r --repeat 3 --compare
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import toml
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+sys.path.append(str(Path(__file__).parent))
+from src.los_script import LosProcessor
+from stub_servers import StubBrokerServer, StubSftpServer
+
+ROOT = Path(__file__).resolve().parent.parent.parent
+TIMESTAMP_COLUMNS = ['aufnahme_ts', 'entlassung_ts', 'triage_ts']
+ID_COLUMNS = ['a_encounter_num', 'a_encounter_ide', 'a_billing_ide']
+
+
+def create_case_data(rng: np.random.Generator, cases: int, missing_column_rate: float, na_rate: float) -> bytes:
+  start = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), 's') - np.timedelta64(365, 'D')
+  aufnahme = start + rng.integers(0, 365 * 24 * 3600, cases).astype('timedelta64[s]')
+  columns = {
+    'aufnahme_ts': aufnahme,
+    'entlassung_ts': aufnahme + rng.integers(-5 * 60, 600 * 60, cases).astype('timedelta64[s]'),
+    'triage_ts': aufnahme + rng.integers(-20 * 60, 20 * 60, cases).astype('timedelta64[s]')
+  }
+  df = pd.DataFrame()
+  for column in TIMESTAMP_COLUMNS:
+    if rng.random() < missing_column_rate:
+      continue
+    values = np.char.add(np.datetime_as_string(columns[column], unit='s'), 'Z').astype(object)
+    values[rng.random(cases) < na_rate] = ''
+    df[column] = values
+  for column in ID_COLUMNS:
+    df[column] = np.arange(cases)
+  return df.to_csv(sep='\t', index=False).encode('utf-8')
+
+
+def create_bundle(clinics: int, cases: int, missing_column_rate: float, na_rate: float, seed: int) -> bytes:
+  rng = np.random.default_rng(seed)
+  bundle = io.BytesIO()
+  with zipfile.ZipFile(bundle, 'w', zipfile.ZIP_DEFLATED) as bundle_zip:
+    for clinic in range(1, clinics + 1):
+      clinic_zip = io.BytesIO()
+      with zipfile.ZipFile(clinic_zip, 'w', zipfile.ZIP_DEFLATED) as result_zip:
+        result_zip.writestr('case_data.txt', create_case_data(rng, cases, missing_column_rate, na_rate))
+      bundle_zip.writestr(f'{clinic}_result.zip', clinic_zip.getvalue())
+  return bundle.getvalue()
+
+
+def create_config(path: Path, broker: StubBrokerServer, sftp: StubSftpServer, clinics: int, engine: str, workers: int, report_path: Path):
+  config = {
+    'BROKER': {'URL': broker.url, 'API_KEY': 'benchmark'},
+    'REQUESTS': {'TAG': 'benchmark'},
+    'SFTP': {'HOST': '127.0.0.1', 'PORT': sftp.port, 'USERNAME': sftp.username, 'PASSWORD': sftp.password, 'TIMEOUT': 10,
+             'FOLDER': 'upload'},
+    'RSCRIPT': {'LOS_SCRIPT_PATH': str(ROOT / 'src/resources/LOSCalculator.R'), 'LOS_MAX': 410, 'ERROR_MAX': 25,
+                'CLINIC_NUMS': f'1-{clinics}', 'ENGINE': engine, 'WORKERS': workers},
+    'METRICS': {'REPORT_PATH': str(report_path)}
+  }
+  path.write_text(toml.dumps(config), encoding='utf-8')
+
+
+def run_pipeline(bundle: bytes, clinics: int, engine: str, workers: int) -> dict:
+  with tempfile.TemporaryDirectory(prefix='los_benchmark_') as tmp, StubBrokerServer(bundle) as broker, StubSftpServer(Path(tmp) / 'sftp') as sftp:
+    tmp = Path(tmp)
+    (tmp / 'sftp' / 'upload').mkdir(parents=True)
+    config_path, report_path = tmp / 'config.toml', tmp / 'run_report.json'
+    create_config(config_path, broker, sftp, clinics, engine, workers, report_path)
+    for key in [key for key in os.environ if key.split('.')[0] in ('BROKER', 'RSCRIPT', 'CACHE', 'STORE', 'METRICS')]:
+      del os.environ[key]
+    LosProcessor(config_path).process()
+    if not list((tmp / 'sftp' / 'upload').glob('*.zip')):
+      raise RuntimeError('No result archive was uploaded to the SFTP server')
+    return json.loads(report_path.read_text())
+
+
+def get_commit() -> str:
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    return commit + ('-dirty' if dirty else '')
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+
+def summarize(scenario: dict, reports: list[dict]) -> dict:
+  stage_names = [stage['stage'] for stage in reports[0]['stages']]
+  stages = {}
+  for name in stage_names:
+    runs = [next(stage for stage in report['stages'] if stage['stage'] == name) for report in reports]
+    stages[name] = {'duration_seconds': statistics.median(run['duration_seconds'] for run in runs)}
+    for key in ('bytes', 'rows'):
+      if key in runs[0]:
+        stages[name][key] = runs[0][key]
+  duration = statistics.median(report['duration_seconds'] for report in reports)
+  return {
+    'recorded_at': datetime.now(timezone.utc).isoformat(),
+    'commit': get_commit(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'scenario': scenario,
+    'repeat': len(reports),
+    'duration_seconds': duration,
+    'cases_per_second': round(scenario['clinics'] * scenario['cases'] / duration, 1),
+    'peak_rss_bytes': max(report['peak_rss_bytes'] for report in reports),
+    'critical_path': {
+      'stages': reports[0]['critical_path']['stages'],
+      'duration_seconds': statistics.median(report['critical_path']['duration_seconds'] for report in reports)
+    },
+    'stages': stages
+  }
+
+
+def find_baseline(results_path: Path, result: dict) -> dict:
+  baseline = None
+  if results_path.exists():
+    for line in results_path.read_text(encoding='utf-8').splitlines():
+      previous = json.loads(line)
+      if previous['scenario'] == result['scenario'] and previous['commit'] != result['commit']:
+        baseline = previous
+  return baseline
+
+
+def print_comparison(result: dict, baseline: dict):
+  print(f"\n{json.dumps(result['scenario'])}")
+  if baseline is None:
+    print('  no result of another commit with this scenario to compare with')
+  rows = [('total', result['duration_seconds'], baseline['duration_seconds'] if baseline else None)]
+  rows += [(name, stage['duration_seconds'], baseline['stages'].get(name, {}).get('duration_seconds') if baseline else None)
+           for name, stage in result['stages'].items()]
+  header = f"  {'stage':<45} {result['commit']:>14}"
+  print(header + (f" {baseline['commit']:>14} {'change':>8}" if baseline else ''))
+  for name, current, previous in rows:
+    line = f'  {name:<45} {current:>13.3f}s'
+    if previous:
+      line += f' {previous:>13.3f}s {(current - previous) / previous:>+8.1%}'
+    print(line)
+  print(f"  critical path: {' -> '.join(result['critical_path']['stages'])} ({result['critical_path']['duration_seconds']:.3f}s)")
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the LOS pipeline with synthetic broker bundles.')
+  parser.add_argument('--clinics', default='10', help='comma-separated clinic counts')
+  parser.add_argument('--cases', default='10000', help='comma-separated case counts per clinic')
+  parser.add_argument('--missing-column-rate', type=float, default=0.02, help='probability that a clinic lacks a timestamp column')
+  parser.add_argument('--na-rate', type=float, default=0.05, help='probability that a timestamp value is empty')
+  parser.add_argument('--engine', default='python', help='comma-separated LOS engines, "python" and/or "r"')
+  parser.add_argument('--workers', type=int, default=1, help='value of RSCRIPT.WORKERS')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per scenario, the median is recorded')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', type=Path, default=Path(__file__).parent / 'results.jsonl', help='JSON lines file the results are appended to')
+  parser.add_argument('--compare', action='store_true', help='compare with the last result of another commit for the same scenario')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+  engines = args.engine.split(',')
+  if 'r' in engines and shutil.which('Rscript') is None:
+    raise SystemExit('Rscript is not installed, run with --engine python')
+  for clinics in map(int, args.clinics.split(',')):
+    for cases in map(int, args.cases.split(',')):
+      bundle = create_bundle(clinics, cases, args.missing_column_rate, args.na_rate, args.seed)
+      for engine in engines:
+        scenario = {'clinics': clinics, 'cases': cases, 'missing_column_rate': args.missing_column_rate, 'na_rate': args.na_rate,
+                    'seed': args.seed, 'engine': engine, 'workers': args.workers, 'bundle_bytes': len(bundle)}
+        reports = [run_pipeline(bundle, clinics, engine, args.workers) for _ in range(args.repeat)]
+        result = summarize(scenario, reports)
+        baseline = find_baseline(args.output, result) if args.compare else None
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'a', encoding='utf-8') as f:
+          f.write(json.dumps(result) + '\n')
+        print_comparison(result, baseline)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import paramiko
+
+EXPORT_UUID = '4f1c2b3a-0d9e-4c8b-a7f6-5e4d3c2b1a09'
+
+
+class StubBrokerServer:
+  """Serves a prepared bundle through the AKTIN Broker endpoints used in bundle fetch mode."""
+
+  def __init__(self, bundle: bytes, request_id: int = 1):
+    self.bundle = bundle
+    self.request_id = request_id
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__create_handler())
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+  @property
+  def url(self) -> str:
+    return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def __create_handler(self):
+    broker = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, *args):
+        pass
+
+      def send_body(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+      def do_POST(self):
+        self.send_body(EXPORT_UUID.encode(), 'text/plain')
+
+      def do_GET(self):
+        if self.path.startswith('/broker/request/filtered'):
+          self.send_body(f'<requests><request id="{broker.request_id}"/></requests>'.encode(), 'application/xml')
+        elif self.path == f'/broker/download/{EXPORT_UUID}':
+          self.send_body(broker.bundle, 'application/zip')
+        else:
+          self.send_response(404)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+
+    return Handler
+
+
+class StubSftpServer:
+  """Local SSH server with a password-protected SFTP subsystem that stores files below a root directory."""
+
+  def __init__(self, root: Path, username: str = 'benchmark', password: str = 'benchmark'):
+    self.root = Path(root).resolve()
+    self.username = username
+    self.password = password
+    self.host_key = paramiko.RSAKey.generate(2048)
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(('127.0.0.1', 0))
+    self.socket.listen(16)
+    self.transports = []
+    self.thread = threading.Thread(target=self.__accept, daemon=True)
+
+  @property
+  def port(self) -> int:
+    return self.socket.getsockname()[1]
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.socket.close()
+    for transport in self.transports:
+      transport.close()
+
+  def __accept(self):
+    while True:
+      try:
+        connection, _ = self.socket.accept()
+      except OSError:
+        return
+      transport = paramiko.Transport(connection)
+      transport.add_server_key(self.host_key)
+      transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSftpInterface, self.root)
+      transport.start_server(server=PasswordServer(self.username, self.password))
+      self.transports.append(transport)
+
+
+class PasswordServer(paramiko.ServerInterface):
+
+  def __init__(self, username: str, password: str):
+    self.username = username
+    self.password = password
+
+  def check_channel_request(self, kind, chanid):
+    return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+  def check_auth_password(self, username, password):
+    return paramiko.AUTH_SUCCESSFUL if (username, password) == (self.username, self.password) else paramiko.AUTH_FAILED
+
+  def get_allowed_auths(self, username):
+    return 'password'
+
+
+class LocalSftpHandle(paramiko.SFTPHandle):
+
+  def stat(self):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class LocalSftpInterface(paramiko.SFTPServerInterface):
+
+  def __init__(self, server, root: Path, *args, **kwargs):
+    super().__init__(server, *args, **kwargs)
+    self.root = root
+
+  def local_path(self, path: str) -> Path:
+    return self.root / self.canonicalize(path).lstrip('/')
+
+  def list_folder(self, path):
+    try:
+      folder = self.local_path(path)
+      return [paramiko.SFTPAttributes.from_stat(entry.stat(), entry.name) for entry in folder.iterdir()]
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def stat(self, path):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def lstat(self, path):
+    try:
+      return paramiko.SFTPAttributes.from_stat(os.lstat(self.local_path(path)))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+
+  def open(self, path, flags, attr):
+    try:
+      fd = os.open(self.local_path(path), flags, getattr(attr, 'st_mode', None) or 0o644)
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    if flags & os.O_WRONLY:
+      mode = 'ab' if flags & os.O_APPEND else 'wb'
+    elif flags & os.O_RDWR:
+      mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+    else:
+      mode = 'rb'
+    handle = LocalSftpHandle(flags)
+    handle.readfile = handle.writefile = os.fdopen(fd, mode)
+    return handle
+
+  def remove(self, path):
+    try:
+      os.remove(self.local_path(path))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def rename(self, oldpath, newpath):
+    try:
+      os.rename(self.local_path(oldpath), self.local_path(newpath))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def posix_rename(self, oldpath, newpath):
+    try:
+      os.replace(self.local_path(oldpath), self.local_path(newpath))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
+
+  def mkdir(self, path, attr):
+    try:
+      os.mkdir(self.local_path(path))
+    except OSError as e:
+      return paramiko.SFTPServer.convert_errno(e.errno)
+    return paramiko.SFTP_OK
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from src.los_script import BrokerResultCache
+
+
+@pytest.fixture(autouse=True)
+def cache_env():
+  os.environ.update({'CACHE.MAX_SIZE_MB': '1', 'CACHE.MAX_AGE_DAYS': '1'})
+  yield
+  for key in ('CACHE.MAX_SIZE_MB', 'CACHE.MAX_AGE_DAYS'):
+    del os.environ[key]
+
+
+@pytest.fixture
+def cache(tmp_path: Path) -> BrokerResultCache:
+  return BrokerResultCache(tmp_path / 'cache')
+
+
+def create_bundle(path: Path, size: int = 1024) -> Path:
+  path.write_bytes(os.urandom(size))
+  return path
+
+
+def test_lookup_returns_bundle_for_unchanged_fingerprints(cache, tmp_path):
+  bundle = create_bundle(tmp_path / 'result1.zip')
+  cache.store('1', {'1': 'a', '2': 'b'}, bundle)
+  cached = cache.lookup('1', {'1': 'a', '2': 'b'})
+  assert cached.read_bytes() == bundle.read_bytes()
+
+
+def test_lookup_misses_for_changed_fingerprints(cache, tmp_path):
+  cache.store('1', {'1': 'a'}, create_bundle(tmp_path / 'result1.zip'))
+  assert cache.lookup('1', {'1': 'a', '2': 'b'}) is None
+  assert cache.lookup('2', {'1': 'a'}) is None
+
+
+def test_changed_nodes(cache, tmp_path):
+  cache.store('1', {'1': 'a', '2': 'b'}, create_bundle(tmp_path / 'result1.zip'))
+  assert cache.changed_nodes('1', {'1': 'a', '2': 'c', '3': 'd'}) == {'2', '3'}
+  assert cache.changed_nodes('5', {'1': 'a'}) == {'1'}
+
+
+def test_cached_bundle_survives_removal_of_source(cache, tmp_path):
+  bundle = create_bundle(tmp_path / 'result1.zip')
+  content = bundle.read_bytes()
+  cache.store('1', {'1': 'a'}, bundle)
+  bundle.unlink()
+  assert cache.lookup('1', {'1': 'a'}).read_bytes() == content
+
+
+def test_evicts_least_recently_used_entries_above_size_limit(cache, tmp_path):
+  for i in range(1, 4):
+    cache.store(str(i), {'1': 'a'}, create_bundle(tmp_path / f'result{i}.zip', size=400 * 1024))
+    time.sleep(0.01)
+  assert cache.lookup('1', {'1': 'a'}) is None
+  assert cache.lookup('2', {'1': 'a'}) is not None
+  assert cache.lookup('3', {'1': 'a'}) is not None
+
+
+def test_evicts_expired_entries(cache, tmp_path):
+  cache.store('1', {'1': 'a'}, create_bundle(tmp_path / 'result1.zip'))
+  manifest = tmp_path / 'cache' / '1' / 'manifest.json'
+  expired = time.time() - 2 * 86400
+  os.utime(manifest, (expired, expired))
+  cache.evict()
+  assert not (tmp_path / 'cache' / '1').exists()
+
+
+def test_evict_keeps_directories_without_manifest(cache, tmp_path):
+  case_data_dir = tmp_path / 'cache' / 'case_data'
+  case_data_dir.mkdir()
+  (case_data_dir / 'clinic.arrow').write_bytes(b'data')
+  cache.store('1', {'1': 'a'}, create_bundle(tmp_path / 'result1.zip'))
+  cache.evict()
+  assert (case_data_dir / 'clinic.arrow').exists()
+  assert cache.lookup('1', {'1': 'a'}) is not None
+
+
+def test_lookup_misses_for_changed_scope(cache, tmp_path):
+  scope = {'fetch_mode': 'nodes', 'clinic_nums': [1, 2]}
+  cache.store('1', {'1': 'a'}, create_bundle(tmp_path / 'result1.zip'), scope)
+  assert cache.lookup('1', {'1': 'a'}, {'fetch_mode': 'nodes', 'clinic_nums': [1, 2]}) is not None
+  assert cache.lookup('1', {'1': 'a'}, {'fetch_mode': 'nodes', 'clinic_nums': [1, 2, 3]}) is None
+  assert cache.lookup('1', {'1': 'a'}, {'fetch_mode': 'bundle', 'clinic_nums': None}) is None
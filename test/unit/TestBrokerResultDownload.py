@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import json
+import os
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from src.los_script import BrokerRequestResultManager
+
+REQUEST_ID = '42'
+EXPORT_UUID = 'd2c6a7a0-0000-4000-8000-000000000042'
+
+
+def create_clinic_result(clinic: int) -> bytes:
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(buffer, 'w') as zf:
+    zf.writestr('case_data.txt', f'aufnahme_ts\tentlassung_ts\ttriage_ts\t{clinic}\n' * 1000)
+  return buffer.getvalue()
+
+
+def create_bundle(clinic_count: int = 3) -> bytes:
+  """Creates an in-memory broker bundle with one nested result zip per clinic."""
+  buffer = io.BytesIO()
+  with zipfile.ZipFile(buffer, 'w') as zf:
+    for i in range(1, clinic_count + 1):
+      zf.writestr(f'{i}_result.zip', create_clinic_result(i))
+  return buffer.getvalue()
+
+
+class StubBroker:
+  """Minimal stand-in for the AKTIN Broker endpoints used by BrokerRequestResultManager."""
+
+  def __init__(self):
+    self.bundle = create_bundle()
+    self.break_download_after = None
+    self.break_download_count = 1
+    self.etag = '"bundle-v1"'
+    self.fail_listing_count = 0
+    self.pending_export_polls = 0
+    self.range_response = None
+    self.missing_export = False
+    self.unregistered_export_polls = 0
+    self.node_status = {'1': '2025-01-06T10:00:00Z', '2': '2025-01-06T11:00:00Z'}
+    self.requests = []
+    self.client_ports = set()
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__create_handler())
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+  @property
+  def url(self) -> str:
+    return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+  def __create_handler(self):
+    broker = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, *args):
+        pass
+
+      def log_request(self, *args):
+        broker.client_ports.add(self.client_address[1])
+
+      def send_empty_response(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+      def do_HEAD(self):
+        broker.requests.append(('HEAD', self.path, dict(self.headers)))
+        if self.path.startswith('/broker/download/') and broker.unregistered_export_polls > 0:
+          broker.unregistered_export_polls -= 1
+          self.send_empty_response(404)
+        elif self.path.startswith('/broker/download/') and broker.pending_export_polls > 0:
+          broker.pending_export_polls -= 1
+          self.send_empty_response(202)
+        elif self.path.startswith('/broker/download/') and broker.missing_export:
+          self.send_empty_response(404)
+        else:
+          self.send_empty_response(200)
+
+      def do_POST(self):
+        broker.requests.append(('POST', self.path, dict(self.headers)))
+        body = EXPORT_UUID.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def do_GET(self):
+        broker.requests.append(('GET', self.path, dict(self.headers)))
+        if self.path.startswith('/broker/request/filtered') and broker.fail_listing_count > 0:
+          broker.fail_listing_count -= 1
+          self.send_empty_response(503)
+        elif self.path.startswith('/broker/request/filtered'):
+          body = f'<requests><request id="1"/><request id="{REQUEST_ID}"/><request id="7"/></requests>'.encode()
+          self.send_response(200)
+          self.send_header('Content-Type', 'application/xml')
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+        elif self.path == f'/broker/request/{REQUEST_ID}/status':
+          entries = ''.join(f'<request-status-info><node>{node}</node><completed>{ts}</completed></request-status-info>'
+                            for node, ts in broker.node_status.items())
+          body = f'<request-status-list>{entries}</request-status-list>'.encode()
+          self.send_response(200)
+          self.send_header('Content-Type', 'application/xml')
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+        elif self.path == f'/aggregator/request/{REQUEST_ID}/result':
+          entries = ''.join(f'<result><request-id>{REQUEST_ID}</request-id><node-id>{node}</node-id><type>application/zip</type></result>'
+                            for node in broker.node_status)
+          body = f'<results>{entries}</results>'.encode()
+          self.send_response(200)
+          self.send_header('Content-Type', 'application/xml')
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+        elif self.path.startswith(f'/aggregator/request/{REQUEST_ID}/result/'):
+          body = create_clinic_result(int(self.path.rsplit('/', 1)[1]))
+          self.send_response(200)
+          self.send_header('Content-Type', 'application/zip')
+          self.send_header('Content-Length', str(len(body)))
+          self.end_headers()
+          self.wfile.write(body)
+        elif self.path == f'/broker/download/{EXPORT_UUID}':
+          self.__send_bundle()
+        else:
+          self.send_empty_response(404)
+
+      def __send_bundle(self):
+        body = broker.bundle
+        range_header = self.headers.get('Range')
+        if range_header and broker.range_response == 'unsatisfiable':
+          self.send_empty_response(416)
+          return
+        if range_header and self.headers.get('If-Range', broker.etag) == broker.etag:
+          offset = int(range_header.removeprefix('bytes=').rstrip('-'))
+          if broker.range_response == 'misaligned':
+            offset //= 2
+          self.send_response(206)
+          self.send_header('Content-Range', f'bytes {offset}-{len(body) - 1}/{len(body)}')
+          body = body[offset:]
+        else:
+          self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', broker.etag)
+        self.end_headers()
+        if broker.break_download_after is not None and broker.break_download_count > 0:
+          broker.break_download_count -= 1
+          self.wfile.write(body[:broker.break_download_after])
+          self.wfile.flush()
+          self.connection.shutdown(2)
+          return
+        self.wfile.write(body)
+
+    return Handler
+
+  def download_requests(self) -> list:
+    return [headers for method, path, headers in self.requests if method == 'GET' and path.startswith('/broker/download/')]
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+@pytest.fixture
+def stub_broker():
+  with StubBroker() as broker:
+    os.environ.update({
+      'BROKER.URL': broker.url,
+      'BROKER.API_KEY': 'xxxAdmin1234',
+      'REQUESTS.TAG': 'test',
+      'BROKER.BACKOFF_FACTOR': '0.01',
+      'BROKER.EXPORT_INTERVAL': '0.01',
+      'BROKER.EXPORT_DEADLINE': '5'
+    })
+    yield broker
+    for key in ('BROKER.BACKOFF_FACTOR', 'BROKER.EXPORT_INTERVAL', 'BROKER.EXPORT_DEADLINE'):
+      del os.environ[key]
+
+
+def test_download_streams_bundle_to_disk(stub_broker, tmp_path):
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.name == f'result{REQUEST_ID}.zip'
+  assert zip_path.read_bytes() == stub_broker.bundle
+  assert not list(tmp_path.glob('*.part'))
+
+
+def test_interrupted_download_leaves_no_result_file(stub_broker, tmp_path):
+  stub_broker.break_download_after = 1024
+  stub_broker.break_download_count = 10
+  with pytest.raises(Exception):
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert not (tmp_path / f'result{REQUEST_ID}.zip').exists()
+  assert (tmp_path / f'result{REQUEST_ID}.zip.part').exists()
+  assert (tmp_path / f'result{REQUEST_ID}.zip.part.json').exists()
+
+
+def test_interrupted_download_is_resumed_with_range_request(stub_broker, tmp_path):
+  stub_broker.break_download_after = 80000
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+  download_headers = stub_broker.download_requests()
+  assert len(download_headers) == 2
+  assert download_headers[1]['Range'] not in (None, 'bytes=0-')
+  assert download_headers[1]['If-Range'] == stub_broker.etag
+  assert not (tmp_path / f'result{REQUEST_ID}.zip.part.json').exists()
+
+
+def test_partial_download_of_previous_run_is_resumed(stub_broker, tmp_path):
+  stub_broker.bundle = create_bundle(clinic_count=10)
+  stub_broker.break_download_after = 80000
+  stub_broker.break_download_count = 10
+  with pytest.raises(Exception):
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  stub_broker.break_download_count = 0
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+
+
+def test_changed_bundle_restarts_download(stub_broker, tmp_path):
+  stub_broker.bundle = create_bundle(clinic_count=10)
+  stub_broker.break_download_after = 80000
+  stub_broker.break_download_count = 10
+  with pytest.raises(Exception):
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  stub_broker.break_download_count = 0
+  stub_broker.bundle = create_bundle(clinic_count=4)
+  stub_broker.etag = '"bundle-v2"'
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+
+
+def create_partial_download(stub_broker, tmp_path: Path, uuid: str = EXPORT_UUID, size: int = 1000):
+  (tmp_path / f'result{REQUEST_ID}.zip.part').write_bytes(stub_broker.bundle[:size])
+  state = {'uuid': uuid, 'validator': stub_broker.etag, 'length': len(stub_broker.bundle), 'digest': None}
+  (tmp_path / f'result{REQUEST_ID}.zip.part.json').write_text(json.dumps(state))
+
+
+@pytest.mark.parametrize('range_response', ['unsatisfiable', 'misaligned'])
+def test_unusable_range_response_restarts_download(stub_broker, tmp_path, range_response):
+  create_partial_download(stub_broker, tmp_path)
+  stub_broker.range_response = range_response
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+  download_headers = stub_broker.download_requests()
+  assert [headers.get('Range') for headers in download_headers] == ['bytes=1000-', None]
+
+
+def test_partial_download_of_other_export_is_not_resumed(stub_broker, tmp_path):
+  create_partial_download(stub_broker, tmp_path, uuid='00000000-0000-4000-8000-000000000000')
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+  assert [headers.get('Range') for headers in stub_broker.download_requests()] == [None]
+
+
+def test_corrupt_bundle_is_rejected(stub_broker, tmp_path):
+  stub_broker.bundle = b'this is not a zip archive'
+  with pytest.raises(RuntimeError, match='corrupt'):
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert not list(tmp_path.iterdir())
+
+
+def test_broker_calls_reuse_one_connection(stub_broker, tmp_path):
+  BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert len(stub_broker.requests) == 5
+  assert len(stub_broker.client_ports) == 1
+
+
+def test_idempotent_call_is_retried_on_server_error(stub_broker, tmp_path):
+  stub_broker.fail_listing_count = 2
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.exists()
+  listing_calls = [path for method, path, headers in stub_broker.requests if path.startswith('/broker/request/filtered')]
+  assert len(listing_calls) == 3
+
+
+def test_download_waits_until_export_is_ready(stub_broker, tmp_path):
+  stub_broker.pending_export_polls = 3
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+  polls = [path for method, path, headers in stub_broker.requests if method == 'HEAD' and path.startswith('/broker/download/')]
+  assert len(polls) == 4
+  exports = [path for method, path, headers in stub_broker.requests if method == 'POST']
+  assert len(exports) == 1
+
+
+def test_export_not_ready_before_deadline(stub_broker, tmp_path):
+  os.environ['BROKER.EXPORT_DEADLINE'] = '0.1'
+  stub_broker.pending_export_polls = 1000
+  with pytest.raises(RuntimeError, match='not ready'):
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert not list(tmp_path.iterdir())
+
+
+def export_polls(stub_broker) -> int:
+  return len([path for method, path, headers in stub_broker.requests if method == 'HEAD' and path.startswith('/broker/download/')])
+
+
+def test_unknown_export_fails_after_grace_period(stub_broker, tmp_path):
+  os.environ['BROKER.EXPORT_404_GRACE'] = '0.1'
+  stub_broker.missing_export = True
+  try:
+    with pytest.raises(RuntimeError, match='not found'):
+      BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  finally:
+    del os.environ['BROKER.EXPORT_404_GRACE']
+  assert 1 < export_polls(stub_broker) < 100
+
+
+def test_export_not_yet_registered_is_awaited(stub_broker, tmp_path):
+  stub_broker.unregistered_export_polls = 5
+  stub_broker.pending_export_polls = 2
+  zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert zip_path.read_bytes() == stub_broker.bundle
+  assert export_polls(stub_broker) == 8
+
+
+def test_export_missing_after_registration_fails_immediately(stub_broker, tmp_path):
+  stub_broker.pending_export_polls = 2
+  stub_broker.missing_export = True
+  with pytest.raises(RuntimeError, match='not found'):
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  assert export_polls(stub_broker) == 3
+
+
+def test_unchanged_request_is_served_from_cache(stub_broker, tmp_path):
+  os.environ['CACHE.DIR'] = str(tmp_path / 'cache')
+  try:
+    first = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    first.unlink()
+    second = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    assert second.read_bytes() == stub_broker.bundle
+    exports = [path for method, path, headers in stub_broker.requests if method == 'POST']
+    assert len(exports) == 1
+    stub_broker.node_status['3'] = '2025-01-07T09:00:00Z'
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    exports = [path for method, path, headers in stub_broker.requests if method == 'POST']
+    assert len(exports) == 2
+  finally:
+    del os.environ['CACHE.DIR']
+
+
+def test_latest_request_ids_are_streamed_from_listing(stub_broker):
+  manager = BrokerRequestResultManager()
+  assert manager.get_latest_request_ids(1) == [int(REQUEST_ID)]
+  assert manager.get_latest_request_ids(2) == [int(REQUEST_ID), 7]
+  assert manager.get_latest_request_ids(10) == [int(REQUEST_ID), 7, 1]
+
+
+def node_result_requests(stub_broker) -> list:
+  return sorted(path.rsplit('/', 1)[1] for method, path, headers in stub_broker.requests
+                if path.startswith(f'/aggregator/request/{REQUEST_ID}/result/'))
+
+
+def test_node_fetch_mode_downloads_whitelisted_clinics(stub_broker, tmp_path):
+  stub_broker.node_status = {'1': 'a', '2': 'b', '3': 'c', '9': 'd'}
+  os.environ.update({'BROKER.FETCH_MODE': 'nodes', 'RSCRIPT.CLINIC_NUMS': '1,3,9'})
+  try:
+    zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  finally:
+    del os.environ['BROKER.FETCH_MODE'], os.environ['RSCRIPT.CLINIC_NUMS']
+  with zipfile.ZipFile(zip_path) as zf:
+    assert sorted(zf.namelist()) == ['1_result.zip', '3_result.zip', '9_result.zip']
+    with zipfile.ZipFile(io.BytesIO(zf.read('3_result.zip'))) as clinic_zf:
+      assert clinic_zf.read('case_data.txt').startswith(b'aufnahme_ts')
+  assert node_result_requests(stub_broker) == ['1', '3', '9']
+  assert not [method for method, path, headers in stub_broker.requests if method == 'POST']
+  assert sorted(p.name for p in tmp_path.iterdir()) == [zip_path.name]
+
+
+def test_node_fetch_mode_only_fetches_changed_nodes(stub_broker, tmp_path):
+  os.environ.update({'BROKER.FETCH_MODE': 'nodes', 'CACHE.DIR': str(tmp_path / 'cache')})
+  try:
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    stub_broker.node_status['2'] = '2025-01-08T08:00:00Z'
+    stub_broker.node_status['3'] = '2025-01-08T09:00:00Z'
+    zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+  finally:
+    del os.environ['BROKER.FETCH_MODE'], os.environ['CACHE.DIR']
+  with zipfile.ZipFile(zip_path) as zf:
+    assert sorted(zf.namelist()) == ['1_result.zip', '2_result.zip', '3_result.zip']
+  assert node_result_requests(stub_broker) == ['1', '2', '2', '3']
+
+
+def test_widened_node_whitelist_is_not_served_from_cache(stub_broker, tmp_path):
+  stub_broker.node_status = {'1': 'a', '2': 'b', '3': 'c'}
+  os.environ.update({'BROKER.FETCH_MODE': 'nodes', 'CACHE.DIR': str(tmp_path / 'cache'), 'RSCRIPT.CLINIC_NUMS': '1,2'})
+  try:
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    os.environ['RSCRIPT.CLINIC_NUMS'] = '1,2,3'
+    zip_path = BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    with zipfile.ZipFile(zip_path) as zf:
+      assert sorted(zf.namelist()) == ['1_result.zip', '2_result.zip', '3_result.zip']
+    assert node_result_requests(stub_broker) == ['1', '2', '3']
+    os.environ['BROKER.FETCH_MODE'] = 'bundle'
+    BrokerRequestResultManager().download_latest_broker_result_by_set_tag(tmp_path)
+    assert len([method for method, path, headers in stub_broker.requests if method == 'POST']) == 1
+  finally:
+    del os.environ['BROKER.FETCH_MODE'], os.environ['CACHE.DIR'], os.environ['RSCRIPT.CLINIC_NUMS']
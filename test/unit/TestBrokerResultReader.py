@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from src.los_script import BrokerResultReader
+
+
+@pytest.fixture
+def bundle_path(tmp_path: Path) -> Path:
+  clinics = {
+    1: "aufnahme_ts\tentlassung_ts\ttriage_ts\ta_encounter_num\n"
+       "2023-07-28T21:55:36Z\t2023-07-28T23:02:49Z\t2023-07-28T21:58:08Z\t4\n"
+       " 2023-07-28T22:21:09Z \t2023-07-28T23:37:27Z\t\t5\n",
+    2: "triage_ts\tentlassung_ts\n"
+       "2023-07-28T21:58:08Z\t2023-07-28T23:02:49Z\n",
+    3: "aufnahme_ts\ttriage_ts\n"
+       "2023-07-28T21:55:36Z\t2023-07-28T21:58:08Z\n",
+    4: "aufnahme_ts\tentlassung_ts\ttriage_ts\n"
+       "2023-07-28T21:55:36Z\t2023-07-28T23:02:49Z\t2023-07-28T21:58:08Z\n",
+  }
+  path = tmp_path / 'result1.zip'
+  with zipfile.ZipFile(path, 'w') as zf:
+    for clinic, case_data in clinics.items():
+      buffer = io.BytesIO()
+      with zipfile.ZipFile(buffer, 'w') as clinic_zf:
+        clinic_zf.writestr('case_data.txt', case_data)
+      zf.writestr(f'{clinic}_result.zip', buffer.getvalue())
+  return path
+
+
+def test_iterate_case_data_only_reads_whitelisted_clinics(bundle_path):
+  reader = BrokerResultReader([1, 4, 7])
+  clinics = [clinic for clinic, case_data in reader.iterate_case_data(bundle_path)]
+  assert clinics == [1, 4]
+
+
+def test_list_clinics_and_read_single_clinic(bundle_path):
+  reader = BrokerResultReader([1, 4, 7])
+  assert reader.list_clinics(bundle_path) == [1, 4]
+  assert BrokerResultReader.read_case_data(bundle_path, 4).startswith(b'aufnahme_ts\tentlassung_ts')
+
+
+def test_iterate_timestamp_rows_normalizes_columns(bundle_path):
+  reader = BrokerResultReader([1, 2, 3])
+  rows = list(reader.iterate_timestamp_rows(bundle_path))
+  assert rows == [
+    ['1', '2023-07-28T21:55:36Z', '2023-07-28T23:02:49Z', '2023-07-28T21:58:08Z'],
+    ['1', '2023-07-28T22:21:09Z', '2023-07-28T23:37:27Z', ''],
+    ['2', '', '2023-07-28T23:02:49Z', '2023-07-28T21:58:08Z'],
+  ]
+
+
+def test_nothing_is_extracted_to_disk(bundle_path):
+  reader = BrokerResultReader([1, 2, 3, 4])
+  list(reader.iterate_timestamp_rows(bundle_path))
+  assert [p.name for p in bundle_path.parent.iterdir()] == [bundle_path.name]
@@ -85,7 +85,7 @@ def cleanup_env():
   Clean up environment variables after each test
   """
   yield
-  env_prefixes = ['BROKER', 'REQUESTS', 'SFTP', 'MISC', 'RSCRIPT']
+  env_prefixes = ['BROKER', 'REQUESTS', 'SFTP', 'MISC', 'RSCRIPT', 'PUBLISH']
   keys_to_remove = [key for key in os.environ if any(key.startswith(prefix) for prefix in env_prefixes) or key == 'REQUESTS_CA_BUNDLE']
   for key in keys_to_remove:
     del os.environ[key]
@@ -113,3 +113,27 @@ def test_missing_file_raises_error():
 def test_missing_required_keys_raises_error(config_paths):
   with pytest.raises(SystemExit, match='Missing keys in config file'):
     ConfigurationManager(config_paths['invalid'])
+
+
+def test_optional_rscript_keys_are_loaded(valid_toml_content, tmp_path):
+  path = tmp_path / 'worker.toml'
+  path.write_text(valid_toml_content + 'WORKER = true\nJOB_TIMEOUT = 5\n')
+  ConfigurationManager(path)
+  assert os.environ['RSCRIPT.WORKER'] == 'True'
+  assert os.environ['RSCRIPT.JOB_TIMEOUT'] == '5'
+
+
+def test_publish_target_sections_are_loaded(valid_toml_content, tmp_path):
+  path = tmp_path / 'publish.toml'
+  path.write_text(valid_toml_content + """
+[PUBLISH]
+TARGETS = ["archive", "objects"]
+
+[PUBLISH.archive]
+TYPE = "local"
+DIR = "/srv/los"
+""")
+  ConfigurationManager(path)
+  assert os.environ['PUBLISH.TARGETS'] == 'archive,objects'
+  assert os.environ['PUBLISH.archive.TYPE'] == 'local'
+  assert os.environ['PUBLISH.archive.DIR'] == '/srv/los'
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import os
+import random
+import shutil
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+
+sys.path.append(str(Path(__file__).parent.parent.parent))
+from src.los_script import CaseDataCache, LosAggregateStore, LosCalculator, LosResultFileManager, LosScriptManager
+
+HEADER = "aufnahme_ts\tentlassung_ts\ttriage_ts\ta_encounter_num\ta_encounter_ide\ta_billing_ide\n"
+
+
+@pytest.fixture(scope="function", autouse=True)
+def setup_env():
+  os.environ.update({
+    'RSCRIPT.LOS_SCRIPT_PATH': str(Path(__file__).parent.parent.parent / 'src/resources/LOSCalculator.R'),
+    'RSCRIPT.LOS_MAX': "410",
+    'RSCRIPT.ERROR_MAX': "25",
+    'RSCRIPT.CLINIC_NUMS': "1,2,3,4,5",
+  })
+
+
+@pytest.fixture(scope="function")
+def los_calculator():
+  return LosCalculator()
+
+
+@pytest.fixture(scope="function")
+def test_zip_path(tmp_path: Path) -> Path:
+  return tmp_path / "test.zip"
+
+
+@pytest.fixture(scope="function")
+def start_end_cw() -> tuple[str, str, str, str]:
+  return "2023", "30", "2023", "30"
+
+
+@pytest.fixture
+def standard_test_data() -> str:
+  return (HEADER +
+          "2023-07-28T21:55:36Z\t2023-07-28T23:02:49Z\t2023-07-28T21:58:08Z\t4\t4\t4\n"
+          "2023-07-28T22:21:09Z\t2023-07-28T23:37:27Z\t2023-07-28T22:21:49Z\t5\t5\t5\n"
+          "2023-07-28T23:46:09Z\t2023-07-29T00:55:15Z\t2023-07-28T23:47:20Z\t6\t6\t6")
+
+
+@pytest.fixture
+def standard_expected_data() -> callable:
+  def _expected(ed_count: str) -> list[list[str]]:
+    return [["date", "ed_count", "visit_mean", "los_mean", "los_reference", "los_difference", "change"],
+            ["2023-W30", ed_count, "3", "70.87", "193.54", "-122.66", "Abnahme"]]
+
+  return _expected
+
+
+def create_test_zip(zip_path: Path, test_data: list[str]) -> Path:
+  """Creates a broker bundle with one nested <n>_result.zip containing a case_data.txt per clinic."""
+  with zipfile.ZipFile(zip_path, "w") as zf:
+    for i, clinic_data in enumerate(test_data):
+      clinic_zip_name = f"{i + 1}_result.zip"
+      clinic_zip_path = zip_path.parent / clinic_zip_name
+      with zipfile.ZipFile(clinic_zip_path, "w") as clinic_zf:
+        clinic_zf.writestr("case_data.txt", clinic_data)
+      zf.write(clinic_zip_path, clinic_zip_name)
+  return zip_path
+
+
+def create_random_case_data(seed: int, rows: int) -> str:
+  rng = random.Random(seed)
+  start = datetime(2023, 6, 1, tzinfo=timezone.utc)
+  lines = [HEADER.rstrip('\n')]
+  for i in range(rows):
+    aufnahme = start + timedelta(minutes=rng.randint(0, 60 * 24 * 70))
+    triage = aufnahme + timedelta(minutes=rng.randint(-20, 20))
+    entlassung = aufnahme + timedelta(minutes=rng.randint(-5, 600))
+    fields = [aufnahme.strftime('%Y-%m-%dT%H:%M:%SZ'), entlassung.strftime('%Y-%m-%dT%H:%M:%SZ'), triage.strftime('%Y-%m-%dT%H:%M:%SZ')]
+    fields = ['' if rng.random() < 0.05 else field for field in fields]
+    lines.append('\t'.join(fields + [str(i)] * 3))
+  return '\n'.join(lines)
+
+
+def calculate(engine, zip_path: Path, start_end_cw: tuple[str, str, str, str]) -> pd.DataFrame:
+  timeframe = engine.calculate_timeframe(zip_path, *start_end_cw)
+  return pd.read_csv(io.StringIO(LosResultFileManager.format_result_csv(timeframe)))
+
+
+def compare_results(los_calculator: LosCalculator, zip_path: Path, start_end_cw: tuple[str, str, str, str], test_data: list[str],
+    expected_data: list[list[str]]) -> bool:
+  zip_path = create_test_zip(zip_path, test_data)
+  actual_df = calculate(los_calculator, zip_path, start_end_cw)
+  expected_df = pd.DataFrame(expected_data[1:], columns=expected_data[0])
+  return actual_df.astype(str).equals(expected_df)
+
+
+def test_single_clinic(los_calculator, test_zip_path, start_end_cw, standard_test_data, standard_expected_data):
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, [standard_test_data], standard_expected_data("1"))
+
+
+def test_multiple_clinics(los_calculator, test_zip_path, start_end_cw, standard_test_data, standard_expected_data):
+  test_data = [standard_test_data, standard_test_data]
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, test_data, standard_expected_data("2"))
+
+
+def test_missing_values_in_aufnahme_ts(los_calculator, test_zip_path, start_end_cw, standard_expected_data):
+  test_data = [HEADER +
+               "2023-07-28T21:55:36Z\t2023-07-28T23:02:49Z\t\t4\t4\t4\n"
+               "2023-07-28T22:21:09Z\t2023-07-28T23:37:27Z\t2023-07-28T22:21:49Z\t5\t5\t5\n"
+               "2023-07-28T23:46:09Z\t2023-07-29T00:55:15Z\t2023-07-28T23:47:20Z\t6\t6\t6"]
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, test_data, standard_expected_data("1"))
+
+
+def test_completely_missing_values_in_aufnahme_ts(los_calculator, test_zip_path, start_end_cw, standard_expected_data):
+  test_data = [HEADER +
+               "\t2023-07-28T23:02:49Z\t2023-07-28T21:55:36Z\t4\t4\t4\n"
+               "\t2023-07-28T23:37:27Z\t2023-07-28T22:21:09Z\t5\t5\t5\n"
+               "\t2023-07-29T00:55:15Z\t2023-07-28T23:46:09Z\t6\t6\t6"]
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, test_data, standard_expected_data("1"))
+
+
+def test_no_column_aufnahme_ts(los_calculator, test_zip_path, start_end_cw, standard_expected_data):
+  test_data = ["entlassung_ts\ttriage_ts\ta_encounter_num\ta_encounter_ide\ta_billing_ide\n"
+               "2023-07-28T23:02:49Z\t2023-07-28T21:55:36Z\t4\t4\t4\n"
+               "2023-07-28T23:37:27Z\t2023-07-28T22:21:09Z\t5\t5\t5\n"
+               "2023-07-29T00:55:15Z\t2023-07-28T23:46:09Z\t6\t6\t6"]
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, test_data, standard_expected_data("1"))
+
+
+def test_no_column_entlassung_ts(los_calculator, test_zip_path, start_end_cw):
+  test_data = ["triage_ts\ta_encounter_num\ta_encounter_ide\ta_billing_ide\n"
+               "2023-07-28T21:55:36Z\t4\t4\t4\n"
+               "2023-07-28T22:21:09Z\t5\t5\t5\n"
+               "2023-07-28T23:46:09Z\t6\t6\t6"]
+  expected = [["message"], ["Error: No Data found in case_data files!"]]
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, test_data, expected)
+
+
+def test_turn_of_the_year(los_calculator, test_zip_path):
+  test_data = [HEADER +
+               "2023-12-31T21:55:36Z\t2023-12-31T23:02:49Z\t2023-12-31T21:58:08Z\t4\t4\t4\n"
+               "2023-12-31T22:21:09Z\t2023-12-31T23:37:27Z\t2023-12-31T22:21:49Z\t5\t5\t5\n"
+               "2023-12-31T23:46:09Z\t2024-01-01T00:55:15Z\t2023-12-31T23:47:20Z\t6\t6\t6"]
+  expected = [["date", "ed_count", "visit_mean", "los_mean", "los_reference", "los_difference", "change"],
+              ["2023-W52", "1", "3", "70.87", "193.54", "-122.66", "Abnahme"]]
+  assert compare_results(los_calculator, test_zip_path, ("2023", "50", "2024", "03"), test_data, expected)
+
+
+def test_clinic_nodata(los_calculator, test_zip_path, start_end_cw, standard_test_data, standard_expected_data):
+  test_data = [standard_test_data, HEADER]
+  assert compare_results(los_calculator, test_zip_path, start_end_cw, test_data, standard_expected_data("1"))
+
+
+def test_clinics_outside_whitelist_are_ignored(los_calculator, test_zip_path, start_end_cw, standard_test_data, standard_expected_data):
+  os.environ['RSCRIPT.CLINIC_NUMS'] = '2'
+  test_data = [standard_test_data, standard_test_data]
+  assert compare_results(LosCalculator(), test_zip_path, start_end_cw, test_data, standard_expected_data("1"))
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='Rscript is not installed')
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_parity_with_r_engine(los_calculator, tmp_path, seed):
+  test_data = [create_random_case_data(seed * 10 + clinic, 400) for clinic in range(5)]
+  window = ("2023", "22", "2023", "33")
+  (tmp_path / 'python').mkdir()
+  (tmp_path / 'r').mkdir()
+  python_zip = create_test_zip(tmp_path / 'python' / 'test.zip', test_data)
+  r_zip = create_test_zip(tmp_path / 'r' / 'test.zip', test_data)
+  python_df = calculate(los_calculator, python_zip, window)
+  r_df = calculate(LosScriptManager(), r_zip, window)
+  pd.testing.assert_frame_equal(python_df, r_df)
+
+
+def test_parallel_preprocessing_matches_sequential(tmp_path):
+  test_data = [create_random_case_data(seed, 300) for seed in range(5)]
+  window = ("2023", "22", "2023", "33")
+  (tmp_path / 'sequential').mkdir()
+  (tmp_path / 'parallel').mkdir()
+  sequential_zip = create_test_zip(tmp_path / 'sequential' / 'test.zip', test_data)
+  parallel_zip = create_test_zip(tmp_path / 'parallel' / 'test.zip', test_data)
+  sequential_df = calculate(LosCalculator(), sequential_zip, window)
+  os.environ['RSCRIPT.WORKERS'] = '3'
+  try:
+    parallel_df = calculate(LosCalculator(), parallel_zip, window)
+  finally:
+    del os.environ['RSCRIPT.WORKERS']
+  assert len(sequential_df) > 0
+  pd.testing.assert_frame_equal(sequential_df, parallel_df)
+
+
+@pytest.mark.parametrize('workers', ['1', '2'])
+def test_case_data_cache_skips_parsing_on_rerun(tmp_path, standard_test_data, standard_expected_data, start_end_cw, workers):
+  os.environ.update({'CACHE.CASE_DATA_DIR': str(tmp_path / 'cache'), 'RSCRIPT.WORKERS': workers})
+  try:
+    test_data = [standard_test_data] * 4
+    (tmp_path / 'first').mkdir()
+    (tmp_path / 'second').mkdir()
+    assert compare_results(LosCalculator(), tmp_path / 'first' / 'test.zip', start_end_cw, test_data, standard_expected_data("4"))
+    assert len(list((tmp_path / 'cache').glob('*.arrow'))) == 4
+    with patch.object(LosCalculator, 'parse_case_data', side_effect=AssertionError('case data was parsed again')):
+      os.environ['RSCRIPT.WORKERS'] = '1'
+      assert compare_results(LosCalculator(), tmp_path / 'second' / 'test.zip', start_end_cw, test_data, standard_expected_data("4"))
+  finally:
+    del os.environ['CACHE.CASE_DATA_DIR'], os.environ['RSCRIPT.WORKERS']
+
+
+def test_process_pool_is_kept_between_calculations(tmp_path, standard_test_data, standard_expected_data, start_end_cw):
+  os.environ['RSCRIPT.WORKERS'] = '2'
+  calculator = LosCalculator()
+  try:
+    with patch('src.los_script.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+      calculator.prepare()
+      for run in ('first', 'second'):
+        (tmp_path / run).mkdir()
+        assert compare_results(calculator, tmp_path / run / 'test.zip', start_end_cw, [standard_test_data] * 4, standard_expected_data("4"))
+      assert pool.call_count == 1
+  finally:
+    calculator.close()
+    del os.environ['RSCRIPT.WORKERS']
+
+
+def test_few_clinics_are_prepared_in_process(test_zip_path, standard_test_data, standard_expected_data, start_end_cw):
+  os.environ['RSCRIPT.WORKERS'] = '2'
+  calculator = LosCalculator()
+  try:
+    with patch('src.los_script.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+      assert compare_results(calculator, test_zip_path, start_end_cw, [standard_test_data] * 2, standard_expected_data("2"))
+      assert pool.call_count == 0
+  finally:
+    calculator.close()
+    del os.environ['RSCRIPT.WORKERS']
+
+
+def test_case_data_cache_key_depends_on_content_and_clinic():
+  assert CaseDataCache.create_key(b'a', 1) == CaseDataCache.create_key(b'a', 1)
+  assert CaseDataCache.create_key(b'a', 1) != CaseDataCache.create_key(b'b', 1)
+  assert CaseDataCache.create_key(b'a', 1) != CaseDataCache.create_key(b'a', 2)
+
+
+@pytest.mark.parametrize('workers', ['1', '2'])
+def test_aggregate_store_matches_row_based_analysis(tmp_path, workers):
+  test_data = [create_random_case_data(seed, 300) for seed in range(5)]
+  window = ("2023", "22", "2023", "33")
+  (tmp_path / 'rows').mkdir()
+  (tmp_path / 'store').mkdir()
+  expected_df = calculate(LosCalculator(), create_test_zip(tmp_path / 'rows' / 'test.zip', test_data), window)
+  os.environ.update({'STORE.PATH': str(tmp_path / 'aggregates.db'), 'RSCRIPT.WORKERS': workers})
+  try:
+    actual_df = calculate(LosCalculator(), create_test_zip(tmp_path / 'store' / 'test.zip', test_data), window)
+  finally:
+    del os.environ['STORE.PATH'], os.environ['RSCRIPT.WORKERS']
+  assert len(expected_df) > 0
+  pd.testing.assert_frame_equal(expected_df, actual_df)
+
+
+def test_aggregate_store_only_parses_changed_clinics(tmp_path, standard_test_data, standard_expected_data, start_end_cw):
+  os.environ['STORE.PATH'] = str(tmp_path / 'aggregates.db')
+  try:
+    for run in ('first', 'second', 'third'):
+      (tmp_path / run).mkdir()
+    assert compare_results(LosCalculator(), tmp_path / 'first' / 'test.zip', start_end_cw, [standard_test_data] * 3, standard_expected_data("3"))
+    with patch.object(LosCalculator, 'parse_case_data', side_effect=AssertionError('case data was parsed again')):
+      assert compare_results(LosCalculator(), tmp_path / 'second' / 'test.zip', start_end_cw, [standard_test_data] * 3, standard_expected_data("3"))
+    with patch.object(LosCalculator, 'parse_case_data', wraps=LosCalculator.parse_case_data) as parse:
+      assert compare_results(LosCalculator(), tmp_path / 'third' / 'test.zip', start_end_cw, [standard_test_data, standard_test_data + "\n"],
+                             standard_expected_data("2"))
+      assert parse.call_count == 1
+    store = LosAggregateStore(tmp_path / 'aggregates.db')
+    assert set(store.content_hashes()) == {1, 2}
+    aggregates = store.load_aggregates()
+    assert aggregates[['total_rows', 'invalid_rows', 'case_count']].sum().tolist() == [6, 0, 6]
+  finally:
+    del os.environ['STORE.PATH']
+
+
+def test_window_without_data_returns_header_only(los_calculator, test_zip_path, standard_test_data):
+  zip_path = create_test_zip(test_zip_path, [standard_test_data])
+  timeframe = los_calculator.calculate_timeframe(zip_path, "2024", "01", "2024", "04")
+  assert timeframe.empty
+  assert list(timeframe.columns) == LosResultFileManager.result_columns
@@ -25,6 +25,7 @@ import zipfile
 from pathlib import Path
 from unittest.mock import patch
 
+import pandas as pd
 import pytest
 
 from src.los_script import LosResultFileManager
@@ -44,15 +45,16 @@ def test_file(tmp_path: Path) -> Path:
   return test_file
 
 
-@patch("datetime.datetime", wraps=datetime.datetime)
-def test_rename_result_file_to_standardized_form(mock_datetime, result_manager, test_file):
-  # Set a fixed datetime (January 1, 2025, CW=2)
+def test_create_standardized_name():
+  # Fixed datetime (January 7, 2025, CW=2), default window ends with the previous week
   fixed_datetime = datetime.datetime(2025, 1, 7, 12, 30, 45)
-  mock_datetime.now.return_value = fixed_datetime
-  new_file_path = result_manager.rename_result_file_to_standardized_form(test_file)
-  expected_filename = "LOS_2024-W50_to_2025-W01_20250107-123045.csv"
-  assert new_file_path.name == expected_filename
-  assert new_file_path.exists()
+  assert LosResultFileManager().create_standardized_name(now=fixed_datetime) == "LOS_2024-W50_to_2025-W01_20250107-123045"
+
+
+@patch("datetime.datetime", wraps=datetime.datetime)
+def test_create_standardized_name_with_explicit_window(mock_datetime, result_manager):
+  mock_datetime.now.return_value = datetime.datetime(2025, 1, 7, 12, 30, 45)
+  assert result_manager.create_standardized_name((2023, 50, 2024, 1)) == "LOS_2023-W50_to_2024-W01_20250107-123045"
 
 
 def test_clear_rscript_data(result_manager, test_file):
@@ -62,12 +64,40 @@ def test_clear_rscript_data(result_manager, test_file):
   assert not parent_dir.exists()
 
 
-def test_zip_result_file(result_manager, test_file):
-  zip_path = result_manager.zip_result_file(test_file)
-  assert zip_path.exists()
-  assert zip_path.suffix == '.zip'
+def test_calculate_rolling_windows_across_year_boundary(result_manager):
+  windows = result_manager.calculate_rolling_windows((2020, 52), (2021, 2))
+  assert windows == [(2020, 49, 2020, 52), (2020, 50, 2020, 53), (2020, 51, 2021, 1), (2020, 52, 2021, 2)]
+  assert result_manager.calculate_enclosing_window(windows) == (2020, 49, 2021, 2)
+
+
+def test_write_result_archives_from_timeframe(result_manager, tmp_path):
+  timeframe = pd.DataFrame({
+    'date': [f"2024-W{week:02d}" for week in range(1, 9)], 'ed_count': [3] * 8, 'visit_mean': [10.5] * 8, 'los_mean': [180.12] * 8,
+    'los_reference': [193.54] * 8, 'los_difference': [-13.42] * 8, 'change': ['Abnahme'] * 8
+  })
+  windows = [(2024, 1, 2024, 4), (2024, 5, 2024, 8)]
+  paths = result_manager.write_result_archives(timeframe, windows, tmp_path / "broker_result")
+  for path, (_, start_week, _, end_week) in zip(paths, windows):
+    assert path.name.startswith(f"LOS_2024-W{start_week:02d}_to_2024-W{end_week:02d}_")
+    with zipfile.ZipFile(path) as zf:
+      assert zf.namelist() == [f"{path.stem}/{path.stem}.csv"]
+      lines = zf.read(zf.namelist()[0]).decode().splitlines()
+    assert lines[0] == "date,ed_count,visit_mean,los_mean,los_reference,los_difference,change"
+    assert lines[1:] == [f"2024-W{week:02d},3,10.5,180.12,193.54,-13.42,Abnahme" for week in range(start_week, end_week + 1)]
+
+
+def test_write_result_archives_keeps_message(result_manager, tmp_path):
+  timeframe = pd.DataFrame({'message': ["Error: No Data found in case_data files!"]})
+  path, = result_manager.write_result_archives(timeframe, [(2024, 1, 2024, 4)], tmp_path)
+  with zipfile.ZipFile(path) as zf:
+    assert zf.read(f"{path.stem}/{path.stem}.csv").decode() == "message\nError: No Data found in case_data files!\n"
+
 
-  with zipfile.ZipFile(zip_path, 'r') as zf:
-    file_list = zf.namelist()
-    expected_path = f"{test_file.stem}/{test_file.name}"
-    assert expected_path in file_list
+@pytest.mark.parametrize("timeframe", [
+  pd.DataFrame({'date': ["2024-W01"], 'ed_count': [3]}),
+  pd.DataFrame({column: ["2024-1"] for column in LosResultFileManager.result_columns}),
+  pd.DataFrame({column: ["2024-W01", "2024-W01"] for column in LosResultFileManager.result_columns})
+])
+def test_write_result_archives_rejects_invalid_timeframe(result_manager, tmp_path, timeframe):
+  with pytest.raises(RuntimeError):
+    result_manager.write_result_archives(timeframe, [(2024, 1, 2024, 4)], tmp_path)
@@ -21,6 +21,7 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+import io
 import os
 import sys
 import zipfile
@@ -30,7 +31,7 @@ import pandas as pd
 import pytest
 
 sys.path.append(str(Path(__file__).parent.parent.parent))
-from src.los_script import LosScriptManager
+from src.los_script import LosResultFileManager, LosScriptManager, PipelineMetrics
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -101,8 +102,8 @@ def create_test_zip(zip_path: Path, test_data: list[str]) -> Path:
 def compare_results(los_manager: LosScriptManager, zip_path: Path, start_end_cw: tuple[str, str, str, str], test_data: list[str],
     expected_data: list[list[str]]) -> bool:
   zip_path = create_test_zip(zip_path, test_data)
-  result_path = los_manager.execute_rscript(zip_path, *start_end_cw)
-  actual_df = pd.read_csv(result_path)
+  timeframe = los_manager.calculate_timeframe(zip_path, *start_end_cw)
+  actual_df = pd.read_csv(io.StringIO(LosResultFileManager.format_result_csv(timeframe)))
   expected_df = pd.DataFrame(expected_data[1:], columns=expected_data[0])
   return actual_df.astype(str).equals(expected_df)
 
@@ -177,3 +178,41 @@ def test_clinic_nodata(los_manager: LosScriptManager, test_zip_path: Path, start
                  ("aufnahme_ts\tentlassung_ts\ttriage_ts\ta_encounter_num\ta_encounter_ide\ta_billing_ide\n")]
     expected = standard_expected_data("1")
     assert compare_results(los_manager, test_zip_path, start_end_cw, test_data, expected)
+
+def test_single_clinic_streamed_input(test_zip_path: Path, start_end_cw: tuple[str, str, str, str], standard_test_data: str,
+    standard_expected_data: callable):
+  os.environ['RSCRIPT.INPUT_MODE'] = 'stream'
+  try:
+    assert compare_results(LosScriptManager(), test_zip_path, start_end_cw, [standard_test_data], standard_expected_data("1"))
+    assert not (test_zip_path.parent / 'broker_result' / '1_result').exists()
+  finally:
+    del os.environ['RSCRIPT.INPUT_MODE']
+
+
+def test_profile_markers_are_added_to_metrics(test_zip_path: Path, start_end_cw: tuple[str, str, str, str], standard_test_data: str,
+    standard_expected_data: callable):
+  os.environ['RSCRIPT.PROFILE'] = 'true'
+  try:
+    metrics = PipelineMetrics()
+    assert compare_results(LosScriptManager(metrics), test_zip_path, start_end_cw, [standard_test_data], standard_expected_data("1"))
+  finally:
+    del os.environ['RSCRIPT.PROFILE']
+  stages = {stage['stage']: stage for stage in metrics.report('ok')['stages']}
+  for step in ('unpackZip', 'unpackClinicResult', 'processFiles', 'performAnalysis', 'performAnalysis/filterLos', 'performAnalysis/calculateTimeframe'):
+    assert f'rscript/{step}' in stages
+  assert stages['rscript/processFiles']['rows'] == 3
+
+
+@pytest.mark.parametrize('input_mode', ['extract', 'stream'])
+def test_worker_runs_repeated_jobs_in_one_process(tmp_path: Path, start_end_cw: tuple[str, str, str, str], standard_test_data: str,
+    standard_expected_data: callable, input_mode: str):
+  os.environ.update({'RSCRIPT.WORKER': 'true', 'RSCRIPT.INPUT_MODE': input_mode})
+  los_manager = LosScriptManager()
+  for name in ('first', 'second'):
+    (tmp_path / name).mkdir()
+  try:
+    assert compare_results(los_manager, tmp_path / 'first' / 'test.zip', start_end_cw, [standard_test_data], standard_expected_data("1"))
+    assert compare_results(los_manager, tmp_path / 'second' / 'test.zip', start_end_cw, [standard_test_data] * 2, standard_expected_data("2"))
+  finally:
+    los_manager.close()
+    del os.environ['RSCRIPT.WORKER'], os.environ['RSCRIPT.INPUT_MODE']
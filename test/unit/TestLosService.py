@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import datetime
+import json
+import os
+import threading
+import urllib.request
+
+import pytest
+
+from src.los_script import CronSchedule, LosService
+
+
+@pytest.fixture
+def service_config(tmp_path) -> str:
+  environ = dict(os.environ)
+  config_path = tmp_path / 'config.toml'
+  config_path.write_text(f"""
+[BROKER]
+URL = "http://127.0.0.1:1"
+API_KEY = "test-key"
+RETRIES = "0"
+
+[REQUESTS]
+TAG = "test-tag"
+
+[SFTP]
+HOST = "127.0.0.1"
+PORT = "1"
+USERNAME = "test-user"
+PASSWORD = "test-pass"
+TIMEOUT = "1"
+FOLDER = "test-folder"
+
+[RSCRIPT]
+LOS_SCRIPT_PATH = "/path/to/script"
+LOS_MAX = "30"
+ERROR_MAX = "0.05"
+CLINIC_NUMS = "1-3"
+ENGINE = "python"
+
+[PUBLISH]
+RETRIES = "0"
+
+[METRICS]
+REPORT_PATH = "{tmp_path / 'run_report.json'}"
+
+[SCHEDULE]
+CRON = "0 6 * * 1"
+HEALTH_PORT = "0"
+""")
+  yield config_path
+  os.environ.clear()
+  os.environ.update(environ)
+
+
+def fetch(service: LosService, path: str) -> str:
+  host, port = service.health_address[:2]
+  with urllib.request.urlopen(f'http://{host}:{port}{path}', timeout=5) as response:
+    return response.read().decode('utf-8')
+
+
+@pytest.mark.parametrize('expression, after, expected', [
+  ('0 6 * * 1', datetime.datetime(2025, 1, 1, 12, 0), datetime.datetime(2025, 1, 6, 6, 0)),
+  ('0 6 * * 1', datetime.datetime(2025, 1, 6, 6, 0), datetime.datetime(2025, 1, 13, 6, 0)),
+  ('*/15 8-9 * * 1-5', datetime.datetime(2025, 1, 3, 9, 50), datetime.datetime(2025, 1, 6, 8, 0)),
+  ('30 2 1 * 7', datetime.datetime(2025, 1, 1, 3, 0), datetime.datetime(2025, 1, 5, 2, 30)),
+  ('0 0 29 2 *', datetime.datetime(2025, 1, 1, 0, 0), datetime.datetime(2028, 2, 29, 0, 0)),
+  ('0 12 * 3,6 *', datetime.datetime(2025, 6, 30, 12, 0), datetime.datetime(2026, 3, 1, 12, 0))
+])
+def test_cron_schedule_next_run(expression, after, expected):
+  assert CronSchedule(expression).next_run(after) == expected
+
+
+@pytest.mark.parametrize('expression', ['0 6 * *', '60 6 * * 1', '0 6 * * 1-8', '0 6 */0 * *', '0 6 x * *', '0 0 31 2 *'])
+def test_invalid_cron_schedule(expression):
+  with pytest.raises(SystemExit):
+    CronSchedule(expression).next_run(datetime.datetime(2025, 1, 1))
+
+
+def test_failed_run_is_reported_on_health_endpoint(service_config):
+  service = LosService(service_config)
+  try:
+    service.run_once()
+    health = service.health()
+    assert health['status'] == 'degraded' and health['runs'] == 1 and health['failed_runs'] == 1
+    assert health['last_run']['status'] == 'error' and 'Connection refused' in health['last_run']['error']
+    service.run_once()
+    assert service.health()['failed_runs'] == 2
+    report = json.loads((service_config.parent / 'run_report.json').read_text())
+    assert [stage['stage'] for stage in report['stages'] if stage['stage'] == 'broker_availability'] == ['broker_availability']
+  finally:
+    service.close()
+
+
+def test_serve_exposes_health_and_metrics_until_stopped(service_config):
+  service = LosService(service_config)
+  thread = threading.Thread(target=service.serve)
+  thread.start()
+  try:
+    for _ in range(50):
+      health = json.loads(fetch(service, '/health'))
+      if health['next_run']:
+        break
+      threading.Event().wait(0.05)
+    assert health['status'] == 'ok' and health['runs'] == 0
+    assert datetime.datetime.fromisoformat(health['next_run']).weekday() == 0
+    assert 'los_service_runs_total 0' in fetch(service, '/metrics')
+  finally:
+    service.stop()
+    thread.join(timeout=10)
+  assert not thread.is_alive()
+  assert service.health_address is None
+
+
+def test_service_requires_schedule(service_config):
+  service_config.write_text(service_config.read_text().replace('CRON = "0 6 * * 1"', ''))
+  with pytest.raises(SystemExit, match='SCHEDULE.CRON'):
+    LosService(service_config)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from src.los_script import PipelineGraph, PipelineMetrics
+
+
+@pytest.fixture
+def metrics_env(tmp_path: Path):
+  os.environ.update({
+    'METRICS.REPORT_PATH': str(tmp_path / 'report' / 'run_report.json'),
+    'METRICS.TEXTFILE_PATH': str(tmp_path / 'los.prom')
+  })
+  yield tmp_path
+  del os.environ['METRICS.REPORT_PATH'], os.environ['METRICS.TEXTFILE_PATH']
+
+
+def test_stage_records_duration_bytes_rows_and_memory():
+  metrics = PipelineMetrics()
+  with metrics.stage('download') as stage:
+    with metrics.stage('broker_download') as inner:
+      inner['bytes'] = 1024
+    stage['rows'] = 3
+  stages = metrics.report('ok')['stages']
+  assert [stage['stage'] for stage in stages] == ['download/broker_download', 'download']
+  assert stages[0]['bytes'] == 1024
+  assert stages[1]['rows'] == 3
+  assert all(stage['status'] == 'ok' and stage['duration_seconds'] >= 0 and stage['peak_rss_bytes'] > 0 for stage in stages)
+
+
+def test_failed_stage_is_recorded_as_error():
+  metrics = PipelineMetrics()
+  with pytest.raises(RuntimeError):
+    with metrics.stage('calculate'):
+      raise RuntimeError('R script failed')
+  assert metrics.report('error')['stages'][0]['status'] == 'error'
+
+
+def test_write_report_creates_json_and_prometheus_textfile(metrics_env):
+  metrics = PipelineMetrics()
+  with metrics.stage('sftp_upload') as stage:
+    stage['bytes'] = 2048
+  metrics.write_report('ok')
+  report = json.loads((metrics_env / 'report' / 'run_report.json').read_text())
+  assert report['status'] == 'ok'
+  assert report['stages'][0]['stage'] == 'sftp_upload'
+  textfile = (metrics_env / 'los.prom').read_text()
+  assert 'los_stage_bytes{stage="sftp_upload"} 2048' in textfile
+  assert 'los_run_success 1' in textfile
+  assert not list(metrics_env.glob('*.tmp'))
+
+
+def test_graph_overlaps_independent_stages_and_reports_critical_path():
+  metrics = PipelineMetrics()
+  graph = PipelineGraph(metrics)
+  graph.add('connect', lambda stage, results: time.sleep(0.2))
+  graph.add('download', lambda stage, results: time.sleep(0.3) or 'raw.zip')
+  graph.add('calculate', lambda stage, results: results['download'] + '.csv', ('download',))
+  graph.add('publish', lambda stage, results: results['calculate'], ('calculate', 'connect'))
+  start = time.perf_counter()
+  results = graph.run()
+  assert time.perf_counter() - start < 0.45
+  assert results['publish'] == 'raw.zip.csv'
+  report = metrics.report('ok')
+  assert report['critical_path']['stages'] == ['download', 'calculate', 'publish']
+  assert report['critical_path']['duration_seconds'] >= 0.3
+  assert {stage['stage'] for stage in report['stages']} == {'connect', 'download', 'calculate', 'publish'}
+
+
+def test_graph_nests_stages_per_thread():
+  metrics = PipelineMetrics()
+  graph = PipelineGraph(metrics)
+
+  def nested(name):
+    with metrics.stage(name):
+      time.sleep(0.05)
+
+  graph.add('download', lambda stage, results: nested('broker_download'))
+  graph.add('publish_prepare', lambda stage, results: nested('sftp'))
+  graph.run()
+  stages = {stage['stage'] for stage in metrics.report('ok')['stages']}
+  assert {'download/broker_download', 'publish_prepare/sftp'} <= stages
+
+
+def test_graph_does_not_start_stages_after_failure():
+  metrics = PipelineMetrics()
+  graph = PipelineGraph(metrics)
+  started = []
+
+  def fail(stage, results):
+    raise SystemExit(0)
+
+  graph.add('connect', lambda stage, results: time.sleep(0.1) or started.append('connect'))
+  graph.add('download', fail)
+  graph.add('calculate', lambda stage, results: started.append('calculate'), ('download',))
+  with pytest.raises(SystemExit):
+    graph.run()
+  assert started == ['connect']
+  statuses = {stage['stage']: stage['status'] for stage in metrics.report('skipped')['stages']}
+  assert statuses == {'connect': 'ok', 'download': 'error'}
+
+
+def test_graph_rejects_unknown_dependency():
+  graph = PipelineGraph()
+  with pytest.raises(ValueError):
+    graph.add('calculate', lambda stage, results: None, ('download',))
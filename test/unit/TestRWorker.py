@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import io
+import json
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+import pytest
+
+from src.los_script import LosScriptManager, PipelineMetrics, RWorker
+
+FAKE_RSCRIPT = '''#!{python}
+import json, os, sys, time
+result = os.fdopen(int(os.environ['LOS_RESULT_FD']), 'w')
+memory = []
+
+
+def run_job(args, input):
+  if args[0] == 'fail' or args[1] == '0000':
+    raise ValueError('boom')
+  if args[0] == 'hang' or args[1] == '9999':
+    time.sleep(600)
+  if args[0] == 'grow':
+    memory.append(bytearray(64 * 1024 * 1024))
+  rows = 0
+  if args[8] == 'stream':
+    with open(args[10]) if len(args) >= 11 else input as f:
+      rows = sum(1 for _ in f)
+  print('[1] "Directory created."')
+  result.write(json.dumps({{'date': ['2023-W30'], 'ed_count': [rows], 'visit_mean': [3], 'los_mean': [70.87], 'los_reference': [193.54],
+                           'los_difference': [-122.66], 'change': ['Abnahme'], 'job': [args[0]]}}) + '\\n')
+  result.flush()
+
+
+if sys.argv[2:] != ['--worker']:
+  run_job(sys.argv[2:], sys.stdin)
+  sys.exit(0)
+print('worker_ready', flush=True)
+for line in sys.stdin:
+  args = line.rstrip('\\n').split('\\t')
+  if args[0] == 'crash':
+    print('segfault', file=sys.stderr, flush=True)
+    sys.exit(3)
+  try:
+    run_job(args, None)
+    print('job_end:ok', flush=True)
+  except ValueError as e:
+    print('job_end:error:%s' % e, flush=True)
+'''
+
+
+def job(zip_path: str) -> list[str]:
+  return [zip_path, '2023', '30', '2023', '30', '410', '25', '1,2', 'extract', '1']
+
+
+@pytest.fixture
+def fake_rscript(tmp_path, monkeypatch) -> Path:
+  bin_dir = tmp_path / 'bin'
+  bin_dir.mkdir()
+  rscript = bin_dir / 'Rscript'
+  rscript.write_text(FAKE_RSCRIPT.format(python=sys.executable))
+  rscript.chmod(0o755)
+  monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+  return tmp_path / 'LOSCalculator.R'
+
+
+@pytest.fixture
+def worker(fake_rscript):
+  worker = RWorker(fake_rscript)
+  yield worker
+  worker.stop()
+
+
+def test_jobs_are_dispatched_to_the_same_process(worker):
+  first_output, first_result = worker.run(job('/data/a.zip'))
+  pid = worker.pid
+  _, second_result = worker.run(job('/data/b.zip'))
+  assert worker.pid == pid
+  assert 'Directory created.' in first_output
+  assert json.loads(first_result)['job'] == ['/data/a.zip'] and json.loads(second_result)['job'] == ['/data/b.zip']
+
+
+def test_failed_job_keeps_worker_running(worker):
+  worker.start()
+  pid = worker.pid
+  with pytest.raises(RuntimeError, match='boom'):
+    worker.run(job('fail'))
+  assert worker.pid == pid
+  worker.run(job('/data/a.zip'))
+
+
+def test_crashed_worker_is_started_again(worker):
+  worker.start()
+  pid = worker.pid
+  with pytest.raises(RuntimeError, match='segfault'):
+    worker.run(job('crash'))
+  assert not worker.is_running
+  worker.run(job('/data/a.zip'))
+  assert worker.is_running and worker.pid != pid
+
+
+def test_hung_job_kills_worker_after_timeout(fake_rscript):
+  worker = RWorker(fake_rscript, job_timeout=1)
+  try:
+    worker.start()
+    pid = worker.pid
+    with pytest.raises(RuntimeError, match='timed out'):
+      worker.run(job('hang'))
+    assert not worker.is_running
+    worker.run(job('/data/a.zip'))
+    assert worker.is_running and worker.pid != pid
+  finally:
+    worker.stop()
+
+
+def test_worker_is_stopped_after_memory_growth(fake_rscript):
+  worker = RWorker(fake_rscript, max_rss_mb=48)
+  try:
+    worker.run(job('/data/a.zip'))
+    assert worker.is_running
+    worker.run(job('grow'))
+    assert not worker.is_running
+  finally:
+    worker.stop()
+
+
+@pytest.mark.parametrize('worker_enabled', ['true', 'false'])
+def test_streamed_case_data_and_result_are_passed_through_pipes(fake_rscript, tmp_path, monkeypatch, worker_enabled):
+  clinic_zip = io.BytesIO()
+  with zipfile.ZipFile(clinic_zip, 'w') as zf:
+    zf.writestr('case_data.txt', 'aufnahme_ts\tentlassung_ts\ttriage_ts\n'
+                                 '2023-07-28T21:55:36Z\t2023-07-28T23:02:49Z\t2023-07-28T21:58:08Z\n'
+                                 '2023-07-28T22:21:09Z\t2023-07-28T23:37:27Z\t2023-07-28T22:21:49Z\n')
+  zip_path = tmp_path / 'result.zip'
+  with zipfile.ZipFile(zip_path, 'w') as zf:
+    zf.writestr('1_result.zip', clinic_zip.getvalue())
+  for key, value in {'RSCRIPT.LOS_SCRIPT_PATH': str(fake_rscript), 'RSCRIPT.LOS_MAX': '410', 'RSCRIPT.ERROR_MAX': '25',
+                     'RSCRIPT.CLINIC_NUMS': '1,2', 'RSCRIPT.INPUT_MODE': 'stream', 'RSCRIPT.WORKER': worker_enabled,
+                     'RSCRIPT.JOB_TIMEOUT': '1'}.items():
+    monkeypatch.setenv(key, value)
+  metrics = PipelineMetrics()
+  los_manager = LosScriptManager(metrics)
+  try:
+    for _ in range(2):
+      timeframe = los_manager.calculate_timeframe(zip_path, '2023', '30', '2023', '30')
+      assert timeframe.astype(str).values.tolist() == [['2023-W30', '2', '3', '70.87', '193.54', '-122.66', 'Abnahme', str(zip_path)]]
+    with pytest.raises(RuntimeError, match='boom'):
+      los_manager.calculate_timeframe(zip_path, '0000', '30', '2023', '30')
+    with pytest.raises(RuntimeError, match='timed out'):
+      los_manager.calculate_timeframe(zip_path, '9999', '30', '2023', '30')
+  finally:
+    los_manager.close()
+  assert [(stage['status'], stage.get('rows')) for stage in metrics.report('error')['stages']] == [('ok', 2), ('ok', 2), ('error', None), ('error', None)]
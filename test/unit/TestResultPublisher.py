@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+@AUTHOR: Alexander Kombeiz (akombeiz@ukaachen.de)
+"""
+
+#
+#  Copyright (c) 2025 AKTIN
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.los_script import PipelineMetrics, ResultPublisher
+
+ACCESS_KEY = 'AKIDEXAMPLE'
+SECRET_KEY = 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY'
+REGION = 'eu-central-1'
+
+
+def verify_signature(method: str, path: str, headers) -> bool:
+  authorization = headers['Authorization']
+  credential = authorization.split('Credential=')[1].split(',')[0]
+  access_key, date, region, service, _ = credential.split('/')
+  signed_headers = authorization.split('SignedHeaders=')[1].split(',')[0]
+  canonical_headers = ''.join(f"{name}:{headers[name]}\n" for name in signed_headers.split(';'))
+  canonical_request = '\n'.join([method, path, '', canonical_headers, signed_headers, headers['x-amz-content-sha256']])
+  string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', headers['x-amz-date'], f'{date}/{region}/{service}/aws4_request',
+                              hashlib.sha256(canonical_request.encode()).hexdigest()])
+  key = ('AWS4' + SECRET_KEY).encode()
+  for part in (date, region, service, 'aws4_request'):
+    key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+  expected = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+  return access_key == ACCESS_KEY and region == REGION and authorization.endswith(f'Signature={expected}')
+
+
+class StubObjectStore:
+  """Accepts SigV4-signed PUT requests like an S3-compatible store and keeps the objects in memory."""
+
+  def __init__(self):
+    self.objects = {}
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.__create_handler())
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+  @property
+  def url(self) -> str:
+    return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+  def __create_handler(self):
+    store = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def log_message(self, *args):
+        pass
+
+      def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        valid = (verify_signature('PUT', self.path, self.headers)
+                 and hashlib.sha256(body).hexdigest() == self.headers['x-amz-content-sha256']
+                 and base64.b64encode(hashlib.md5(body).digest()).decode() == self.headers['Content-MD5'])
+        if valid:
+          store.objects[self.path] = body
+        self.send_response(200 if valid else 403)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    return Handler
+
+
+@pytest.fixture
+def object_store():
+  store = StubObjectStore()
+  yield store
+  store.server.shutdown()
+  store.server.server_close()
+
+
+@pytest.fixture
+def publish_env(monkeypatch, tmp_path, object_store):
+  settings = {
+    'SFTP.HOST': '127.0.0.1', 'SFTP.PORT': '1', 'SFTP.USERNAME': 'user', 'SFTP.PASSWORD': 'pass', 'SFTP.TIMEOUT': '1', 'SFTP.FOLDER': 'test',
+    'PUBLISH.TARGETS': 'archive,objects', 'PUBLISH.RETRIES': '1', 'PUBLISH.BACKOFF': '0.01',
+    'PUBLISH.archive.TYPE': 'local', 'PUBLISH.archive.DIR': str(tmp_path / 'archive'),
+    'PUBLISH.objects.TYPE': 's3', 'PUBLISH.objects.ENDPOINT': object_store.url, 'PUBLISH.objects.BUCKET': 'los',
+    'PUBLISH.objects.PREFIX': 'reports/weekly', 'PUBLISH.objects.ACCESS_KEY': ACCESS_KEY,
+    'PUBLISH.objects.SECRET_KEY': SECRET_KEY, 'PUBLISH.objects.REGION': REGION
+  }
+  for key, value in settings.items():
+    monkeypatch.setenv(key, value)
+  return tmp_path
+
+
+def test_failing_destination_does_not_block_the_others(publish_env, object_store):
+  archive = publish_env / 'LOS_2025-W01_to_2025-W04_20250127-120000.zip'
+  archive.write_bytes(os.urandom(4096))
+  metrics = PipelineMetrics()
+  publisher = ResultPublisher(metrics)
+  assert publisher.destinations == ['sftp', 'archive', 'objects']
+  with pytest.raises(RuntimeError, match='sftp'):
+    publisher.publish([archive])
+  publisher.close()
+  assert (publish_env / 'archive' / archive.name).read_bytes() == archive.read_bytes()
+  assert object_store.objects[f'/los/reports/weekly/{archive.name}'] == archive.read_bytes()
+  results = {stage['stage']: stage for stage in metrics.report('error')['stages']}
+  assert results['sftp']['status'] == 'error' and results['sftp']['attempts'] == 2 and 'error' in results['sftp']
+  assert results['archive']['status'] == 'ok' and results['archive']['attempts'] == 1
+  assert results['objects']['status'] == 'ok' and results['objects']['bytes'] == 4096
+
+
+def test_rejected_s3_upload_is_reported(publish_env, monkeypatch):
+  monkeypatch.setenv('PUBLISH.objects.SECRET_KEY', 'wrong')
+  archive = publish_env / 'result.zip'
+  archive.write_bytes(b'content')
+  metrics = PipelineMetrics()
+  with pytest.raises(RuntimeError, match='objects'):
+    ResultPublisher(metrics).publish([archive])
+  results = {stage['stage']: stage for stage in metrics.report('error')['stages']}
+  assert 'HTTP 403' in results['objects']['error']
+
+
+@pytest.mark.parametrize('key, value', [('PUBLISH.archive.TYPE', 'ftp'), ('PUBLISH.TARGETS', 'archive,sftp')])
+def test_invalid_target_configuration(publish_env, monkeypatch, key, value):
+  monkeypatch.setenv(key, value)
+  with pytest.raises(SystemExit):
+    ResultPublisher()
+
+
+def test_missing_target_key(publish_env, monkeypatch):
+  monkeypatch.delenv('PUBLISH.archive.DIR')
+  with pytest.raises(SystemExit, match='PUBLISH.archive.DIR'):
+    ResultPublisher()
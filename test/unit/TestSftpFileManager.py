@@ -21,11 +21,14 @@
 #
 
 import os
+import threading
+from unittest.mock import MagicMock
 
 import docker
+import paramiko
 import pytest
 
-from src.los_script import SftpFileManager
+from src.los_script import SftpConnectionPool, SftpFileManager
 
 DOCKER_IMAGE = 'ubuntu:20.04'
 USER_NAME = 'sftpuser'
@@ -132,3 +135,99 @@ def test_delete_nonexistent_file(sftp_manager):
     Ensure deleting a non-existent file does not raise an exception.
     """
   sftp_manager.delete_file('nonexistent.txt')
+
+
+def test_upload_file_in_parallel_chunks_with_hash_verification(docker_setup):
+  test_file = docker_setup['temp_dir'] / 'test_parallel.zip'
+  test_file.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+  os.environ.update({'SFTP.CHANNELS': '4', 'SFTP.PARALLEL_MIN_MB': '1', 'SFTP.VERIFY': 'hash'})
+  try:
+    sftp_manager = SftpFileManager()
+    sftp_manager.upload_file(test_file)
+    assert test_file.name in sftp_manager.list_files()
+  finally:
+    del os.environ['SFTP.CHANNELS'], os.environ['SFTP.PARALLEL_MIN_MB'], os.environ['SFTP.VERIFY']
+
+
+def test_invalid_verification_mode(docker_setup):
+  os.environ['SFTP.VERIFY'] = 'crc'
+  try:
+    with pytest.raises(SystemExit):
+      SftpFileManager()
+  finally:
+    del os.environ['SFTP.VERIFY']
+
+
+def test_publish_files_replaces_targets_and_prunes_stale_files(docker_setup, sftp_manager):
+  stale_file = docker_setup['temp_dir'] / 'test_stale.zip'
+  stale_file.write_text('stale')
+  sftp_manager.upload_file(stale_file)
+  result_file = docker_setup['temp_dir'] / 'test_result.zip'
+  result_file.write_text('old result')
+  sftp_manager.upload_file(result_file)
+  result_file.write_text('new result')
+  os.environ['SFTP.PUBLISH_MODE'] = 'atomic'
+  try:
+    publisher = SftpFileManager()
+    publisher.publish_files([result_file])
+    assert publisher.list_files() == [result_file.name]
+  finally:
+    del os.environ['SFTP.PUBLISH_MODE']
+
+
+def test_connection_is_opened_lazily(monkeypatch):
+  for key, value in {'SFTP.HOST': '127.0.0.1', 'SFTP.PORT': '1', 'SFTP.USERNAME': USER_NAME, 'SFTP.PASSWORD': USER_PASSWORD,
+                     'SFTP.TIMEOUT': '1', 'SFTP.FOLDER': SFTP_DIRNAME}.items():
+    monkeypatch.setenv(key, value)
+  with SftpFileManager() as unreachable_manager:
+    with pytest.raises(OSError):
+      unreachable_manager.list_files()
+
+
+def test_shared_pool_reuses_session_after_close(docker_setup):
+  with SftpConnectionPool() as pool:
+    first_manager, second_manager = SftpFileManager(pool), SftpFileManager(pool)
+    test_file = docker_setup['temp_dir'] / 'test_pool.txt'
+    test_file.write_text('pooled')
+    first_manager.upload_file(test_file)
+    first_manager.close()
+    assert test_file.name in second_manager.list_files()
+    pool.close()
+    assert test_file.name in second_manager.list_files()
+
+
+def test_sessions_to_different_endpoints_are_opened_concurrently(monkeypatch):
+  handshakes = threading.Barrier(2, timeout=5)
+  connects = []
+
+  def connect(self, host, port, username, password, timeout):
+    connects.append(host)
+    handshakes.wait()
+    return MagicMock()
+
+  monkeypatch.setattr(SftpConnectionPool, '_SftpConnectionPool__connect', connect)
+  monkeypatch.setattr(paramiko.SFTPClient, 'from_transport', MagicMock())
+  errors = []
+
+  def open_channel(pool, host):
+    try:
+      with pool.channel((host, 22, USER_NAME, USER_PASSWORD, 1, 1024, 1024)):
+        pass
+    except Exception as e:
+      errors.append(e)
+
+  with SftpConnectionPool() as pool:
+    threads = [threading.Thread(target=open_channel, args=(pool, host)) for host in ('primary', 'mirror')]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert not errors
+    assert sorted(connects) == ['mirror', 'primary']
+    threads = [threading.Thread(target=open_channel, args=(pool, 'primary')) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assert not errors
+    assert sorted(connects) == ['mirror', 'primary']